@@ -5,6 +5,7 @@ from datetime import datetime, timezone
 import discord
 from discord.ext import commands
 
+import outbound
 import scheduler
 from timeconverter import time_converter
 
@@ -53,17 +54,38 @@ class AdminCommands(commands.Cog, command_attrs=dict(hidden=True)):
             asyncio.create_task(ctx.message.delete())
         asyncio.create_task(channel.send(msg))
 
+    @commands.command(aliases=["queuestats", "sendstats"])
+    @commands.is_owner()
+    async def outboundstats(self, ctx):
+        embed = discord.Embed(title="Outbound Messages", color=discord.Color(0xB565D9),
+                              description=f"{outbound.gateway.depth} queued in "
+                                          f"{len(outbound.gateway.workers)} bucket(s)")
+        for priority, stats in outbound.gateway.stats().items():
+            embed.add_field(name=priority.name.title(),
+                            value=f"Queued: {stats['queued']}\n"
+                                  f"Sent: {stats['sent']}\n"
+                                  f"Failed: {stats['failed']}\n"
+                                  f"Shed: {stats['shed']}\n"
+                                  f"Latency: {stats['latency_avg'] * 1000:.0f}ms avg, "
+                                  f"{stats['latency_p95'] * 1000:.0f}ms p95")
+        replies = outbound.replystats["replies"]
+        fallbacks = outbound.replystats["fallbacks"]
+        embed.add_field(name="Replies", value=f"{replies} replies, {fallbacks} sent without a reference "
+                                              f"({fallbacks / replies if replies else 0:.1%})", inline=False)
+        await ctx.reply(embed=embed)
+
     @commands.command()
     @commands.is_owner()
     async def testschedule(self, ctx, time: time_converter):
         scheduletime = datetime.now(tz=timezone.utc) + time
-        await scheduler.schedule(scheduletime, "debug", {"message": "hello world!"})
+        await scheduler.schedule(scheduletime, "debug", {"message": "hello world!"}, durable=False)
 
     @commands.command()
     @commands.is_owner()
     async def schedulemessage(self, ctx, time: time_converter, *, message):
         scheduletime = datetime.now(tz=timezone.utc) + time
-        await scheduler.schedule(scheduletime, "message", {"channel": ctx.channel.id, "message": message})
+        await scheduler.schedule(scheduletime, "message", {"channel": ctx.channel.id, "message": message},
+                                 durable=False)
 
 
 '''
@@ -0,0 +1,256 @@
+import asyncio
+import collections
+import json
+import re
+import time
+import typing
+import unicodedata
+from datetime import datetime, timedelta, timezone
+
+import discord
+import humanize
+from discord.ext import commands
+
+import database
+import jsonconfig
+import massaction
+import modlog
+import scheduler
+from clogs import logger
+from moderation import ban_action, mod_only, mute_action, update_server_config
+
+RING_SIZE = 1000  # most joins remembered per guild, older ones are dropped even if they're still in the window
+ACTIONS = ("none", "mute", "ban")
+# settings of a guild with anti-raid turned on, until they're changed with m.antiraid. durations are in seconds.
+DEFAULTS = {
+    "joins": 10,  # joins within window that count as a raid
+    "window": 10,
+    "young_joins": 5,  # joins of accounts younger than account_age within window that count as a raid
+    "account_age": 86400 * 7,
+    "similar_names": 4,  # joins with the same name once numbers, symbols and accents are ignored within window
+    "action": "none",  # done to everyone who joins during a raid
+    "action_duration": 0,  # 0 for permanent
+    "lockdown": 3600,  # how long to raise the verification level for when a raid starts, 0 to not
+    "cooldown": 60  # a raid is over once nobody has joined for this long
+}
+
+
+class RaidConfig(jsonconfig.JSONConfig):
+    __slots__ = tuple(DEFAULTS)
+    DEFAULTS = DEFAULTS
+    DURATIONS = frozenset({"window", "account_age", "action_duration", "lockdown", "cooldown"})
+    ACTIONS = ACTIONS
+
+
+configs = jsonconfig.ConfigCache("anti_raid", RaidConfig)
+get_config = configs.get
+invalidate_config = configs.invalidate  # call after changing anti_raid of a guild
+
+
+def name_skeleton(name: str) -> str:
+    """
+    reduce a name to what's left once things raid bots vary are removed, so "raider_123" and "Ráider456" match
+    :param name: a username
+    :return: lowercase letters of the name without accents
+    """
+    name = unicodedata.normalize("NFKD", name.casefold())
+    return re.sub(r"[\W\d_]", "", name)
+
+
+class JoinWindow:
+    """recent joins of one guild with running counts, so checking for a raid doesn't depend on how many joined"""
+    __slots__ = ("joins", "young", "names", "raid_until")
+
+    def __init__(self):
+        self.joins: typing.Deque[typing.Tuple[float, int, bool, str]] = collections.deque()
+        self.young = 0
+        self.names: typing.Counter[str] = collections.Counter()
+        self.raid_until = 0.0
+
+    def pop(self):
+        _, _, young, skeleton = self.joins.popleft()
+        self.young -= young
+        self.names[skeleton] -= 1
+        if not self.names[skeleton]:
+            del self.names[skeleton]
+
+    def add(self, now: float, memberid: int, young: bool, skeleton: str, window: float):
+        while self.joins and (self.joins[0][0] <= now - window or len(self.joins) >= RING_SIZE):
+            self.pop()
+        self.joins.append((now, memberid, young, skeleton))
+        self.young += young
+        self.names[skeleton] += 1
+
+    def check(self, config: RaidConfig, skeleton: str) -> typing.Optional[str]:
+        """
+        :param config: the guild's config
+        :param skeleton: name skeleton of the member who just joined
+        :return: why this is a raid, or None if it isn't
+        """
+        window = humanize.precisedelta(config.window)
+        if config.joins and len(self.joins) >= config.joins:
+            return f"{len(self.joins)} members joined within {window}"
+        if config.young_joins and self.young >= config.young_joins:
+            return f"{self.young} accounts younger than {humanize.precisedelta(config.account_age)} joined " \
+                   f"within {window}"
+        # only the newest name can have just crossed the threshold
+        if config.similar_names and skeleton and self.names[skeleton] >= config.similar_names:
+            return f"{self.names[skeleton]} members named like `{skeleton}` joined within {window}"
+        return None
+
+
+windows: typing.Dict[int, JoinWindow] = {}
+
+
+async def lockdown(guild: discord.Guild, length: int) -> bool:
+    """
+    raise the guild's verification level until length seconds from now
+    :return: if the verification level was raised, False if it already was high enough or it couldn't be changed
+    """
+    before = guild.verification_level
+    if before >= discord.VerificationLevel.high:
+        return False
+    try:
+        await guild.edit(verification_level=discord.VerificationLevel.high, reason="Raid detected.")
+    except discord.HTTPException as e:
+        logger.warning(f"couldn't lock down {guild}: {e}")
+        return False
+    await scheduler.schedule(datetime.now(tz=timezone.utc) + timedelta(seconds=length), "end_lockdown",
+                             {"guild": guild.id, "verification_level": before.value})
+    return True
+
+
+async def respond(guild: discord.Guild, config: RaidConfig, members: typing.List[discord.Member]):
+    """do the configured action to members who joined during a raid"""
+    if config.action == "none" or not members:
+        return
+    length = timedelta(seconds=config.action_duration) if config.action_duration else None
+    reason = "Automatically " + ("banned" if config.action == "ban" else "muted") + " during a raid."
+    pending = []
+    semaphore = asyncio.Semaphore(massaction.CONCURRENCY)
+
+    async def act(member: discord.Member) -> bool:
+        async with semaphore:
+            try:
+                if config.action == "ban":
+                    return bool(await ban_action(member, guild, length, reason, pending))
+                return bool(await mute_action(member, length, reason, pending))
+            except discord.HTTPException as e:
+                logger.warning(f"anti-raid couldn't {config.action} {member}: {e}")
+                return False
+
+    try:
+        results = await asyncio.gather(*[act(member) for member in members])
+    finally:
+        await scheduler.schedule_many(pending)
+    done = [member for member, success in zip(members, results) if success]
+    verb = "banned" if config.action == "ban" else "muted"
+    await modlog.modlog_many([(member.id, f"{member.mention} (`{member}`) was automatically {verb} during a raid.")
+                              for member in done], guild.id, None,
+                             f"Automatically {verb} {len(done)}/{len(members)} members who joined during a raid.")
+
+
+class AntiRaidCog(commands.Cog, name="Anti-Raid"):
+    """
+    Automatic protection from join raids.
+    """
+
+    def __init__(self, bot):
+        self.bot: commands.Bot = bot
+
+    @commands.Cog.listener()
+    async def on_member_join(self, member: discord.Member):
+        if member.bot:  # only admins can add bots
+            return
+        config = await get_config(member.guild.id)
+        if not config.enabled:
+            return
+        now = time.monotonic()
+        window = windows.setdefault(member.guild.id, JoinWindow())
+        young = (discord.utils.utcnow() - member.created_at).total_seconds() < config.account_age
+        skeleton = name_skeleton(member.name)
+        window.add(now, member.id, young, skeleton, config.window)
+        if window.raid_until > now:  # raid is still going, deal with this member too
+            window.raid_until = now + config.cooldown
+            await respond(member.guild, config, [member])
+            return
+        reason = window.check(config, skeleton)
+        if reason is None:
+            return
+        window.raid_until = now + config.cooldown
+        # everyone in the window is part of the raid, not just the one who set it off. taken before awaiting anything,
+        # members joining after this are already handled one by one since raid_until is set.
+        joined = [memberid for _, memberid, _, _ in window.joins]
+        logger.info(f"raid detected in {member.guild}: {reason}")
+        lockeddown = config.lockdown and await lockdown(member.guild, config.lockdown)
+        await modlog.modlog(f"🚨 **Raid detected**: {reason}. " +
+                            (f"Raised the verification level for "
+                             f"{humanize.precisedelta(config.lockdown)}. " if lockeddown else "") +
+                            (f"Members who join in the next {humanize.precisedelta(config.cooldown)} will be "
+                             f"{'banned' if config.action == 'ban' else 'muted'}. "
+                             if config.action != "none" else "") +
+                            "Use `m.endraid` to end it early.", member.guild.id)
+        joined = [member.guild.get_member(memberid) for memberid in joined]
+        await respond(member.guild, config, [m for m in joined if m is not None])
+
+    @commands.command(aliases=["raidprotection", "raidconfig"])
+    @commands.has_guild_permissions(manage_guild=True)
+    @commands.guild_only()
+    async def antiraid(self, ctx, setting: typing.Optional[str] = None, *, value: typing.Optional[str] = None):
+        """
+        Set up automatic raid protection.
+        When too many members join too quickly, too many new accounts join, or too many members with similar
+        names join, the verification level is raised for a while and everyone joining during the raid can be
+        muted or banned.
+
+        :param ctx: discord context
+        :param setting: `on`, `off`, or the name of a setting to change. leave blank to see the current settings.
+        :param value: the new value of the setting. counts are numbers (0 to not check), times are like `10s` or `7d`,
+        and action is `none`, `mute` or `ban`.
+        """
+        config = await get_config(ctx.guild.id)
+        if setting is None:
+            await ctx.reply(embed=config.embed(f"Anti-raid for {ctx.guild.name}"))
+            return
+        setting = setting.lower()
+        settings = config.change(setting, value)
+        await update_server_config(ctx.guild.id, "anti_raid", None if settings is None else json.dumps(settings))
+        invalidate_config(ctx.guild.id)
+        text = "turned anti-raid off" if settings is None else "turned anti-raid on" if setting == "on" \
+            else f"set anti-raid `{setting}` to `{settings[setting]}`"
+        await ctx.reply(f"✔️ {text[0].upper()}{text[1:]}.")
+        await modlog.modlog(f"{ctx.author.mention} (`{ctx.author}`) {text}.", ctx.guild.id, modid=ctx.author.id)
+
+    @commands.command(aliases=["raidover", "unlockdown"])
+    @mod_only()
+    async def endraid(self, ctx):
+        """
+        End a detected raid early, lowering the verification level back to what it was.
+        """
+        window = windows.get(ctx.guild.id)
+        if window is not None:
+            window.raid_until = 0.0
+        # the scheduler's index knows the lockdown's row, so only that row is read instead of searching the schedule.
+        # the oldest lockdown has the level from before the raid.
+        lockdowns = scheduler.eventindex.get(("end_lockdown", ctx.guild.id, None))
+        row = None
+        if lockdowns:
+            async with database.db.execute("SELECT eventdata FROM schedule WHERE id=?", (min(lockdowns),)) as cur:
+                row = await cur.fetchone()
+        restored = discord.VerificationLevel(json.loads(row[0])["verification_level"]) if row else None
+        await scheduler.cancel_matching("end_lockdown", ctx.guild.id)
+        if restored is not None:
+            await ctx.guild.edit(verification_level=restored, reason=f"Raid ended by {ctx.author}.")
+        await ctx.reply(f"✔️ Ended the raid"
+                        f"{f' and set the verification level back to {restored}' if restored else ''}.")
+        await modlog.modlog(f"{ctx.author.mention} (`{ctx.author}`) ended the raid.", ctx.guild.id,
+                            modid=ctx.author.id)
+
+
+'''
+Steps to convert:
+@bot.command() -> @commands.command()
+@bot.listen() -> @commands.Cog.listener()
+function(ctx, ...): -> function(self, ctx, ...)
+bot -> self.bot
+'''
@@ -0,0 +1,42 @@
+"""
+microbenchmark for embedutils.split_embed() and pack_embeds() on embeds with hundreds of fields, like a long
+warns or modlogs page.
+run from the repo root: python benchmarks/embed_bench.py
+"""
+import os
+import sys
+import timeit
+
+import discord
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from embedutils import pack_embeds, split_embed  # noqa: E402
+
+RUNS = 50
+
+
+def make_embed(fieldcount: int, valuelength: int) -> discord.Embed:
+    embed = discord.Embed(title="Warns of someone", description="x" * 200, color=discord.Color(0xB565D9))
+    for i in range(fieldcount):
+        embed.add_field(name=f"Warn #{i} by moderator", value="y" * valuelength, inline=False)
+    return embed
+
+
+def main():
+    for fieldcount, valuelength in ((100, 100), (300, 200), (500, 1000)):
+        embed = make_embed(fieldcount, valuelength)
+        embeds = split_embed(embed)
+        # the output has to be sendable, otherwise the timing means nothing
+        assert all(len(e) <= 6000 and len(e.fields) <= 25 for e in embeds)
+        assert sum(len(e.fields) for e in embeds) == fieldcount
+        messages = pack_embeds(embeds)
+        assert all(len(m) <= 10 and sum(len(e) for e in m) <= 6000 for m in messages)
+        split = timeit.timeit(lambda: split_embed(embed), number=RUNS) / RUNS
+        pack = timeit.timeit(lambda: pack_embeds(embeds), number=RUNS) / RUNS
+        print(f"{fieldcount} fields of {valuelength} chars -> {len(embeds)} embeds in {len(messages)} messages: "
+              f"split_embed {split * 1000:.2f}ms, pack_embeds {pack * 1000:.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
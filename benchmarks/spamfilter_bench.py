@@ -0,0 +1,53 @@
+"""
+benchmark for spamfilter.check(), which runs on every message in guilds with the spam filter on.
+messages come from more (guild, user) pairs than spamfilter.STATE_SIZE so the eviction path is measured too.
+run from the repo root: python benchmarks/spamfilter_bench.py
+"""
+import os
+import random
+import sys
+import time
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import spamfilter  # noqa: E402
+
+MESSAGES = 200000
+GUILDS = 50
+USERS_PER_GUILD = 2000  # 100000 pairs, twice STATE_SIZE
+TARGET = 50e-6  # seconds per message
+
+CONTENTS = ["hello", "hi everyone", "check this out https://example.com", "lol", "<:pog:123456789012345678> " * 25,
+            "😀" * 30, "a much longer message about nothing in particular, " * 10, ""]
+
+
+def make_messages(count: int) -> list:
+    random.seed(0)
+    guilds = [types.SimpleNamespace(id=1000 + g) for g in range(GUILDS)]
+    users = [types.SimpleNamespace(id=5000 + u) for u in range(USERS_PER_GUILD)]
+    # attribute access like a real discord.Message, without needing a connection to build one
+    return [types.SimpleNamespace(guild=random.choice(guilds), author=random.choice(users),
+                                  content=random.choice(CONTENTS), attachments=[]) for _ in range(count)]
+
+
+def main():
+    config = spamfilter.SpamConfig({})
+    messages = make_messages(MESSAGES)
+    spamfilter.states.clear()
+    start = time.perf_counter()
+    spam = 0
+    for message in messages:
+        if spamfilter.check(message, config)[0] is not None:
+            spam += 1
+    elapsed = time.perf_counter() - start
+    assert len(spamfilter.states) == spamfilter.STATE_SIZE  # eviction happened and kept the bound
+    permessage = elapsed / MESSAGES
+    print(f"{MESSAGES} messages from {GUILDS * USERS_PER_GUILD} (guild, user) pairs, {spam} spam: "
+          f"{permessage * 1e6:.2f}µs per message (target {TARGET * 1e6:.0f}µs)")
+    if permessage > TARGET:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
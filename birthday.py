@@ -6,8 +6,6 @@ from discord.ext import commands
 import database
 import moderation
 import modlog
-import scheduler
-from clogs import logger
 
 
 class BirthdayCog(commands.Cog, name="Birthday Commands"):
@@ -34,31 +32,12 @@ class BirthdayCog(commands.Cog, name="Birthday Commands"):
         except ValueError as e:
             await ctx.reply(str(e))
             return
-        # cancel all existing birthday events
-        async with database.db.execute("SELECT id FROM schedule WHERE json_extract(eventdata, \"$.user\")=? "
-                                       "AND eventtype=?",
-                                       (ctx.author.id, "birthday")) as cur:
-            async for event in cur:
-                await scheduler.canceltask(event[0])
-        # insert birthday into db
+        # the hourly birthday sweep picks this up by month/day, no need to schedule anything
         await database.db.execute(
-            "REPLACE INTO birthdays(user,birthday) "
-            "VALUES (?,?)",
-            (ctx.author.id, birthday.timestamp()))
+            "REPLACE INTO birthdays(user,birthday,month,day,tz) "
+            "VALUES (?,?,?,?,?)",
+            (ctx.author.id, birthday.timestamp(), month, day, tz))
         await database.db.commit()
-        # calculate next birthday
-        now = datetime.datetime.now(tz=datetime.timezone(datetime.timedelta(hours=tz)))
-        thisyear = now.year
-        nextbirthday = birthday
-        while nextbirthday < now:
-            try:
-                nextbirthday = nextbirthday.replace(year=thisyear)
-            except ValueError as e:  # leap years are weird
-                logger.debug(str(e))
-            thisyear += 1
-        # schedule birthday event on next birthday
-        await scheduler.schedule(nextbirthday, "birthday",
-                                 {"user": ctx.author.id, "birthday": birthday.timestamp()})
         await ctx.reply(f"Set birthday to <t:{int(birthday.timestamp())}:f>")
 
     @commands.command()
@@ -102,31 +81,12 @@ class BirthdayCog(commands.Cog, name="Birthday Commands"):
         except ValueError as e:
             await ctx.reply(str(e))
             return
-        # cancel all existing birthday events
-        async with database.db.execute("SELECT id FROM schedule WHERE json_extract(eventdata, \"$.user\")=? "
-                                       "AND eventtype=?",
-                                       (user.id, "birthday")) as cur:
-            async for event in cur:
-                await scheduler.canceltask(event[0])
-        # insert birthday into db
+        # the hourly birthday sweep picks this up by month/day, no need to schedule anything
         await database.db.execute(
-            "REPLACE INTO birthdays(user,birthday) "
-            "VALUES (?,?)",
-            (user.id, birthday.timestamp()))
+            "REPLACE INTO birthdays(user,birthday,month,day,tz) "
+            "VALUES (?,?,?,?,?)",
+            (user.id, birthday.timestamp(), month, day, tz))
         await database.db.commit()
-        # calculate next birthday
-        now = datetime.datetime.now(tz=datetime.timezone(datetime.timedelta(hours=tz)))
-        thisyear = now.year
-        nextbirthday = birthday
-        while nextbirthday < now:
-            try:
-                nextbirthday = nextbirthday.replace(year=thisyear)
-            except ValueError as e:  # leap years are weird
-                logger.debug(str(e))
-            thisyear += 1
-        # schedule birthday event on next birthday
-        await scheduler.schedule(nextbirthday, "birthday",
-                                 {"user": user.id, "birthday": birthday.timestamp()})
         await ctx.reply(f"Set birthday to <t:{int(birthday.timestamp())}:f>")
 
 
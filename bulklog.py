@@ -1,6 +1,9 @@
 import asyncio
+import collections
 import datetime
+import inspect
 import io
+import json
 import re
 import typing
 
@@ -9,14 +12,348 @@ from discord.ext import commands
 
 import database
 import embedutils
+import messagestore
+import modlog
+import outbound
+from clogs import logger
+
+FLUSH_INTERVAL = 5  # seconds between sending batches to a log channel
+CHANNEL_BUDGET = 200  # max embeds waiting for one channel, anything past this is dropped and summarized
+REFRESH_DELAY = 3  # seconds to wait for pin/webhook updates to a channel to settle before refetching
+MEMBER_UPDATE_WINDOW = 5  # seconds to collect member updates of a guild for before logging them
+MEMBER_UPDATE_DETAIL_LIMIT = 5  # windows with more member updates than this are logged as one summary
+# every event type the bulk log can log, named after the listener without the on_
+EVENTS = frozenset({
+    "message_delete", "bulk_message_delete", "message_edit", "reaction_remove", "reaction_clear",
+    "guild_channel_create", "guild_channel_delete", "guild_channel_update", "guild_channel_pins_update",
+    "thread_delete", "thread_create", "thread_member_join", "thread_member_remove", "thread_update",
+    "guild_integrations_update", "webhooks_update", "member_join", "member_remove", "member_update",
+    "guild_update", "guild_role_create", "guild_role_delete", "guild_role_update", "guild_emojis_update",
+    "guild_stickers_update", "member_unban", "invite_delete", "invite_create"
+})
+
+
+class LogConfig:
+    __slots__ = ("channel", "events", "enabled")
+
+    def __init__(self, channel: typing.Optional[int], events: typing.Optional[typing.Set[str]]):
+        self.channel = channel
+        self.events = events  # None logs every event type
+        self.enabled = channel is not None and events != set()
+
+    def wants(self, event: str) -> bool:
+        return self.enabled and (self.events is None or event in self.events)
+
+    def stores_messages(self) -> bool:
+        """if messages have to be kept in the message store to log what happens to them later"""
+        return self.wants("message_delete") or self.wants("message_edit") or self.wants("bulk_message_delete")
+
+
+configs: typing.Dict[int, LogConfig] = {}
+flushing: typing.Set[asyncio.Task] = set()  # so member update windows aren't garbage collected while they wait
+
+
+async def get_config(guildid: int) -> LogConfig:
+    """
+    get the bulk log config of a guild, only hitting the database the first time
+    :param guildid: ID of the guild
+    :return: the config
+    """
+    config = configs.get(guildid)
+    if config is None:
+        async with database.db.execute("SELECT bulk_log_channel, bulk_log_events FROM server_config WHERE guild=?",
+                                       (guildid,)) as cur:
+            row = await cur.fetchone()
+        channel, events = row if row else (None, None)
+        config = configs[guildid] = LogConfig(channel, None if events is None else set(json.loads(events)))
+    return config
+
+
+def invalidate_config(guildid: int):
+    """call after changing bulk_log_channel or bulk_log_events of a guild"""
+    configs.pop(guildid, None)
+
+
+class LogEntry:
+    __slots__ = ("action", "embed", "files", "length")
+
+    def __init__(self, action: str, embed: discord.Embed, files: typing.List[discord.File]):
+        self.action = action
+        self.embed = embed
+        self.files = files
+        self.length = len(embed)
+
+
+class LogQueue:
+    """
+    collects bulk log embeds per channel and sends them in batches of up to 10 embeds per message
+    """
+
+    def __init__(self):
+        self.queues: typing.Dict[int, typing.Deque[LogEntry]] = {}
+        self.dropped: typing.Dict[int, typing.Counter[str]] = {}  # actions dropped per channel
+        self.full: typing.Dict[int, asyncio.Event] = {}
+        self.workers: typing.Dict[int, asyncio.Task] = {}
+
+    def put(self, channelid: int, action: str, embeds: typing.List[discord.Embed],
+            files: typing.List[discord.File]):
+        """
+        queue a log entry
+        :param channelid: ID of the bulk log channel
+        :param action: name of the action, used to summarize entries dropped when a server logs too much
+        :param embeds: embeds of the entry, each must be at most 6000 chars
+        :param files: files to attach to the entry
+        """
+        queue = self.queues.setdefault(channelid, collections.deque())
+        if len(queue) + len(embeds) > CHANNEL_BUDGET:
+            # too much spam to keep up with, just count it for the summary
+            self.dropped.setdefault(channelid, collections.Counter())[action] += 1
+            for f in files:
+                f.close()
+        else:
+            for i, embed in enumerate(embeds):
+                queue.append(LogEntry(action, embed, files if i == 0 else []))
+        if channelid not in self.workers:
+            self.full[channelid] = asyncio.Event()
+            self.workers[channelid] = asyncio.create_task(self.worker(channelid))
+        if len(queue) >= 10:
+            self.full[channelid].set()
+
+    def next_batch(self, channelid: int) -> typing.List[LogEntry]:
+        # as many entries as fit in one message: 10 embeds, 6000 chars total and 10 files
+        queue = self.queues[channelid]
+        batch = []
+        files = 0
+        length = 0
+        while queue:
+            entry = queue[0]
+            if batch and (len(batch) == 10 or length + entry.length > 6000 or files + len(entry.files) > 10):
+                break
+            queue.popleft()
+            batch.append(entry)
+            files += len(entry.files)
+            length += entry.length
+        return batch
+
+    def dropped_summary(self, channelid: int) -> typing.Optional[discord.Embed]:
+        dropped = self.dropped.pop(channelid, None)
+        if not dropped:
+            return None
+        embed = discord.Embed(title="Server Log", color=discord.Color.dark_grey(),
+                              description=f"Too many events to log, skipped {sum(dropped.values())} entries.",
+                              timestamp=datetime.datetime.now(tz=datetime.timezone.utc))
+        embedutils.add_long_field(embed, "Skipped", "\n".join(f"{action}: {count}"
+                                                               for action, count in dropped.most_common()))
+        return embed
+
+    async def worker(self, channelid: int):
+        try:
+            while self.queues.get(channelid) or self.dropped.get(channelid):
+                try:
+                    await asyncio.wait_for(self.full[channelid].wait(), FLUSH_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                self.full[channelid].clear()
+                channel = await modlog.get_channel(channelid)
+                while self.queues.get(channelid):
+                    batch = self.next_batch(channelid)
+                    if await outbound.send(channel, embeds=[entry.embed for entry in batch],
+                                           files=[f for entry in batch for f in entry.files],
+                                           priority=outbound.Priority.LOG) is None:
+                        # dropped by outbound for being too far behind, say so in the summary instead
+                        dropped = self.dropped.setdefault(channelid, collections.Counter())
+                        for entry in batch:
+                            dropped[entry.action] += 1
+                counts = self.dropped.get(channelid)
+                if summary := self.dropped_summary(channelid):
+                    if await outbound.send(channel, embed=summary, priority=outbound.Priority.LOG) is None:
+                        # still too far behind, try the summary again next time around
+                        self.dropped.setdefault(channelid, collections.Counter()).update(counts)
+        except Exception as e:
+            logger.error(e, exc_info=(type(e), e, e.__traceback__))
+            self.queues.pop(channelid, None)
+            self.dropped.pop(channelid, None)
+        finally:
+            del self.workers[channelid]
+            del self.full[channelid]
+
+
+class SnapshotCache:
+    """
+    last known state of something per channel (pins, webhooks) so updates can be logged as a diff.
+    bursts of update events for a channel are coalesced into one diff after REFRESH_DELAY.
+    """
+
+    def __init__(self, fetch: typing.Callable[[typing.Any], typing.Awaitable[typing.Dict[int, str]]],
+                 live: bool = False):
+        """
+        :param fetch: gets the current state of a channel as a dict of ID -> description
+        :param live: if the state is kept up to date with apply() from events, it's then only fetched to seed a
+        channel's snapshot instead of after every burst
+        """
+        self.fetch = fetch
+        self.live = live
+        self.snapshots: typing.Dict[int, typing.Dict[int, str]] = {}
+        self.logged: typing.Dict[int, typing.Dict[int, str]] = {}  # live only: state as of the last diff
+        self.pending: typing.Set[int] = set()
+
+    async def refresh(self, channel) -> typing.Optional[typing.Tuple[typing.Optional[typing.Dict[int, str]],
+                                                                     typing.Dict[int, str]]]:
+        """
+        get what changed in a channel since the last refresh
+        :param channel: the channel
+        :return: (old state or None if there wasn't one, new state), or None if another event is already refreshing it
+        or a live snapshot was only just seeded
+        """
+        if channel.id in self.pending:
+            return None
+        self.pending.add(channel.id)
+        try:
+            await asyncio.sleep(REFRESH_DELAY)
+        finally:
+            self.pending.discard(channel.id)
+        if self.live:
+            if channel.id not in self.snapshots:
+                # the change that brought us here is already in the fetched state, there's nothing to diff it with
+                self.snapshots[channel.id] = await self.fetch(channel)
+                self.logged[channel.id] = dict(self.snapshots[channel.id])
+                return None
+            before = self.logged[channel.id]
+            current = self.logged[channel.id] = dict(self.snapshots[channel.id])
+            return before, current
+        current = await self.fetch(channel)
+        before = self.snapshots.get(channel.id)
+        self.snapshots[channel.id] = current
+        return before, current
+
+    def apply(self, channelid: int, key: int, value: typing.Optional[str]):
+        """
+        update a live snapshot from an event, channels without a snapshot are skipped since seeding fetches it anyway
+        :param channelid: ID of the channel
+        :param key: ID of what changed
+        :param value: its new description, or None if it was removed
+        """
+        current = self.snapshots.get(channelid)
+        if current is None:
+            return
+        if value is None:
+            current.pop(key, None)
+        else:
+            current[key] = value
+
+    def evict(self, channelid: int):
+        self.snapshots.pop(channelid, None)
+        self.logged.pop(channelid, None)
+
+
+def diff_fields(before: typing.Dict[int, str], after: typing.Dict[int, str]) -> typing.Dict[str, str]:
+    fields = {
+        "Added": "\n".join(v for k, v in after.items() if k not in before) or "None",
+        "Removed": "\n".join(v for k, v in before.items() if k not in after) or "None"
+    }
+    if changed := [f"{before[k]} -> {v}" for k, v in after.items() if k in before and before[k] != v]:
+        fields["Changed"] = "\n".join(changed)
+    return fields
+
+
+async def fetch_pins(channel: typing.Union[discord.TextChannel, discord.Thread]) -> typing.Dict[int, str]:
+    return {pin.id: f"{pin.jump_url} by {pin.author.mention}" for pin in await channel.pins()}
+
+
+async def fetch_webhooks(channel: discord.TextChannel) -> typing.Dict[int, str]:
+    return {webhook.id: f"{webhook.name} ({webhook.id})" for webhook in await channel.webhooks()}
+
+
+def bulk_delete_transcript(rows: typing.List[tuple]) -> io.BytesIO:
+    """
+    write bulk deleted messages as JSON lines, ran in a thread so big purges don't block the event loop
+    :param rows: (id, author id, author, timestamp, content, links) tuples
+    :return: buffer containing the transcript
+    """
+    buf = io.BytesIO()
+    for msgid, authorid, author, timestamp, content, links in rows:
+        buf.write(json.dumps({"id": msgid, "author_id": authorid, "author": author, "timestamp": timestamp,
+                              "content": content, "attachments": links}, ensure_ascii=False).encode("utf8"))
+        buf.write(b"\n")
+    buf.seek(0)
+    return buf
+
+
+class MemberDiff:
+    __slots__ = ("member", "added", "removed", "nickbefore", "nickafter")
+
+    def __init__(self, before: discord.Member, after: discord.Member):
+        self.member = after
+        beforeroles = set(before.roles)
+        afterroles = set(after.roles)
+        self.added = [role for role in after.roles if role not in beforeroles]
+        self.removed = [role for role in before.roles if role not in afterroles]
+        self.nickbefore = before.nick
+        self.nickafter = after.nick
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.nickbefore != self.nickafter)
+
+    def fields(self) -> dict:
+        fields = {
+            "Action": "Member Update",
+            "User": f"{self.member.mention} (@{self.member})"
+        }
+        if self.nickbefore != self.nickafter:
+            fields["Nickname Before"] = self.nickbefore or "No Nickname"
+            fields["Nickname After"] = self.nickafter or "No Nickname"
+        if self.added:
+            fields["Roles Added"] = ", ".join(role.mention for role in self.added)
+        if self.removed:
+            fields["Roles Removed"] = ", ".join(role.mention for role in self.removed)
+        fields["User ID"] = str(self.member.id)
+        return fields
+
+
+def member_update_transcript(diffs: typing.List[MemberDiff]) -> io.BytesIO:
+    """
+    write member updates as JSON lines, ran in a thread since a mass role change can be thousands of members
+    :param diffs: the member updates
+    :return: buffer containing the transcript
+    """
+    buf = io.BytesIO()
+    for diff in diffs:
+        buf.write(json.dumps({"id": diff.member.id, "user": str(diff.member),
+                              "roles_added": [role.name for role in diff.added],
+                              "roles_removed": [role.name for role in diff.removed],
+                              "nick_before": diff.nickbefore, "nick_after": diff.nickafter},
+                             ensure_ascii=False).encode("utf8"))
+        buf.write(b"\n")
+    buf.seek(0)
+    return buf
 
 
 class BulkLog(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-
-    async def logdict(self, fields: dict, guildid: int, embed: typing.Optional[discord.Embed] = None,
-                      color: discord.Colour = discord.Color.blurple()):
+        self.queue = LogQueue()
+        self.pins = SnapshotCache(fetch_pins, live=True)
+        self.webhooks = SnapshotCache(fetch_webhooks)
+        self.memberupdates: typing.Dict[int, typing.List[MemberDiff]] = {}  # guild ID -> updates in this window
+
+    async def logdict(self, event: str, guildid: int,
+                      fields: typing.Callable[[], typing.Union[dict, typing.Awaitable[dict]]],
+                      embed: typing.Optional[discord.Embed] = None, color: discord.Colour = discord.Color.blurple()):
+        """
+        log an event to the bulk log channel, if the guild logs that event
+        :param event: event type, one of EVENTS
+        :param guildid: ID of guild
+        :param fields: returns (or is a coroutine function returning) the fields to log,
+        only called if the event is actually logged so expensive fields cost nothing for everyone else.
+        :param embed: base embed, for actions that want to modify it
+        :param color: color of the embed
+        """
+        config = await get_config(guildid)
+        if not config.wants(event):
+            return
+        fields = fields()
+        if inspect.isawaitable(fields):
+            fields = await fields
         # most actions will work fine with the simple dict format but some might want to modify
         # the embed, easiest way is to allow them to pass their own embed
         if embed is None:
@@ -32,26 +369,31 @@ class BulkLog(commands.Cog):
                 fname = pattern.sub('', k) + ".txt"
                 files.append(discord.File(io.BytesIO(v.encode("utf8")), fname))
                 embed.add_field(name=k, value=f"see attached file `{fname}`")
-        await self.log(embed, guildid, files)
+        self.log(config.channel, embed, files, fields.get("Action", "Unknown"))
 
-    async def log(self, embed: discord.Embed, guildid: int, files: typing.Optional[typing.List[discord.File]] = None):
+    def log(self, channelid: int, embed: discord.Embed, files: typing.Optional[typing.List[discord.File]] = None,
+            action: str = "Unknown"):
         """
-        log generated embed to server bulk log channel
-        :param guildid: ID of guild
-        :param embed: embed object, passed through embedutils.split_embed() to .send()
-        :param files: list of files, passed straight to .send()
+        queue generated embed to be sent to the server bulk log channel
+        :param channelid: ID of the bulk log channel
+        :param embed: embed object, passed through embedutils.split_embed()
+        :param files: list of files to attach
+        :param action: name of the action, used to summarize entries dropped when a server logs too much
         """
-        async with database.db.execute("SELECT bulk_log_channel FROM server_config WHERE guild=?", (guildid,)) as cur:
-            modlogchannel = await cur.fetchone()
-        if modlogchannel is None or modlogchannel[0] is None:
+        self.queue.put(channelid, action, embedutils.split_embed(embed), files or [])
+
+    @commands.Cog.listener()
+    async def on_message(self, msg: discord.Message):
+        # remember messages compactly so deletes and edits can be logged after discord.py forgets them
+        if msg.guild is None:
             return
-        modlogchannel = modlogchannel[0]
-        channel = await self.bot.fetch_channel(modlogchannel)
-        await channel.send(embeds=embedutils.split_embed(embed), files=files)
+        config = await get_config(msg.guild.id)
+        if config.stores_messages():
+            messagestore.store.add(msg)
 
     @commands.Cog.listener()
     async def on_message_delete(self, msg: discord.Message):
-        await self.logdict({
+        await self.logdict("message_delete", msg.guild.id, lambda: {
             "Action": "Message Delete",
             "Channel": f"{msg.channel.mention} (#{msg.channel})",
             "Author": f"{msg.author.mention} (@{msg.author})",
@@ -61,20 +403,81 @@ class BulkLog(commands.Cog):
                      or "No Embeds or Attachments",
             "Timestamp": f"<t:{int(msg.created_at.timestamp())}:F>",
             "Message ID": str(msg.id)
-        }, msg.guild.id, color=discord.Colour.red())
+        }, color=discord.Colour.red())
 
     @commands.Cog.listener()
-    async def on_bulk_message_delete(self, msgs: typing.List[discord.Message]):
-        await self.logdict({
+    async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
+        # on_message_delete handles messages still in discord.py's cache, this covers the rest from the message store
+        if payload.guild_id is None:
+            return
+        config = await get_config(payload.guild_id)
+        if not config.stores_messages():
+            return
+        stored = await messagestore.store.remove(payload.guild_id, [payload.message_id])
+        if payload.cached_message is not None or not stored or not config.wants("message_delete"):
+            return
+        msg = stored[0]
+        await self.logdict("message_delete", payload.guild_id, lambda: {
+            "Action": "Message Delete",
+            "Channel": f"<#{msg.channel}>",
+            "Author": f"<@{msg.author}>",
+            "Content": msg.content,
+            "Links": "\n".join(msg.links) or "No Embeds or Attachments",
+            "Timestamp": f"<t:{int(msg.created_at.timestamp())}:F>",
+            "Message ID": str(msg.id)
+        }, color=discord.Colour.red())
+
+    async def log_bulk_delete(self, logchannel: int, channelid: int, channeltext: str, rows: typing.List[tuple]):
+        """
+        log deleted messages as one summary plus a transcript file instead of an embed for every message
+        :param logchannel: ID of the bulk log channel
+        :param channelid: ID of the channel the messages were deleted from
+        :param channeltext: how to show that channel
+        :param rows: the messages, see bulk_delete_transcript()
+        """
+        transcript = await asyncio.to_thread(bulk_delete_transcript, rows)
+        embed = discord.Embed(title="Server Log", color=discord.Colour.red(),
+                              timestamp=datetime.datetime.now(tz=datetime.timezone.utc))
+        for k, v in {
             "Action": "Bulk Message Delete",
-            "Channel": f"{msgs[0].channel.mention} (#{msgs[0].channel})",
-            "Number of Messages Deleted": str(len(msgs))
-        }, msgs[0].guild.id, color=discord.Colour.red())
-        await asyncio.wait([self.on_message_delete(msg) for msg in msgs])
+            "Channel": channeltext,
+            "Number of Messages Deleted": str(len(rows)),
+            "Authors": ", ".join(f"<@{author}>" for author in dict.fromkeys(row[1] for row in rows)),
+            "Transcript": f"see attached file `deleted-messages-{channelid}.jsonl`"
+        }.items():
+            embedutils.add_long_field(embed, k, v)
+        self.log(logchannel, embed, [discord.File(transcript, f"deleted-messages-{channelid}.jsonl")],
+                 "Bulk Message Delete")
+
+    @commands.Cog.listener()
+    async def on_bulk_message_delete(self, msgs: typing.List[discord.Message]):
+        config = await get_config(msgs[0].guild.id)
+        if not config.wants("bulk_message_delete"):
+            return
+        rows = [(msg.id, msg.author.id, str(msg.author), msg.created_at.isoformat(), msg.system_content,
+                 [att.url for att in msg.attachments] + [emb.url for emb in msg.embeds if emb.url is not None])
+                for msg in sorted(msgs, key=lambda m: m.id)]
+        await self.log_bulk_delete(config.channel, msgs[0].channel.id,
+                                   f"{msgs[0].channel.mention} (#{msgs[0].channel})", rows)
+
+    @commands.Cog.listener()
+    async def on_raw_bulk_message_delete(self, payload: discord.RawBulkMessageDeleteEvent):
+        # on_bulk_message_delete handles messages still in discord.py's cache, this covers the rest from the store
+        if payload.guild_id is None:
+            return
+        config = await get_config(payload.guild_id)
+        if not config.stores_messages():
+            return
+        stored = await messagestore.store.remove(payload.guild_id, payload.message_ids)
+        cached = {msg.id for msg in payload.cached_messages}
+        rows = [(msg.id, msg.author, None, msg.created_at.isoformat(), msg.content, msg.links)
+                for msg in stored if msg.id not in cached]
+        if rows and config.wants("bulk_message_delete"):
+            await self.log_bulk_delete(config.channel, payload.channel_id, f"<#{payload.channel_id}>", rows)
 
     @commands.Cog.listener()
     async def on_message_edit(self, before: discord.Message, after: discord.Message):
-        await self.logdict({
+        await self.logdict("message_edit", after.guild.id, lambda: {
             "Action": "Message Edit",
             "Channel": f"{after.channel.mention} (#{after.channel})",
             "Author": f"{after.author.mention} (@{after.author})",
@@ -82,11 +485,39 @@ class BulkLog(commands.Cog):
             "Content After": after.system_content,
             "Message ID": str(after.id),
             "Message Jump URL": after.jump_url
-        }, after.guild.id, color=discord.Colour.yellow())
+        }, color=discord.Colour.yellow())
+
+    @commands.Cog.listener()
+    async def on_raw_message_edit(self, payload: discord.RawMessageUpdateEvent):
+        if payload.guild_id is not None and "pinned" in payload.data:
+            # (un)pinning a message edits it, keeps pin snapshots current without fetching every pin again
+            author = payload.data.get("author", {}).get("id")
+            self.pins.apply(payload.channel_id, payload.message_id,
+                            f"https://discord.com/channels/{payload.guild_id}/{payload.channel_id}/"
+                            f"{payload.message_id} by <@{author}>" if payload.data["pinned"] else None)
+        # keep the message store up to date, and log edits of messages that are only in the store
+        if payload.guild_id is None or "content" not in payload.data:
+            return
+        config = await get_config(payload.guild_id)
+        if not config.stores_messages():
+            return
+        before = await messagestore.store.edit(payload.guild_id, payload.message_id, payload.data["content"])
+        if payload.cached_message is not None or before is None:
+            return
+        await self.logdict("message_edit", payload.guild_id, lambda: {
+            "Action": "Message Edit",
+            "Channel": f"<#{payload.channel_id}>",
+            "Author": f"<@{before.author}>",
+            "Content Before": before.content,
+            "Content After": payload.data["content"],
+            "Message ID": str(payload.message_id),
+            "Message Jump URL": f"https://discord.com/channels/{payload.guild_id}/{payload.channel_id}/"
+                                f"{payload.message_id}"
+        }, color=discord.Colour.yellow())
 
     @commands.Cog.listener()
     async def on_reaction_remove(self, reaction: discord.Reaction, user: typing.Union[discord.Member, discord.User]):
-        await self.logdict({
+        await self.logdict("reaction_remove", reaction.message.guild.id, lambda: {
             "Action": "Reaction Remove",
             "Channel": f"{reaction.message.channel.mention} (#{reaction.message.channel})",
             "Author": f"{reaction.message.author.mention} (@{reaction.message.author})",
@@ -94,242 +525,300 @@ class BulkLog(commands.Cog):
             "Reaction Removed": str(reaction.emoji),
             "Message ID": str(reaction.message.id),
             "Message Jump URL": reaction.message.jump_url
-        }, reaction.message.guild.id, color=discord.Colour.orange())
+        }, color=discord.Colour.orange())
 
     @commands.Cog.listener()
     async def on_reaction_clear(self, msg: discord.Message, reactions: typing.List[discord.Reaction]):
-        await self.logdict({
+        await self.logdict("reaction_clear", msg.guild.id, lambda: {
             "Action": "Reaction Clear",
             "Channel": f"{msg.channel.mention} (#{msg.channel})",
             "Author": f"{msg.author.mention} (@{msg.author})",
             "Reactions Cleared": " ".join([f"{reaction.emoji}x{reaction.count}" for reaction in reactions]),
             "Message ID": str(msg.id),
             "Message Jump URL": msg.jump_url
-        }, msg.guild.id, color=discord.Colour.orange())
+        }, color=discord.Colour.orange())
 
     @commands.Cog.listener()
     async def on_guild_channel_create(self, channel: discord.abc.GuildChannel):
-        await self.logdict({
+        await self.logdict("guild_channel_create", channel.guild.id, lambda: {
             "Action": "Channel Create",
             "Channel": f"{channel.mention} (#{channel})",
             "Category": channel.category.name if channel.category else "No Category",
             "Channel ID": str(channel.id)
-        }, channel.guild.id, color=discord.Colour.green())
+        }, color=discord.Colour.green())
 
     @commands.Cog.listener()
     async def on_guild_channel_delete(self, channel: discord.abc.GuildChannel):
-        await self.logdict({
+        self.pins.evict(channel.id)
+        self.webhooks.evict(channel.id)
+        await self.logdict("guild_channel_delete", channel.guild.id, lambda: {
             "Action": "Channel Delete",
             "Channel": f"{channel.mention} (#{channel})",
             "Category": channel.category.name if channel.category else "No Category",
             "Channel ID": str(channel.id)
-        }, channel.guild.id, color=discord.Colour.red())
+        }, color=discord.Colour.red())
 
     @commands.Cog.listener()
     async def on_guild_channel_update(self, before: discord.abc.GuildChannel, after: discord.abc.GuildChannel, ):
-        await self.logdict({
+        await self.logdict("guild_channel_update", after.guild.id, lambda: {
             "Action": "Channel Update",
             "Before": f"{before.mention} (#{before}) "
                       f"in category {before.category.name if before.category else 'No Category'}",
             "After": f"{after.mention} (#{after}) "
                      f"in category {after.category.name if after.category else 'No Category'}",
             "Channel ID": str(after.id)
-        }, after.guild.id, color=discord.Colour.yellow())
+        }, color=discord.Colour.yellow())
 
     @commands.Cog.listener()
     async def on_guild_channel_pins_update(self, channel: typing.Union[discord.TextChannel, discord.Thread],
                                            last_pin: typing.Optional[datetime.datetime]):
-        pins = await channel.pins()
-        await self.logdict({
+        if not (await get_config(channel.guild.id)).wants("guild_channel_pins_update"):
+            return
+        refreshed = await self.pins.refresh(channel)
+        if refreshed is None:
+            return
+        before, after = refreshed
+        if before == after:
+            return
+        await self.logdict("guild_channel_pins_update", channel.guild.id, lambda: {
             "Action": "Channel Pins Update",
             "Channel": f"{channel.mention} (#{channel})",
             "Category": channel.category.name if channel.category else "No Category",
             "Channel ID": str(channel.id),
-            "# of Pins": len(pins),
-            "Pinned messages": ", ".join([str(pin.id) for pin in pins]) or "No pins",
+            "# of Pins": len(after),
+            # first update we've seen for this channel, nothing to diff against
+            **({"Pinned messages": "\n".join(after.values()) or "No pins"} if before is None
+               else diff_fields(before, after)),
             "Time of last pin": f"<t:{int(last_pin.timestamp())}:F>" if last_pin else "unknown"
-        }, channel.guild.id, color=discord.Colour.yellow())
+        }, color=discord.Colour.yellow())
 
     @commands.Cog.listener()
     async def on_thread_delete(self, thread: discord.Thread):
-        await self.logdict({
+        self.pins.evict(thread.id)
+        await self.logdict("thread_delete", thread.guild.id, lambda: {
             "Action": "Thread Delete",
             "Owner": f"{thread.owner.mention} (@{thread.owner})",
             "Thread": f"{thread.mention} (#{thread})",
             "Parent Channel": f"{thread.parent.mention} (#{thread.parent})",
             "Thread ID": str(thread.id)
-        }, thread.guild.id, color=discord.Colour.red())
+        }, color=discord.Colour.red())
 
     @commands.Cog.listener()
     async def on_thread_create(self, thread: discord.Thread):
-        await self.logdict({
+        await self.logdict("thread_create", thread.guild.id, lambda: {
             "Action": "Thread Create",
             "Owner": f"{thread.owner.mention} (@{thread.owner})",
             "Thread": f"{thread.mention} (#{thread})",
             "Parent Channel": f"{thread.parent.mention} (#{thread.parent})",
             "Thread ID": str(thread.id)
-        }, thread.guild.id, color=discord.Colour.green())
+        }, color=discord.Colour.green())
 
     @commands.Cog.listener()
     async def on_thread_member_join(self, member: discord.ThreadMember):
         truemember = member.thread.guild.get_member(member.id)
-        await self.logdict({
+        await self.logdict("thread_member_join", member.thread.guild.id, lambda: {
             "Action": "Thread Join",
             "User": f"{truemember.mention} (@{truemember})",
             "Thread": f"{member.thread.mention} (#{member.thread})",
             "Parent Channel": f"{member.thread.parent.mention} (#{member.thread.parent})",
             "Thread ID": str(member.thread.id)
-        }, member.thread.guild.id, color=discord.Colour.yellow())
+        }, color=discord.Colour.yellow())
 
     @commands.Cog.listener()
     async def on_thread_member_remove(self, member: discord.ThreadMember):
         truemember = member.thread.guild.get_member(member.id)
-        await self.logdict({
+        await self.logdict("thread_member_remove", member.thread.guild.id, lambda: {
             "Action": "Thread Leave",
             "User": f"{truemember.mention} (@{truemember})",
             "Thread": f"{member.thread.mention} (#{member.thread})",
             "Parent Channel": f"{member.thread.parent.mention} (#{member.thread.parent})",
             "Thread ID": str(member.thread.id)
-        }, member.thread.guild.id, color=discord.Colour.yellow())
+        }, color=discord.Colour.yellow())
 
     @commands.Cog.listener()
     async def on_thread_update(self, before: discord.Thread, after: discord.Thread):
-        await self.logdict({
+        await self.logdict("thread_update", after.guild.id, lambda: {
             "Action": "Thread Update",
             "Owner": f"{after.owner.mention} (@{after.owner})",
             "Thread": f"{after.mention} (#{before} -> #{after})",
             "Parent Channel": f"{after.parent.mention} (#{after.parent})",
             "Thread ID": str(after.id)
-        }, after.guild.id, color=discord.Colour.yellow())
+        }, color=discord.Colour.yellow())
 
     @commands.Cog.listener()
     async def on_guild_integrations_update(self, guild: discord.Guild):
-        await self.logdict({
+        await self.logdict("guild_integrations_update", guild.id, lambda: {
             "Action": "Integration Update",
-        }, guild.id, color=discord.Colour.yellow())
+        }, color=discord.Colour.yellow())
 
     @commands.Cog.listener()
     async def on_webhooks_update(self, channel: discord.TextChannel):
-        await self.logdict({
+        if not (await get_config(channel.guild.id)).wants("webhooks_update"):
+            return
+        refreshed = await self.webhooks.refresh(channel)
+        if refreshed is None:
+            return
+        before, after = refreshed
+        if before == after:
+            return
+        await self.logdict("webhooks_update", channel.guild.id, lambda: {
             "Action": "Webhooks Update",
             "Channel": f"{channel.mention} (#{channel})",
-            "Webhooks": "\n".join([f"{webhook.name} ({webhook.id}" for webhook in await channel.webhooks()])
-        }, channel.guild.id, color=discord.Colour.yellow())
+            **({"Webhooks": "\n".join(after.values()) or "No webhooks"} if before is None
+               else diff_fields(before, after))
+        }, color=discord.Colour.yellow())
 
     @commands.Cog.listener()
     async def on_member_join(self, member: discord.Member):
-        await self.logdict({
+        await self.logdict("member_join", member.guild.id, lambda: {
             "Action": "Member Join",
             "User": f"{member.mention} (@{member})",
             "User ID": str(member.id)
-        }, member.guild.id, color=discord.Colour.green())
+        }, color=discord.Colour.green())
 
     @commands.Cog.listener()
     async def on_member_remove(self, member: discord.Member):
-        await self.logdict({
+        await self.logdict("member_remove", member.guild.id, lambda: {
             "Action": "Member Left",
             "User": f"{member.mention} (@{member})",
             "Nickname": member.nick or "No Nickname",
             "Roles": ", ".join([role.mention for role in member.roles]) or "None",
             "User ID": str(member.id)
-        }, member.guild.id, color=discord.Colour.red())
+        }, color=discord.Colour.red())
 
     @commands.Cog.listener()
     async def on_member_update(self, before: discord.Member, after: discord.Member):
-        await self.logdict({
-            "Action": "Member Update",
-            "User": f"{after.mention} (@{after})",
-            "Nickname Before": before.nick or "No Nickname",
-            "Roles Before": ", ".join([role.mention for role in before.roles]) or "None",
-            "Nickname After": after.nick or "No Nickname",
-            "Roles After": ", ".join([role.mention for role in after.roles]) or "None",
-            "User ID": str(after.id)
-        }, after.guild.id, color=discord.Colour.yellow())
+        # mass role changes would log one message per member, so updates are collected per guild and summarized
+        if not (await get_config(after.guild.id)).wants("member_update"):
+            return
+        diff = MemberDiff(before, after)
+        if not diff:  # something we don't log changed
+            return
+        if after.guild.id not in self.memberupdates:
+            self.memberupdates[after.guild.id] = []
+            task = asyncio.create_task(self.log_member_updates(after.guild.id))
+            flushing.add(task)
+            task.add_done_callback(flushing.discard)
+        self.memberupdates[after.guild.id].append(diff)
+
+    async def log_member_updates(self, guildid: int):
+        await asyncio.sleep(MEMBER_UPDATE_WINDOW)
+        diffs = self.memberupdates.pop(guildid)
+        try:
+            if len(diffs) <= MEMBER_UPDATE_DETAIL_LIMIT:
+                for diff in diffs:
+                    await self.logdict("member_update", guildid, diff.fields, color=discord.Colour.yellow())
+                return
+            config = await get_config(guildid)
+            if not config.wants("member_update"):
+                return
+            added = collections.Counter(role for diff in diffs for role in diff.added)
+            removed = collections.Counter(role for diff in diffs for role in diff.removed)
+            nicks = sum(diff.nickbefore != diff.nickafter for diff in diffs)
+            transcript = await asyncio.to_thread(member_update_transcript, diffs)
+            embed = discord.Embed(title="Server Log", color=discord.Colour.yellow(),
+                                  timestamp=datetime.datetime.now(tz=datetime.timezone.utc))
+            fields = {
+                "Action": "Member Update",
+                "Members Updated": f"{len(diffs):,}"
+            }
+            if added:
+                fields["Roles Added"] = "\n".join(f"{role.mention} added to {count:,} member{'' if count == 1 else 's'}"
+                                                  for role, count in added.most_common())
+            if removed:
+                fields["Roles Removed"] = "\n".join(f"{role.mention} removed from {count:,} "
+                                                    f"member{'' if count == 1 else 's'}"
+                                                    for role, count in removed.most_common())
+            if nicks:
+                fields["Nicknames Changed"] = f"{nicks:,}"
+            fields["Details"] = f"see attached file `member-updates-{guildid}.jsonl`"
+            for k, v in fields.items():
+                embedutils.add_long_field(embed, k, v)
+            self.log(config.channel, embed, [discord.File(transcript, f"member-updates-{guildid}.jsonl")],
+                     "Member Update")
+        except Exception as e:
+            logger.error(e, exc_info=(type(e), e, e.__traceback__))
 
     @commands.Cog.listener()
     async def on_guild_update(self, before: discord.Guild, after: discord.Guild):
-        await self.logdict({
+        await self.logdict("guild_update", after.id, lambda: {
             "Action": "Guild Update",
             "Guild ID": str(after.id)
-        }, after.id, color=discord.Colour.yellow())
+        }, color=discord.Colour.yellow())
 
     @commands.Cog.listener()
     async def on_guild_role_create(self, role: discord.Role):
-        await self.logdict({
+        await self.logdict("guild_role_create", role.guild.id, lambda: {
             "Action": "Role Create",
             "Role": f"{role.mention} ({role.name})",
             "Role ID": str(role.id)
-        }, role.guild.id, color=discord.Colour.green())
+        }, color=discord.Colour.green())
 
     @commands.Cog.listener()
     async def on_guild_role_delete(self, role: discord.Role):
-        await self.logdict({
+        await self.logdict("guild_role_delete", role.guild.id, lambda: {
             "Action": "Role Delete",
             "Role": f"{role.mention} ({role.name})",
             "Role ID": str(role.id)
-        }, role.guild.id, color=discord.Colour.red())
+        }, color=discord.Colour.red())
 
     @commands.Cog.listener()
     async def on_guild_role_update(self, before: discord.Role, after: discord.Role):
-        await self.logdict({
+        await self.logdict("guild_role_update", after.guild.id, lambda: {
             "Action": "Role Update",
             "Role": f"{after.mention} ({before.name} -> {after.name})",
             "Role ID": str(after.id)
-        }, after.guild.id, color=discord.Colour.yellow())
+        }, color=discord.Colour.yellow())
 
     @commands.Cog.listener()
     async def on_guild_emojis_update(self, guild: discord.Guild, before: typing.Sequence[discord.Emoji],
                                      after: typing.Sequence[discord.Emoji]):
-        deleted = list(set(before) - set(after))
-        added = list(set(after) - set(before))
-        await self.logdict({
+        await self.logdict("guild_emojis_update", guild.id, lambda: {
             "Action": "Emoji Update",
-            "Emojis Removed": " ".join([str(e) for e in deleted]) or "None",
-            "Emojis Added": " ".join([str(e) for e in added]) or "None",
-        }, guild.id, color=discord.Colour.yellow())
+            "Emojis Removed": " ".join([str(e) for e in set(before) - set(after)]) or "None",
+            "Emojis Added": " ".join([str(e) for e in set(after) - set(before)]) or "None",
+        }, color=discord.Colour.yellow())
 
     @commands.Cog.listener()
     async def on_guild_stickers_update(self, guild: discord.Guild, before: typing.Sequence[discord.GuildSticker],
                                        after: typing.Sequence[discord.GuildSticker]):
-        deleted = list(set(before) - set(after))
-        added = list(set(after) - set(before))
-        await self.logdict({
+        await self.logdict("guild_stickers_update", guild.id, lambda: {
             "Action": "Sticker Update",
-            "Stickers Removed": ", ".join([f"`{e}`" for e in deleted]) or "None",
-            "Stickers Added": ", ".join([f"`{e}`" for e in added]) or "None",
-        }, guild.id, color=discord.Colour.yellow())
+            "Stickers Removed": ", ".join([f"`{e}`" for e in set(before) - set(after)]) or "None",
+            "Stickers Added": ", ".join([f"`{e}`" for e in set(after) - set(before)]) or "None",
+        }, color=discord.Colour.yellow())
 
     @commands.Cog.listener()
     async def on_member_unban(self, guild: discord.Guild, member: discord.User):
-        await self.logdict({
+        await self.logdict("member_unban", guild.id, lambda: {
             "Action": "User Unban",
             "User": f"{member.mention} (@{member})",
             "User ID": str(member.id)
-        }, guild.id, color=discord.Colour.green())
+        }, color=discord.Colour.green())
 
     @commands.Cog.listener()
     async def on_invite_delete(self, invite: discord.Invite):
-        await self.logdict({
+        await self.logdict("invite_delete", invite.guild.id, lambda: {
             "Action": "Invite Delete",
             "Invite": str(invite),
             "Invite ID": str(invite.id)
-        }, invite.guild.id, color=discord.Colour.red())
+        }, color=discord.Colour.red())
 
     @commands.Cog.listener()
     async def on_invite_create(self, invite: discord.Invite):
-        await self.logdict({
+        await self.logdict("invite_create", invite.guild.id, lambda: {
             "Action": "Invite Create",
             "Invite": str(invite),
             "Invite ID": str(invite.id)
-        }, invite.guild.id, color=discord.Colour.green())
+        }, color=discord.Colour.green())
 
     # @commands.Cog.listener()
     # async def on_user_update(self, before: discord.User, after: discord.User):
-    #     await self.logdict({
+    #     await self.logdict("user_update", NONE, lambda: {
     #         "Action": "User Update",
     #         "User": f"{after.mention} (@{before} -> @{after})",
     #         "User ID": str(after.id)
-    #     }, NONE, color=discord.Colour.yellow())
+    #     }, color=discord.Colour.yellow())
 
     '''
     Steps to convert:
@@ -1,10 +1,33 @@
 import copy
-import re
 import typing
 
 import discord
 
 
+def split_value(value: str, limit: int = 1024) -> typing.List[str]:
+    """
+    split a long string into chunks, preferring to break at newlines and then spaces
+    :param value: the string
+    :param limit: max length of a chunk
+    :return: list of chunks, none longer than limit
+    """
+    chunks = []
+    start = 0
+    while len(value) - start > limit:
+        end = start + limit
+        cut = value.rfind("\n", start, end + 1)
+        if cut <= start:
+            cut = value.rfind(" ", start, end + 1)
+        if cut <= start:  # one giant word, no choice but to cut it
+            chunks.append(value[start:end])
+            start = end
+        else:  # drop the separator we split on
+            chunks.append(value[start:cut])
+            start = cut + 1
+    chunks.append(value[start:])
+    return chunks
+
+
 def add_long_field(embed: discord.Embed, name: str, value: str, inline: bool = False,
                    erroriftoolong: bool = False) -> discord.Embed:
     """
@@ -21,9 +44,10 @@ def add_long_field(embed: discord.Embed, name: str, value: str, inline: bool = F
             value = "`No Content`"
         return embed.add_field(name=name, value=value, inline=inline)
     else:
-        for i, section in enumerate(re.finditer('.{1,1024}', value, flags=re.S)):  # split every 1024 chars
-            embed.add_field(name=f"{name} `({i + 1}/{len(value) // 1024})`", value=section[0], inline=inline)
-    if len(embed) > 6000 and erroriftoolong:
+        sections = split_value(value)
+        for i, section in enumerate(sections):
+            embed.add_field(name=f"{name} `({i + 1}/{len(sections)})`", value=section or "​", inline=inline)
+    if erroriftoolong and len(embed) > 6000:
         raise Exception(f"Generated embed exceeds maximum size. ({len(embed)} > 6000)")
     return embed
 
@@ -34,20 +58,42 @@ def split_embed(embed: discord.Embed) -> typing.List[discord.Embed]:
     :param embed: the initial embed
     :return: a list of embeds, none of which should have more than 25 fields or more than 6000 chars
     """
-    out = []
-    baseembed = copy.deepcopy(embed)
-    baseembed.clear_fields()
-    if len(baseembed) > 6000:
+    base = embed.to_dict()
+    fields = base.pop("fields", [])
+    baseembed = discord.Embed.from_dict(copy.deepcopy(base))
+    baselength = len(baseembed)
+    if baselength > 6000:
         raise Exception(f"Embed without fields exceeds 6000 chars.")
-    currentembed = copy.deepcopy(baseembed)
-    for field in embed.fields:  # for every field in the embed
-        currentembed.add_field(name=field.name, value=field.value,
-                               inline=field.inline)  # add it to the "currentembed" object we are working on
-        if len(currentembed) > 6000 or len(currentembed.fields) > 25:  # if the currentembed object is too big
-            currentembed.remove_field(-1)  # remove the field
-            out.append(currentembed)  # add the embed to our output
-            currentembed = copy.deepcopy(baseembed)  # make a new embed
-            currentembed.add_field(name=field.name, value=field.value,
-                                   inline=field.inline)  # add the field to our new embed instead
-    out.append(currentembed)  # add the final embed which didnt exceed 6000 to the output
+    # keep a running total instead of asking the embed for its length after every field, which walks every field
+    out = [baseembed]
+    length = baselength
+    for field in fields:
+        fieldlength = len(field["name"]) + len(field["value"])
+        if baselength + fieldlength > 6000:  # wouldn't fit in any embed, even one of its own
+            raise Exception(f"Embed field with the rest of the embed exceeds 6000 chars. "
+                            f"({baselength + fieldlength} > 6000)")
+        # only start a new embed once the current one has something in it, an empty one doesn't make room
+        if out[-1].fields and (length + fieldlength > 6000 or len(out[-1].fields) >= 25):
+            out.append(discord.Embed.from_dict(copy.deepcopy(base)))
+            length = baselength
+        out[-1].add_field(name=field["name"], value=field["value"], inline=field.get("inline", False))
+        length += fieldlength
     return out
+
+
+def pack_embeds(embeds: typing.List[discord.Embed]) -> typing.List[typing.List[discord.Embed]]:
+    """
+    group embeds into as few messages as possible
+    :param embeds: embeds, such as the output of split_embed()
+    :return: lists of embeds, each can be sent as one message (at most 10 embeds and 6000 chars total)
+    """
+    messages = [[]]
+    length = 0
+    for embed in embeds:
+        embedlength = len(embed)
+        if messages[-1] and (len(messages[-1]) >= 10 or length + embedlength > 6000):
+            messages.append([])
+            length = 0
+        messages[-1].append(embed)
+        length += embedlength
+    return messages
@@ -5,6 +5,7 @@ from discord.ext import commands
 
 import database
 import modlog
+import outbound
 from clogs import logger
 from moderation import update_server_config, mod_only
 
@@ -43,7 +44,7 @@ class GateKeep(commands.Cog):
                 try:
                     await th.delete()
                 except discord.HTTPException:
-                    await th.send(f"User left, locking thread.")
+                    await outbound.send(th, f"User left, locking thread.", priority=outbound.Priority.MODERATION)
                     await th.remove_user(member)
                     await th.edit(archived=True, locked=True)
                 await database.db.execute("DELETE FROM members_to_verify guild=? AND member=?",
@@ -83,8 +84,8 @@ class GateKeep(commands.Cog):
                 modping = member.guild.get_role(res[1]).mention
             else:
                 modping = member.guild.owner.mention
-            await thread.send(f"{modping} {member.mention}\n{res[3]}",
-                              allowed_mentions=discord.AllowedMentions.all())
+            await outbound.send(thread, f"{modping} {member.mention}\n{res[3]}",
+                                allowed_mentions=discord.AllowedMentions.all(), priority=outbound.Priority.MODERATION)
 
     @commands.command()
     @commands.has_guild_permissions(manage_guild=True)
@@ -0,0 +1,125 @@
+import asyncio
+import csv
+import gzip
+import json
+import tempfile
+import typing
+from datetime import datetime
+
+import database
+
+BATCH_SIZE = 500  # rows read from the database and written to the file at once
+
+# table -> (SELECT ... FROM table, guild column, user columns, time column)
+# there's no ORDER BY so sqlite never has to sort the whole history, rows come out in the order of the index on the
+# guild column, which is by user and then time for warns and modlogs
+TABLES = {
+    "warnings": ("SELECT id, user, issuedby, issuedat, reason, deactivated, points FROM warnings",
+                 "server", ["user"], "issuedat"),
+    "modlog": ("SELECT id, user, moderator, text, datetime FROM modlog",
+               "guild", ["user", "moderator"], "datetime"),
+    "auto_punishment": ("SELECT warn_count, punishment_type, punishment_duration, warn_timespan "
+                        "FROM auto_punishment", "guild", [], None)
+}
+
+
+def query(table: str, guildid: int, userid: typing.Optional[int], since: typing.Optional[datetime],
+          until: typing.Optional[datetime]) -> typing.Tuple[str, tuple]:
+    select, guildcol, usercols, timecol = TABLES[table]
+    where = [f"{guildcol}=?"]
+    params = [guildid]
+    # auto-punishments apply to everyone and have no time, they're always exported whole
+    if userid is not None and usercols:
+        where.append("(" + " OR ".join(f"{col}=?" for col in usercols) + ")")
+        params += [userid] * len(usercols)
+    if since is not None and timecol:
+        where.append(f"{timecol}>=?")
+        params.append(since.timestamp())
+    if until is not None and timecol:
+        where.append(f"{timecol}<?")
+        params.append(until.timestamp())
+    return f"{select} WHERE {' AND '.join(where)}", tuple(params)
+
+
+class CSVWriter:
+    """one gzipped csv file per table"""
+
+    def __init__(self):
+        self.file = tempfile.TemporaryFile()
+        self.text = gzip.open(self.file, "wt", encoding="utf8", newline="")
+        self.writer = csv.writer(self.text)
+
+    def start(self, table: str, columns: typing.List[str]):
+        self.writer.writerow(columns)
+
+    def write(self, table: str, columns: typing.List[str], rows: typing.List[tuple]):
+        self.writer.writerows(rows)
+
+    def finish(self):
+        self.text.close()
+        self.file.seek(0)
+
+
+class JSONLWriter:
+    """every table in one gzipped file, each line is one row with a "table" key"""
+
+    def __init__(self):
+        self.file = tempfile.TemporaryFile()
+        self.text = gzip.open(self.file, "wt", encoding="utf8")
+
+    def start(self, table: str, columns: typing.List[str]):
+        pass
+
+    def write(self, table: str, columns: typing.List[str], rows: typing.List[tuple]):
+        for row in rows:
+            self.text.write(json.dumps({"table": table, **dict(zip(columns, row))}) + "\n")
+
+    def finish(self):
+        self.text.close()
+        self.file.seek(0)
+
+
+async def stream(table: str, writer: typing.Union[CSVWriter, JSONLWriter], sql: str, params: tuple):
+    async with database.db.execute(sql, params) as cur:
+        columns = [col[0] for col in cur.description]
+        writer.start(table, columns)
+        while True:
+            rows = await cur.fetchmany(BATCH_SIZE)
+            if not rows:
+                break
+            # compressing is slow enough to do off the event loop
+            await asyncio.to_thread(writer.write, table, columns, rows)
+
+
+async def export(guildid: int, file_format: str, userid: typing.Optional[int] = None,
+                 since: typing.Optional[datetime] = None, until: typing.Optional[datetime] = None) \
+        -> typing.List[typing.Tuple[typing.BinaryIO, str]]:
+    """
+    export the moderation history of a guild, rows are streamed from the database into temporary files so memory
+    use doesn't grow with the size of the history
+    :param guildid: ID of the guild
+    :param file_format: "csv" for a .csv.gz per table or "jsonl" for one .jsonl.gz
+    :param userid: only export warns and modlogs of this user, as the target or the moderator
+    :param since: only export warns and modlogs from this time onwards
+    :param until: only export warns and modlogs from before this time
+    :return: (file, filename) of every file, the caller has to close them
+    """
+    files = []
+    try:
+        if file_format == "jsonl":
+            writer = JSONLWriter()
+            files.append((writer.file, f"history-{guildid}.jsonl.gz"))
+            for table in TABLES:
+                await stream(table, writer, *query(table, guildid, userid, since, until))
+            writer.finish()
+        else:
+            for table in TABLES:
+                writer = CSVWriter()
+                files.append((writer.file, f"{table}-{guildid}.csv.gz"))
+                await stream(table, writer, *query(table, guildid, userid, since, until))
+                writer.finish()
+    except BaseException:
+        for file, _ in files:
+            file.close()
+        raise
+    return files
@@ -0,0 +1,110 @@
+import json
+import typing
+
+import discord
+import humanize
+from discord.ext import commands
+
+import database
+from timeconverter import time_converter
+
+
+class JSONConfig:
+    """
+    settings of a feature stored as a JSON object in a server_config column, NULL turns the feature off.
+    subclasses set __slots__ = tuple(DEFAULTS) and the class attributes below.
+    """
+    __slots__ = ("enabled",)
+    DEFAULTS: typing.Dict[str, typing.Any] = {}  # every setting and its value until it's changed
+    DURATIONS: typing.FrozenSet[str] = frozenset()  # settings that are times in seconds
+    FLOATS: typing.FrozenSet[str] = frozenset()  # number settings that don't have to be whole
+    ACTIONS: typing.Tuple[str, ...] = ()  # values the "action" setting can have
+
+    def __init__(self, settings: typing.Optional[dict]):
+        """
+        :param settings: the column's JSON, None if the feature is off
+        """
+        self.enabled = settings is not None
+        for key, default in self.DEFAULTS.items():
+            setattr(self, key, (settings or {}).get(key, default))
+
+    def settings(self) -> dict:
+        return {key: getattr(self, key) for key in self.DEFAULTS}
+
+    def embed(self, title: str) -> discord.Embed:
+        """
+        :param title: what the feature is called and where, "on" or "off" is added to the end
+        :return: embed showing every setting
+        """
+        embed = discord.Embed(title=f"{title}: {'on' if self.enabled else 'off'}", color=discord.Color(0xB565D9))
+        for key, val in self.settings().items():
+            if key in self.DURATIONS:
+                val = humanize.precisedelta(val) if val else "0"
+            embed.add_field(name=key, value=str(val))
+        return embed
+
+    def change(self, setting: str, value: typing.Optional[str]) -> typing.Optional[dict]:
+        """
+        work out the settings after a user changes one
+        :param setting: `on`, `off` or the name of a setting
+        :param value: what the user gave as the new value of the setting
+        :return: the new settings, None if the feature is being turned off
+        """
+        settings = self.settings()
+        if setting == "off":
+            return None
+        if setting == "on":
+            return settings
+        if setting not in self.DEFAULTS:
+            raise commands.BadArgument(f"Unknown setting `{setting}`. Settings are: {', '.join(self.DEFAULTS)}")
+        if value is None:
+            raise commands.BadArgument(f"Give a value for `{setting}`.")
+        if setting == "action":
+            if value.lower() not in self.ACTIONS:
+                raise commands.BadArgument(f"Action must be one of {', '.join(self.ACTIONS)}.")
+            settings[setting] = value.lower()
+        elif setting in self.DURATIONS:
+            settings[setting] = time_converter(value).total_seconds()
+        else:
+            try:
+                settings[setting] = float(value) if setting in self.FLOATS else int(value)
+            except ValueError:
+                raise commands.BadArgument(f"{value} is not a number!")
+        self.validate(setting, settings[setting])
+        return settings
+
+    def validate(self, setting: str, value):
+        """raise commands.BadArgument if a new value doesn't make sense, subclasses can check more than this"""
+        if setting != "action" and value < 0:
+            raise commands.BadArgument(f"`{setting}` can't be negative.")
+
+
+class ConfigCache:
+    """the JSONConfig of every guild for one server_config column, only hitting the database the first time"""
+
+    def __init__(self, column: str, config: typing.Type[JSONConfig]):
+        """
+        :param column: column of server_config the settings are in
+        :param config: JSONConfig subclass of the settings
+        """
+        self.column = column
+        self.config = config
+        self.configs: typing.Dict[int, JSONConfig] = {}
+
+    async def get(self, guildid: int) -> JSONConfig:
+        """
+        get the config of a guild
+        :param guildid: ID of the guild
+        :return: the config
+        """
+        config = self.configs.get(guildid)
+        if config is None:
+            async with database.db.execute(f"SELECT {self.column} FROM server_config WHERE guild=?",
+                                           (guildid,)) as cur:
+                row = await cur.fetchone()
+            config = self.configs[guildid] = self.config(json.loads(row[0]) if row and row[0] else None)
+        return config
+
+    def invalidate(self, guildid: int):
+        """call after changing the column for a guild"""
+        self.configs.pop(guildid, None)
@@ -1,4 +1,5 @@
 import glob
+import io
 import itertools
 import os
 import sqlite3
@@ -9,8 +10,11 @@ from discord.ext import commands
 import config
 import database
 import errhandler
+import migrations
+import outbound
 import scheduler
 from admincommands import AdminCommands
+from antiraid import AntiRaidCog
 from autoreaction import AutoReactionCog
 from birthday import BirthdayCog
 from bulklog import BulkLog
@@ -26,6 +30,7 @@ from modlog import ModLogInitCog
 from nitroroles import NitroRolesCog
 from threadutils import ThreadUtilsCog
 from utilitycommands import UtilityCommands
+from wordfilter import WordFilterCog
 from wordsinthebible import BibleCog
 from xp import ExperienceCog
 
@@ -46,6 +51,7 @@ if numoftables == 0:
     with con:
         con.executescript(makesql)
     logger.debug("initialized db!")
+migrations.migrate(con)
 con.close()
 
 # loop = asyncio.new_event_loop()
@@ -57,17 +63,31 @@ discord.Message.orig_reply = discord.Message.reply
 
 
 async def safe_reply(self: discord.Message, *args, **kwargs) -> discord.Message:
-    # replies to original message if it exists, just sends in channel if it doesnt
+    # replies to original message if it exists, just sends in channel if it doesnt.
+    # the reply is sent optimistically instead of fetching the message first, which doubled the API calls of every
+    # reply. sending closes file objects, so any files are read into memory to be able to send them again.
+    files = [kwargs.pop("file")] if "file" in kwargs else kwargs.pop("files", None) or []
+    buffered = []
+    for f in files:
+        if f is None:  # file=None means no file, same as not passing it
+            continue
+        buffered.append((f.fp.read(), f.filename, f.spoiler, f.description))
+        f.close()
+
+    def freshfiles():
+        return {"files": [discord.File(io.BytesIO(data), filename=filename, spoiler=spoiler, description=description)
+                          for data, filename, spoiler, description in buffered]} if buffered else {}
+
+    outbound.replystats["replies"] += 1
     try:
-        # retrieve this message, will throw NotFound if its not found and go to the fallback option.
-        # turns out trying to send a message will close any file objects which causes problems
-        await self.channel.fetch_message(self.id)
         # reference copy of .reply() since this func will override .reply()
-        return await self.orig_reply(*args, **kwargs)
-    # for some reason doesnt throw specific error
-    # if its unrelated httpexception itll just throw again and fall to the
-    # error handler hopefully
-    except (discord.errors.NotFound, discord.errors.HTTPException) as e:
+        return await outbound.submit(lambda: self.orig_reply(*args, **kwargs, **freshfiles()), self.channel.id,
+                                     outbound.Priority.INTERACTIVE)
+    except discord.errors.HTTPException as e:
+        # deleted messages can't be replied to, anything else is a real error for the error handler
+        if not (isinstance(e, discord.errors.NotFound) or (e.code == 50035 and "message_reference" in e.text)):
+            raise
+        outbound.replystats["fallbacks"] += 1
         logger.debug(f"abandoning reply to {self.id} due to {errhandler.get_full_class_name(e)}, "
                      f"sending message in {self.channel.id}.")
         # mention author
@@ -76,8 +96,10 @@ async def safe_reply(self: discord.Message, *args, **kwargs) -> discord.Message:
             content = author + (args[0] or "")[:2000 - len(author)]
         else:
             content = author
-        return await self.channel.send(content, **kwargs, allowed_mentions=discord.AllowedMentions(
-            everyone=False, users=True, roles=False, replied_user=True))
+        return await outbound.send(self.channel, content, **kwargs, **freshfiles(),
+                                   allowed_mentions=discord.AllowedMentions(everyone=False, users=True, roles=False,
+                                                                            replied_user=True),
+                                   priority=outbound.Priority.INTERACTIVE)
 
 
 # override .reply()
@@ -114,6 +136,8 @@ class MyBot(commands.Bot):
         await bot.add_cog(BulkLog(bot))
         await bot.add_cog(ExperienceCog(bot))
         await bot.add_cog(GateKeep(bot))
+        await bot.add_cog(AntiRaidCog(bot))
+        await bot.add_cog(WordFilterCog(bot))
         await bot.add_cog(BibleCog(bot))
         await scheduler.start()
 
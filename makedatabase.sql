@@ -23,9 +23,15 @@ create table birthdays
     user     int not null
         constraint birthdays_pk
             primary key,
-    birthday int not null
+    birthday int not null,
+    month    int,
+    day      int,
+    tz       float default 0
 );
 
+create index birthdays_month_day
+    on birthdays (month, day);
+
 create table booster_roles
 (
     guild int not null,
@@ -44,6 +50,14 @@ create table experience
         primary key (user, guild)
 );
 
+create table filtered_words
+(
+    guild int  not null,
+    word  text not null,
+    constraint filtered_words_pk
+        primary key (guild, word)
+);
+
 create table guild_xp_exclusions
 (
     guild         integer not null,
@@ -80,23 +94,65 @@ create table members_to_verify
     thread integer
 );
 
+create table message_store
+(
+    id          integer not null
+        constraint message_store_pk
+            primary key,
+    guild       int     not null,
+    channel     int     not null,
+    author      int     not null,
+    content     text,
+    attachments json
+);
+
+create index message_store_guild
+    on message_store (guild, id);
+
 create table modlog
 (
-    guild     int not null,
+    id        integer not null
+        constraint modlog_pk
+            primary key,
+    guild     int     not null,
     user      int,
     moderator int,
     text      text,
     datetime  int
 );
 
+create index modlog_guild_moderator_datetime
+    on modlog (guild, moderator, datetime);
+
+create index modlog_guild_user_datetime
+    on modlog (guild, user, datetime);
+
+create virtual table modlog_fts using fts5(text, guild, content='modlog', content_rowid='id');
+
+insert into modlog_fts (modlog_fts, rank) values ('rank', 'bm25(1.0, 0.0)');
+
+create trigger modlog_fts_insert after insert on modlog begin
+    insert into modlog_fts (rowid, text, guild) values (new.id, new.text, new.guild);
+end;
+
+create trigger modlog_fts_delete after delete on modlog begin
+    insert into modlog_fts (modlog_fts, rowid, text, guild) values ('delete', old.id, old.text, old.guild);
+end;
+
+create trigger modlog_fts_update after update of text, guild on modlog begin
+    insert into modlog_fts (modlog_fts, rowid, text, guild) values ('delete', old.id, old.text, old.guild);
+    insert into modlog_fts (rowid, text, guild) values (new.id, new.text, new.guild);
+end;
+
 create table schedule
 (
-    id        integer  not null
+    id         integer  not null
         constraint schedule_pk
             primary key autoincrement,
-    eventtype text     not null,
-    eventtime DATETIME not null,
-    eventdata json     not null
+    eventtype  text     not null,
+    eventtime  DATETIME not null,
+    eventdata  json     not null,
+    recurrence json
 );
 
 create table server_config
@@ -111,11 +167,14 @@ create table server_config
     booster_roles        BOOL,
     booster_role_hoist   int,
     bulk_log_channel     int,
+    bulk_log_events      json,
     time_between_xp      float,
     xp_change_per_level  float,
     verification_channel integer,
     verified_role        integer,
-    verification_text    text
+    verification_text    text,
+    anti_raid            json,
+    spam_filter          json
 );
 
 create table thin_ice
@@ -142,3 +201,24 @@ create table warnings
     points      float   default 1 not null
 );
 
+create index warnings_server_user_issuedat
+    on warnings (server, user, issuedat);
+
+create virtual table warnings_fts using fts5(reason, server, content='warnings', content_rowid='id');
+
+insert into warnings_fts (warnings_fts, rank) values ('rank', 'bm25(1.0, 0.0)');
+
+create trigger warnings_fts_insert after insert on warnings begin
+    insert into warnings_fts (rowid, reason, server) values (new.id, new.reason, new.server);
+end;
+
+create trigger warnings_fts_delete after delete on warnings begin
+    insert into warnings_fts (warnings_fts, rowid, reason, server) values ('delete', old.id, old.reason, old.server);
+end;
+
+create trigger warnings_fts_update after update of reason, server on warnings begin
+    insert into warnings_fts (warnings_fts, rowid, reason, server) values ('delete', old.id, old.reason, old.server);
+    insert into warnings_fts (rowid, reason, server) values (new.id, new.reason, new.server);
+end;
+
+PRAGMA user_version = 11;
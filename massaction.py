@@ -0,0 +1,92 @@
+import asyncio
+import csv
+import io
+import typing
+
+import discord
+from discord.ext import commands
+
+from clogs import logger
+
+CONCURRENCY = 5  # targets worked on at once, discord rate limits ban/kick/timeout per guild so more doesn't help
+PROGRESS_INTERVAL = 3  # seconds between edits of the progress message
+REPLY_LIMIT = 3  # up to this many targets get one reply each, more get a progress message and a report file
+
+T = typing.TypeVar("T", discord.User, discord.Member)
+# (success, line to reply to the moderator with, modlog text)
+Outcome = typing.Tuple[bool, str, str]
+
+
+def report(results: typing.List[typing.Tuple[T, bool, str, str]]) -> io.BytesIO:
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(["user_id", "user", "success", "result"])
+    for target, success, reply, _ in results:
+        writer.writerow([target.id, str(target), success, reply])
+    return io.BytesIO(buf.getvalue().encode("utf8"))
+
+
+async def run(ctx: commands.Context, verb: str, targets: typing.List[T],
+              pipeline: typing.Callable[[T], typing.Awaitable[Outcome]],
+              concurrency: int = CONCURRENCY) -> typing.List[typing.Tuple[T, bool, str, str]]:
+    """
+    run a moderation action on many targets at once
+    :param ctx: discord context, progress and results are sent here
+    :param verb: name of the action, like "ban"
+    :param targets: members/users to run the action on
+    :param pipeline: does the action to one target, returns an Outcome. the caller sends the outcomes' modlog text
+    once for every target. the helpers a pipeline uses can still write their own modlog entries and commit, like
+    ban_action() refusing to ban a mod.
+    :param concurrency: max targets worked on at once
+    :return: (target, success, reply, modlog text) for every target, in the order they were given
+    """
+    targets = list(dict.fromkeys(targets))  # Greedy can give the same member twice
+    few = len(targets) <= REPLY_LIMIT
+    # with only a few targets keep them in order, each gets its own reply like they always did
+    semaphore = asyncio.Semaphore(1 if few else concurrency)
+    results: typing.List[typing.Optional[typing.Tuple[T, bool, str, str]]] = [None] * len(targets)
+    done = 0
+
+    async def runone(i: int, target: T):
+        nonlocal done
+        async with semaphore:
+            try:
+                success, reply, logtext = await pipeline(target)
+            except Exception as e:
+                logger.error(e, exc_info=(type(e), e, e.__traceback__))
+                success, reply, logtext = False, f"❌ Failed to {verb} {target.mention}: `{e}`", \
+                                          f"Failed to {verb} {target.mention} (`{target}`): `{e}`"
+            results[i] = (target, success, reply, logtext)
+            done += 1
+            if few:
+                await ctx.reply(reply)
+
+    if few:
+        await asyncio.gather(*[runone(i, target) for i, target in enumerate(targets)])
+        return results
+
+    progress = await ctx.reply(f"⚙️ Running {verb} on {len(targets)} members...")
+
+    async def updateprogress():
+        while True:
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            try:
+                await progress.edit(content=f"⚙️ Running {verb} on {len(targets)} members... "
+                                            f"({done}/{len(targets)} done)")
+            except discord.HTTPException as e:
+                logger.debug(e)
+
+    updater = asyncio.create_task(updateprogress())
+    try:
+        await asyncio.gather(*[runone(i, target) for i, target in enumerate(targets)])
+    finally:
+        updater.cancel()
+    succeeded = sum(result[1] for result in results)
+    summary = f"{'✔️' if succeeded == len(targets) else '⚠️'} Finished {verb} on {len(targets)} members: " \
+              f"{succeeded} succeeded, {len(targets) - succeeded} failed."
+    try:
+        await progress.edit(content=summary)
+    except discord.HTTPException:
+        pass
+    await ctx.reply(summary, file=discord.File(await asyncio.to_thread(report, results), filename=f"{verb}-report.csv"))
+    return results
@@ -0,0 +1,152 @@
+import asyncio
+import collections
+import json
+import time
+import typing
+from datetime import datetime, timedelta, timezone
+
+import discord
+
+import database
+from clogs import logger
+
+RING_SIZE = 1000  # messages per guild kept in memory
+RETENTION = timedelta(days=3)  # how long messages are kept on disk
+GUILD_ROW_LIMIT = 100000  # max messages per guild kept on disk
+SPILL_INTERVAL = 30  # seconds between writing new messages to disk
+
+
+class StoredMessage:
+    """just enough of a message to log it after it's gone from discord.py's cache"""
+    __slots__ = ("id", "guild", "channel", "author", "content", "links")
+
+    def __init__(self, id: int, guild: int, channel: int, author: int, content: str, links: typing.List[str]):
+        self.id = id
+        self.guild = guild
+        self.channel = channel
+        self.author = author
+        self.content = content
+        self.links = links
+
+    @classmethod
+    def from_message(cls, message: discord.Message) -> "StoredMessage":
+        return cls(message.id, message.guild.id, message.channel.id, message.author.id, message.system_content,
+                   [att.url for att in message.attachments] + [emb.url for emb in message.embeds
+                                                               if emb.url is not None])
+
+    @property
+    def created_at(self) -> datetime:
+        return discord.utils.snowflake_time(self.id)
+
+
+class MessageStore:
+    """
+    recent messages of each guild, the newest RING_SIZE in memory and everything within RETENTION on disk.
+    new messages are written to disk in batches every SPILL_INTERVAL seconds.
+    """
+
+    def __init__(self):
+        self.rings: typing.Dict[int, typing.OrderedDict[int, StoredMessage]] = {}
+        self.unsaved: typing.Dict[int, StoredMessage] = {}
+        self.task: typing.Optional[asyncio.Task] = None
+
+    def add(self, message: discord.Message):
+        record = StoredMessage.from_message(message)
+        ring = self.rings.setdefault(record.guild, collections.OrderedDict())
+        ring[record.id] = record
+        if len(ring) > RING_SIZE:
+            ring.popitem(last=False)
+        self.unsaved[record.id] = record
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def get(self, guildid: int, messageid: int) -> typing.Optional[StoredMessage]:
+        """
+        find a stored message
+        :param guildid: ID of the guild the message was in
+        :param messageid: ID of the message
+        :return: the message or None if it's too old or was never seen
+        """
+        record = self.rings.get(guildid, {}).get(messageid) or self.unsaved.get(messageid)
+        if record is not None:
+            return record
+        async with database.db.execute("SELECT id, guild, channel, author, content, attachments FROM message_store "
+                                       "WHERE id=? AND guild=?", (messageid, guildid)) as cur:
+            row = await cur.fetchone()
+        if row is None:
+            return None
+        return StoredMessage(*row[:5], json.loads(row[5]))
+
+    async def edit(self, guildid: int, messageid: int, content: str) -> typing.Optional[StoredMessage]:
+        """
+        update the content of a stored message
+        :return: the message as it was before the edit, or None if it isn't stored
+        """
+        before = await self.get(guildid, messageid)
+        if before is None:
+            return None
+        after = StoredMessage(before.id, before.guild, before.channel, before.author, content, before.links)
+        ring = self.rings.get(guildid)
+        if ring is not None and messageid in ring:
+            ring[messageid] = after
+        self.unsaved[messageid] = after
+        return before
+
+    async def remove(self, guildid: int, messageids: typing.Collection[int]) -> typing.List[StoredMessage]:
+        """
+        forget deleted messages, so their content isn't kept around or logged again if the delete is seen twice
+        :param guildid: ID of the guild the messages were in
+        :param messageids: IDs of the messages
+        :return: the messages that were stored, oldest first
+        """
+        ring = self.rings.get(guildid, {})
+        found = {}
+        for messageid in messageids:
+            record = ring.pop(messageid, None)
+            unsaved = self.unsaved.pop(messageid, None)
+            if record or unsaved:
+                found[messageid] = record or unsaved
+        # aiosqlite runs statements in the order they're sent, so a flush writing one of these right now does so
+        # before it's deleted here
+        rest = [messageid for messageid in messageids if messageid not in found]
+        for i in range(0, len(rest), 500):  # stay under sqlite's variable limit
+            chunk = rest[i:i + 500]
+            params = (guildid, *chunk)
+            async with database.db.execute(f"SELECT id, guild, channel, author, content, attachments FROM "
+                                           f"message_store WHERE guild=? AND id IN ({','.join('?' * len(chunk))})",
+                                           params) as cur:
+                for row in await cur.fetchall():
+                    found[row[0]] = StoredMessage(*row[:5], json.loads(row[5]))
+            await database.db.execute(f"DELETE FROM message_store WHERE guild=? AND id IN "
+                                      f"({','.join('?' * len(chunk))})", params)
+        if rest:
+            await database.db.commit()
+        return [found[messageid] for messageid in sorted(found)]
+
+    async def flush(self):
+        records, self.unsaved = self.unsaved, {}
+        if records:
+            await database.db.executemany("REPLACE INTO message_store(id, guild, channel, author, content, "
+                                          "attachments) VALUES (?,?,?,?,?,?)",
+                                          [(r.id, r.guild, r.channel, r.author, r.content, json.dumps(r.links))
+                                           for r in records.values()])
+        # snowflakes are ordered by time so old messages are just the ones with a low ID
+        cutoff = discord.utils.time_snowflake(datetime.now(tz=timezone.utc) - RETENTION)
+        await database.db.execute("DELETE FROM message_store WHERE id < ?", (cutoff,))
+        for guild in {r.guild for r in records.values()}:
+            await database.db.execute("DELETE FROM message_store WHERE guild=? AND id <= (SELECT id FROM message_store "
+                                      "WHERE guild=? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                                      (guild, guild, GUILD_ROW_LIMIT))
+        await database.db.commit()
+
+    async def run(self):
+        while True:
+            start = time.monotonic()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(e, exc_info=(type(e), e, e.__traceback__))
+            await asyncio.sleep(max(SPILL_INTERVAL - (time.monotonic() - start), 0))
+
+
+store = MessageStore()
@@ -0,0 +1,157 @@
+import sqlite3
+
+from clogs import logger
+
+# each entry upgrades the database by one version (PRAGMA user_version).
+# makedatabase.sql always creates the latest schema and sets user_version to len(migrations),
+# so these only ever run on databases created by older versions of the bot.
+migrations = [
+    # 1: native recurring scheduler events
+    """
+    ALTER TABLE schedule ADD COLUMN recurrence json;
+    INSERT INTO schedule (eventtype, eventtime, eventdata)
+    SELECT 'unmute', json_extract(eventdata, '$.muteend'),
+           json_object('guild', json_extract(eventdata, '$.guild'), 'member', json_extract(eventdata, '$.member'))
+    FROM schedule WHERE eventtype = 'refresh_mute' AND json_extract(eventdata, '$.muteend') IS NOT NULL;
+    UPDATE schedule SET recurrence = json_object('every', 2419200, 'until', json_extract(eventdata, '$.muteend'))
+    WHERE eventtype = 'refresh_mute';
+    UPDATE schedule SET recurrence = json_object('yearly', json('true')) WHERE eventtype = 'birthday';
+    """,
+    # 2: birthdays are found by a sweep over month/day instead of having one scheduled event each.
+    # the timezone wasn't stored before, but birthdays are stored as local midnight so it can be worked out.
+    """
+    ALTER TABLE birthdays ADD COLUMN month int;
+    ALTER TABLE birthdays ADD COLUMN day int;
+    ALTER TABLE birthdays ADD COLUMN tz float DEFAULT 0;
+    UPDATE birthdays SET tz = CASE
+        WHEN ((birthday % 86400) + 86400) % 86400 <= 43200 THEN -(((birthday % 86400) + 86400) % 86400) / 3600.0
+        ELSE (86400 - ((birthday % 86400) + 86400) % 86400) / 3600.0 END;
+    UPDATE birthdays SET month = CAST(strftime('%m', birthday + tz * 3600, 'unixepoch') AS int),
+                         day   = CAST(strftime('%d', birthday + tz * 3600, 'unixepoch') AS int);
+    CREATE INDEX birthdays_month_day ON birthdays (month, day);
+    DELETE FROM schedule WHERE eventtype = 'birthday';
+    """,
+    # 3: per-guild bulk log event filter, NULL logs everything
+    """
+    ALTER TABLE server_config ADD COLUMN bulk_log_events json;
+    """,
+    # 4: compact store of recent messages for logging deletes/edits of messages discord.py doesn't have cached
+    """
+    CREATE TABLE message_store
+    (
+        id          integer not null
+            constraint message_store_pk
+                primary key,
+        guild       int     not null,
+        channel     int     not null,
+        author      int     not null,
+        content     text,
+        attachments json
+    );
+    CREATE INDEX message_store_guild ON message_store (guild, id);
+    """,
+    # 5: auto-punishments load a member's warnings ordered by time
+    """
+    CREATE INDEX warnings_server_user_issuedat ON warnings (server, user, issuedat);
+    """,
+    # 6: modlogs pages through a member's logs by time, as the user or as the moderator
+    """
+    CREATE INDEX modlog_guild_user_datetime ON modlog (guild, user, datetime);
+    CREATE INDEX modlog_guild_moderator_datetime ON modlog (guild, moderator, datetime);
+    """,
+    # 7: full-text search of modlogs and warn reasons. the guild is indexed too so searches only go through that
+    # guild's rows, it's weighted 0 so it doesn't affect the ranking.
+    """
+    CREATE VIRTUAL TABLE modlog_fts USING fts5(text, guild, content='modlog', content_rowid='rowid');
+    INSERT INTO modlog_fts (modlog_fts, rank) VALUES ('rank', 'bm25(1.0, 0.0)');
+    CREATE TRIGGER modlog_fts_insert AFTER INSERT ON modlog BEGIN
+        INSERT INTO modlog_fts (rowid, text, guild) VALUES (new.rowid, new.text, new.guild);
+    END;
+    CREATE TRIGGER modlog_fts_delete AFTER DELETE ON modlog BEGIN
+        INSERT INTO modlog_fts (modlog_fts, rowid, text, guild) VALUES ('delete', old.rowid, old.text, old.guild);
+    END;
+    CREATE TRIGGER modlog_fts_update AFTER UPDATE OF text, guild ON modlog BEGIN
+        INSERT INTO modlog_fts (modlog_fts, rowid, text, guild) VALUES ('delete', old.rowid, old.text, old.guild);
+        INSERT INTO modlog_fts (rowid, text, guild) VALUES (new.rowid, new.text, new.guild);
+    END;
+    INSERT INTO modlog_fts (modlog_fts) VALUES ('rebuild');
+    CREATE VIRTUAL TABLE warnings_fts USING fts5(reason, server, content='warnings', content_rowid='id');
+    INSERT INTO warnings_fts (warnings_fts, rank) VALUES ('rank', 'bm25(1.0, 0.0)');
+    CREATE TRIGGER warnings_fts_insert AFTER INSERT ON warnings BEGIN
+        INSERT INTO warnings_fts (rowid, reason, server) VALUES (new.id, new.reason, new.server);
+    END;
+    CREATE TRIGGER warnings_fts_delete AFTER DELETE ON warnings BEGIN
+        INSERT INTO warnings_fts (warnings_fts, rowid, reason, server)
+        VALUES ('delete', old.id, old.reason, old.server);
+    END;
+    CREATE TRIGGER warnings_fts_update AFTER UPDATE OF reason, server ON warnings BEGIN
+        INSERT INTO warnings_fts (warnings_fts, rowid, reason, server)
+        VALUES ('delete', old.id, old.reason, old.server);
+        INSERT INTO warnings_fts (rowid, reason, server) VALUES (new.id, new.reason, new.server);
+    END;
+    INSERT INTO warnings_fts (warnings_fts) VALUES ('rebuild');
+    """,
+    # 8: per-guild anti-raid settings, NULL means it's off
+    """
+    ALTER TABLE server_config ADD COLUMN anti_raid json;
+    """,
+    # 9: per-guild spam filter settings, NULL means it's off
+    """
+    ALTER TABLE server_config ADD COLUMN spam_filter json;
+    """,
+    # 10: word filter
+    """
+    CREATE TABLE filtered_words
+    (
+        guild int  not null,
+        word  text not null,
+        constraint filtered_words_pk
+            primary key (guild, word)
+    );
+    """,
+    # 11: modlog gets an INTEGER PRIMARY KEY for modlog_fts to point at, VACUUM can renumber plain rowids which
+    # would make search results point at the wrong entries. the old rowids are kept as the IDs.
+    """
+    DROP TRIGGER modlog_fts_insert;
+    DROP TRIGGER modlog_fts_delete;
+    DROP TRIGGER modlog_fts_update;
+    DROP TABLE modlog_fts;
+    CREATE TABLE modlog_new
+    (
+        id        integer not null
+            constraint modlog_pk
+                primary key,
+        guild     int     not null,
+        user      int,
+        moderator int,
+        text      text,
+        datetime  int
+    );
+    INSERT INTO modlog_new (id, guild, user, moderator, text, datetime)
+    SELECT rowid, guild, user, moderator, text, datetime FROM modlog;
+    DROP TABLE modlog;
+    ALTER TABLE modlog_new RENAME TO modlog;
+    CREATE INDEX modlog_guild_user_datetime ON modlog (guild, user, datetime);
+    CREATE INDEX modlog_guild_moderator_datetime ON modlog (guild, moderator, datetime);
+    CREATE VIRTUAL TABLE modlog_fts USING fts5(text, guild, content='modlog', content_rowid='id');
+    INSERT INTO modlog_fts (modlog_fts, rank) VALUES ('rank', 'bm25(1.0, 0.0)');
+    CREATE TRIGGER modlog_fts_insert AFTER INSERT ON modlog BEGIN
+        INSERT INTO modlog_fts (rowid, text, guild) VALUES (new.id, new.text, new.guild);
+    END;
+    CREATE TRIGGER modlog_fts_delete AFTER DELETE ON modlog BEGIN
+        INSERT INTO modlog_fts (modlog_fts, rowid, text, guild) VALUES ('delete', old.id, old.text, old.guild);
+    END;
+    CREATE TRIGGER modlog_fts_update AFTER UPDATE OF text, guild ON modlog BEGIN
+        INSERT INTO modlog_fts (modlog_fts, rowid, text, guild) VALUES ('delete', old.id, old.text, old.guild);
+        INSERT INTO modlog_fts (rowid, text, guild) VALUES (new.id, new.text, new.guild);
+    END;
+    INSERT INTO modlog_fts (modlog_fts) VALUES ('rebuild');
+    """,
+]
+
+
+def migrate(con: sqlite3.Connection):
+    version = con.execute("PRAGMA user_version").fetchone()[0]
+    for i, sql in enumerate(migrations[version:], start=version + 1):
+        logger.debug(f"migrating database to version {i}")
+        con.executescript(f"BEGIN;\n{sql}\nPRAGMA user_version = {i};\nCOMMIT;")
@@ -1,5 +1,8 @@
 import asyncio
+import collections
 import json
+import sqlite3
+import time
 import typing
 from datetime import datetime, timedelta, timezone
 
@@ -9,13 +12,21 @@ import humanize
 from discord.ext import commands
 from discord.ext.commands import Greedy
 
+import bulklog
 import config
 import database
+import historyexport
+import massaction
 import modlog
+import outbound
+import paginator
+import pointsledger
 import scheduler
+import spamfilter
+import userresolver
 from clogs import logger
 from embedutils import add_long_field, split_embed
-from timeconverter import time_converter
+from timeconverter import date_converter, time_converter
 
 
 async def is_mod(guild: discord.Guild, user: typing.Union[discord.User, discord.Member]):
@@ -74,29 +85,65 @@ async def get_server_config(guild: int, config: str):
         return conf[0]
 
 
+BAN_CACHE_TTL = 3600  # seconds before a cached ban status is checked with discord again
+BAN_CACHE_SIZE = 10000  # users cached per guild, the least recently updated are forgotten first
+# guild ID -> user ID -> (banned, expiry). kept up to date by on_member_ban/on_member_unban, the TTL only matters
+# for events missed while disconnected
+bancache: typing.Dict[int, typing.OrderedDict[int, typing.Tuple[bool, float]]] = {}
+
+
+def set_banned(guildid: int, userid: int, banned: bool):
+    guildbans = bancache.setdefault(guildid, collections.OrderedDict())
+    guildbans[userid] = (banned, time.monotonic() + BAN_CACHE_TTL)
+    # every entry gets the same TTL, so the least recently updated is also the first to expire
+    guildbans.move_to_end(userid)
+    if len(guildbans) > BAN_CACHE_SIZE:
+        guildbans.popitem(last=False)
+
+
+async def is_banned(guild: discord.Guild, user: typing.Union[discord.User, discord.Member, discord.Object]) -> bool:
+    """
+    check if a user is banned, only asking discord about this one user if it's not cached
+    :param guild: the guild
+    :param user: the user
+    :return: if the user is banned
+    """
+    cached = bancache.get(guild.id, {}).get(user.id)
+    if cached is not None and cached[1] > time.monotonic():
+        return cached[0]
+    try:
+        await guild.fetch_ban(user)
+        banned = True
+    except discord.NotFound:
+        banned = False
+    set_banned(guild.id, user.id, banned)
+    return banned
+
+
 async def ban_action(user: typing.Union[discord.User, discord.Member], guild: discord.Guild,
-                     ban_length: typing.Optional[timedelta], reason: str):
-    async for banned in guild.bans():
-        if banned.user.id == user.id:
-            return False
+                     ban_length: typing.Optional[timedelta], reason: str,
+                     pending: typing.Optional[list] = None):
+    if await is_banned(guild, user):
+        return False
     htime = humanize.precisedelta(ban_length)
     if await is_mod(guild, user):
         await modlog.modlog(f"Tried to ban {user.mention} (`{user}`), but they are a mod.", guild.id, user.id)
         return False
     try:
         await guild.ban(user, reason=reason, delete_message_days=0)
+        set_banned(guild.id, user.id, True)
         if ban_length is None:
             try:
-                await user.send(f"You were permanently banned in **{guild.name}** with reason "
-                                f"`{reason}`.")
+                await outbound.send(user, f"You were permanently banned in **{guild.name}** with reason "
+                                    f"`{reason}`.", priority=outbound.Priority.DM)
             except (discord.Forbidden, discord.HTTPException, AttributeError):
                 logger.debug("pass")
         else:
             scheduletime = datetime.now(tz=timezone.utc) + ban_length
-            await scheduler.schedule(scheduletime, "unban", {"guild": guild.id, "member": user.id})
+            await schedule_or_defer(pending, scheduletime, "unban", {"guild": guild.id, "member": user.id})
             try:
-                await user.send(f"You were banned in **{guild.name}** for **{htime}** with reason "
-                                f"`{reason}`.")
+                await outbound.send(user, f"You were banned in **{guild.name}** for **{htime}** with reason "
+                                    f"`{reason}`.", priority=outbound.Priority.DM)
             except (discord.Forbidden, discord.HTTPException, AttributeError):
                 logger.debug("pass")
         return True
@@ -106,11 +153,22 @@ async def ban_action(user: typing.Union[discord.User, discord.Member], guild: di
                             guild.id, user.id)
 
 
+async def schedule_or_defer(pending: typing.Optional[list], time: datetime, eventtype: str, eventdata: dict,
+                            recurrence: typing.Optional[dict] = None):
+    # actions taken on many targets pass a list to collect their events in, which then gets flushed with a single
+    # scheduler.schedule_many() call instead of one insert + commit per target
+    if pending is None:
+        await scheduler.schedule(time, eventtype, eventdata, recurrence)
+    else:
+        pending.append((time, eventtype, eventdata, recurrence))
+
+
 def is_timedout(member: discord.Member):
     return member.timed_out_until is not None and member.timed_out_until > datetime.now(tz=timezone.utc)
 
 
-async def mute_action(member: discord.Member, mute_length: typing.Optional[timedelta], reason: str):
+async def mute_action(member: discord.Member, mute_length: typing.Optional[timedelta], reason: str,
+                      pending: typing.Optional[list] = None):
     if is_timedout(member):
         return False
     htime = humanize.precisedelta(mute_length)
@@ -120,32 +178,63 @@ async def mute_action(member: discord.Member, mute_length: typing.Optional[timed
         return False
     if mute_length is None or mute_length > timedelta(days=28):
         # max timeout is 28days
-        muteend = (datetime.now(tz=timezone.utc) + mute_length).timestamp() if mute_length else None
+        muteend = datetime.now(tz=timezone.utc) + mute_length if mute_length else None
         await member.timeout(datetime.now(tz=timezone.utc) + timedelta(days=28), reason=reason)
-        await scheduler.schedule(datetime.now(tz=timezone.utc) + timedelta(days=28),
-                                 "refresh_mute", {"guild": member.guild.id, "member": member.id, "muteend": muteend})
+        await schedule_or_defer(pending, datetime.now(tz=timezone.utc) + timedelta(days=28),
+                                "refresh_mute", {"guild": member.guild.id, "member": member.id,
+                                                 "muteend": muteend.timestamp() if muteend else None},
+                                scheduler.every(timedelta(days=28), muteend))
+        if muteend is not None:
+            # purely cosmetic
+            await schedule_or_defer(pending, muteend, "unmute", {"guild": member.guild.id, "member": member.id})
     else:
         scheduletime = datetime.now(tz=timezone.utc) + mute_length
         await member.timeout(scheduletime, reason=reason)
         # purely cosmetic
-        await scheduler.schedule(scheduletime, "unmute", {"guild": member.guild.id, "member": member.id})
+        await schedule_or_defer(pending, scheduletime, "unmute", {"guild": member.guild.id, "member": member.id})
     if mute_length is None:
         try:
-            await member.send(f"You were permanently muted in **{member.guild.name}** with reason "
-                              f"`{reason}`.")
+            await outbound.send(member, f"You were permanently muted in **{member.guild.name}** with reason "
+                                f"`{reason}`.", priority=outbound.Priority.DM)
         except (discord.Forbidden, discord.HTTPException, AttributeError) as e:
             logger.debug(e)
     else:
 
         try:
-            await member.send(f"You were muted in **{member.guild.name}** for **{htime}** with reason "
-                              f"`{reason}`.")
+            await outbound.send(member, f"You were muted in **{member.guild.name}** for **{htime}** with reason "
+                                f"`{reason}`.", priority=outbound.Priority.DM)
         except (discord.Forbidden, discord.HTTPException, AttributeError) as e:
             logger.debug(e)
     return True
 
 
-async def on_warn(member: discord.Member, issued_points: float):
+async def warn_action(member: discord.Member, points: float, reason: str, issuedby: int,
+                      now: typing.Optional[datetime] = None, pending: typing.Optional[list] = None) -> int:
+    """
+    give a member a warn, DM them and run auto-punishments.
+    the warn itself isn't committed here, but thin ice and auto-punishments commit whatever is pending when they
+    trigger, so the caller still has to commit for warns that trigger nothing.
+    :return: ID of the warn
+    """
+    if now is None:
+        now = datetime.now(tz=timezone.utc)
+    async with database.db.cursor() as cur:
+        cur: aiosqlite.Cursor
+        await cur.execute("INSERT INTO warnings(server, user, issuedby, issuedat, reason, points)"
+                          "VALUES (?, ?, ?, ?, ?, ?)",
+                          (member.guild.id, member.id, issuedby, int(now.timestamp()), reason, points))
+        insertedrow = cur.lastrowid
+    pointsledger.add_warning(member.guild.id, member.id, int(now.timestamp()), points)
+    try:
+        await outbound.send(member, f"You were warned in {member.guild.name} for `{reason}`.",
+                            priority=outbound.Priority.DM)
+    except (discord.Forbidden, discord.HTTPException, AttributeError) as e:
+        logger.debug("pass;" + str(e))
+    await on_warn(member, points, pending)  # this handles autopunishments
+    return insertedrow
+
+
+async def on_warn(member: discord.Member, issued_points: float, pending: typing.Optional[list] = None):
     async with database.db.execute("SELECT thin_ice_role, thin_ice_threshold FROM server_config WHERE guild=?",
                                    (member.guild.id,)) as cur:
         thin_ice_role = await cur.fetchone()
@@ -161,7 +250,7 @@ async def on_warn(member: discord.Member, issued_points: float):
             warns_on_thin_ice = (await cur.fetchone())[0]
         if warns_on_thin_ice >= threshold:
             await ban_action(member, member.guild, None, f"Automatically banned for receiving more than {threshold}"
-                                                         f" points on thin ice.")
+                                                         f" points on thin ice.", pending)
             await modlog.modlog(f"{member.mention} (`{member}`) was automatically "
                                 f"banned for receiving more than {threshold} "
                                 f"points on thin ice.", member.guild.id, member.id)
@@ -170,43 +259,80 @@ async def on_warn(member: discord.Member, issued_points: float):
             await database.db.commit()
 
     else:
-        # select all from punishments where the sum of warnings in the punishment range fits the warn_count thing
-        # this thing is a mess but should return 1 or 0 punishments if needed
-        monstersql = "SELECT *, (SELECT SUM(points) FROM warnings WHERE (warn_timespan=0 OR (" \
-                     ":now-warn_timespan)<warnings.issuedat) AND warnings.server=:guild AND user=:user AND " \
-                     "deactivated=0) pointstotal FROM auto_punishment WHERE pointstotal >= warn_count AND " \
-                     "warn_count > (pointstotal-:pointsjustgained) AND guild=:guild ORDER BY punishment_duration," \
-                     "punishment_type DESC LIMIT 1 "
-        params = {"now": datetime.now(tz=timezone.utc).timestamp(), "pointsjustgained": issued_points,
-                  "guild": member.guild.id, "user": member.id}
-        async with database.db.execute(monstersql, params) as cur:
-            punishment = await cur.fetchone()
+        # the first rule (by shortest punishment) whose point count this warn crossed, see pointsledger
+        punishment = await pointsledger.triggered_rule(member.guild.id, member.id,
+                                                       datetime.now(tz=timezone.utc).timestamp(), issued_points)
         if punishment is not None:
-            logger.debug(punishment)
-            # punishment_types = {
-            #     "ban": ban_action,
-            #     "mute": mute_action
-            # }
-            # func = punishment_types[punishment[2]]
-            duration = None if punishment[3] == 0 else timedelta(seconds=punishment[3])
-            timespan_text = "total" if punishment[4] == 0 else \
-                f"within {humanize.precisedelta(punishment[4])}"
-            if punishment[2] == "ban":
-                await ban_action(member, member.guild, duration,
-                                 f"Automatic punishment due to reaching {punishment[1]} points {timespan_text}")
-            elif punishment[2] == "mute":
-                await mute_action(member, duration,
-                                  f"Automatic punishment due to reaching {punishment[1]} points {timespan_text}")
+            duration = timedelta(seconds=punishment.punishment_duration) if punishment.punishment_duration else None
+            timespan_text = "total" if punishment.warn_timespan == 0 else \
+                f"within {humanize.precisedelta(punishment.warn_timespan)}"
+            reason = f"Automatic punishment due to reaching {punishment.warn_count} points {timespan_text}"
+            if punishment.punishment_type == "ban":
+                await ban_action(member, member.guild, duration, reason, pending)
+            elif punishment.punishment_type == "mute":
+                await mute_action(member, duration, reason, pending)
             punishment_type_future_tense = {
                 "ban": "banned",
                 "mute": "muted"
             }
-            punishment_text = "permanently" if duration.total_seconds() == 0 else \
-                f"for {humanize.precisedelta(duration)}"
+            punishment_text = "permanently" if duration is None else f"for {humanize.precisedelta(duration)}"
             await modlog.modlog(
                 f"{member.mention} (`{member}`) has been automatically "
-                f"{punishment_type_future_tense[punishment[2]]}  {punishment_text} due to reaching {punishment[1]} "
-                f"points {timespan_text}", member.guild.id, member.id)
+                f"{punishment_type_future_tense[punishment.punishment_type]} {punishment_text} due to reaching "
+                f"{punishment.warn_count} points {timespan_text}", member.guild.id, member.id)
+
+
+def user_text(userid: int, users: typing.Dict[int, typing.Optional[discord.User]]) -> str:
+    """
+    :param userid: ID of a user
+    :param users: users from userresolver.resolve()
+    :return: a mention of the user, with their name if it's known since mentions of uncached users don't render
+    """
+    user = users.get(userid)
+    return f"<@{userid}> (`{user}`)" if user is not None else f"<@{userid}>"
+
+
+def add_warn_field(embed: discord.Embed, warn: tuple, user: typing.Optional[int] = None,
+                   users: typing.Optional[typing.Dict[int, typing.Optional[discord.User]]] = None):
+    """
+    :param embed: embed to add the warn to
+    :param warn: id, issuedby, issuedat, reason, deactivated, points of the warn
+    :param user: ID of the warned user, to show it when the embed has warns of more than one user
+    :param users: resolved users to show the names of
+    """
+    users = users or {}
+    issuedat = warn[2]
+    reason = warn[3]
+    points = warn[5]
+    add_long_field(embed,
+                   name=f"Warn ID `#{warn[0]}`: {'%g' % points} point{'' if points == 1 else 's'}"
+                        f"{' (Deleted)' if warn[4] else ''}",
+                   value=
+                   f"Reason: {reason}\n" +
+                   (f"User: {user_text(user, users)}\n" if user else "") +
+                   f"Issued by: {user_text(warn[1], users)}\n"
+                   f"Issued <t:{int(issuedat)}:f> "
+                   f"(<t:{int(issuedat)}:R>)", inline=False)
+
+
+def add_modlog_field(embed: discord.Embed, log: tuple,
+                     users: typing.Optional[typing.Dict[int, typing.Optional[discord.User]]] = None):
+    """
+    :param embed: embed to add the modlog to
+    :param log: text, datetime, user, moderator of the modlog
+    :param users: resolved users to show the names of
+    """
+    users = users or {}
+    user = log[2]
+    moderator = log[3]
+    issuedat = log[1]
+    text = log[0]
+    add_long_field(embed,
+                   name=f"<t:{int(issuedat)}:f> (<t:{int(issuedat)}:R>)",
+                   value=
+                   text + ("\n\n" if user or moderator else "") +
+                   (f"**User**: {user_text(user, users)}\n" if user else "") +
+                   (f"**Moderator**: {user_text(moderator, users)}\n" if moderator else ""), inline=False)
 
 
 class ModerationCog(commands.Cog, name="Moderation"):
@@ -226,17 +352,46 @@ class ModerationCog(commands.Cog, name="Moderation"):
                 modlog.modlog(f"{message.author.mention} (`{message.author}`) "
                               f"was automatically banned for mass ping.", message.guild.id, message.author.id)
             )
+            return
+        if message.guild and isinstance(message.author, discord.Member) and not message.author.bot \
+                and not message.author.guild_permissions.manage_messages:
+            spamconfig = await spamfilter.get_config(message.guild.id)
+            if spamconfig.enabled:
+                reason, state = spamfilter.check(message, spamconfig)
+                if reason is not None:
+                    await self.punish_spam(message, spamconfig, reason, state)
+
+    async def punish_spam(self, message: discord.Message, spamconfig: spamfilter.SpamConfig, reason: str,
+                          state: spamfilter.SpamState):
+        try:
+            await message.delete()
+        except discord.HTTPException as e:
+            logger.debug(e)
+        if not spamfilter.should_punish(state):  # already dealt with this burst of spam
+            return
+        member = message.author
+        text = f"{member.mention} (`{member}`) was caught {reason} in {message.channel.mention}"
+        if spamconfig.action == "warn" and not await is_mod(message.guild, member):
+            pending = []
+            try:
+                warnid = await warn_action(member, spamconfig.points, f"Spam: {reason}.", self.bot.user.id,
+                                           pending=pending)
+            finally:
+                await database.db.commit()
+                await scheduler.schedule_many(pending)
+            text += f" and was automatically warned (warn ID `#{warnid}`)"
+        elif spamconfig.action == "mute":
+            length = timedelta(seconds=spamconfig.mute_duration) if spamconfig.mute_duration else None
+            if await mute_action(member, length, f"Spam: {reason}."):
+                text += f" and was automatically muted " \
+                        f"{f'for {humanize.precisedelta(length)}' if length else 'permanently'}"
+        await modlog.modlog(text + ".", message.guild.id, member.id)
 
     # delete unban events if someone manually unbans with discord.
     @commands.Cog.listener()
     async def on_member_unban(self, guild: discord.Guild, user: discord.User):
-        actuallycancelledanytasks = False
-        async with database.db.execute("SELECT id FROM schedule WHERE json_extract(eventdata, \"$.guild\")=? "
-                                       "AND json_extract(eventdata, \"$.member\")=? AND eventtype=?",
-                                       (guild.id, user.id, "unban")) as cur:
-            async for row in cur:
-                await scheduler.canceltask(row[0])
-                actuallycancelledanytasks = True
+        set_banned(guild.id, user.id, False)
+        actuallycancelledanytasks = await scheduler.cancel_matching("unban", guild.id, user.id)
         thin_ice_role = await get_server_config(guild.id, "thin_ice_role")
         if thin_ice_role is not None:
             await database.db.execute("REPLACE INTO thin_ice(user,guild,marked_for_thin_ice,warns_on_thin_ice) VALUES "
@@ -244,27 +399,27 @@ class ModerationCog(commands.Cog, name="Moderation"):
             await database.db.commit()
         if actuallycancelledanytasks:
             try:
-                await user.send(f"You were manually unbanned in **{guild.name}**.")
+                await outbound.send(user, f"You were manually unbanned in **{guild.name}**.",
+                                    priority=outbound.Priority.DM)
             except (discord.Forbidden, discord.HTTPException, AttributeError, discord.NotFound):
                 logger.debug("pass")
         channel_to_invite = guild.text_channels[0]
         invite = await channel_to_invite.create_invite(max_uses=1, reason=f"{user.name} was unbanned.")
         try:
-            await user.send(f"You can rejoin **{guild.name}** with this link: {invite}")
+            await outbound.send(user, f"You can rejoin **{guild.name}** with this link: {invite}",
+                                priority=outbound.Priority.DM)
         except (discord.Forbidden, discord.HTTPException, AttributeError, discord.NotFound):
             logger.debug("pass")
 
     @commands.Cog.listener()
     async def on_member_ban(self, guild: discord.Guild, user: discord.User):
-        async with database.db.execute("SELECT id FROM schedule WHERE json_extract(eventdata, \"$.guild\")=? "
-                                       "AND json_extract(eventdata, \"$.member\")=? AND eventtype=?",
-                                       (guild.id, user.id, "un_thin_ice")) as cur:
-            async for row in cur:
-                await scheduler.canceltask(row[0])
+        set_banned(guild.id, user.id, True)
+        await scheduler.cancel_matching("un_thin_ice", guild.id, user.id)
         ban_appeal_link = await get_server_config(guild.id, "ban_appeal_link")
         if ban_appeal_link is not None:
             try:
-                await user.send(f"You can appeal your ban from **{guild.name}** at {ban_appeal_link}")
+                await outbound.send(user, f"You can appeal your ban from **{guild.name}** at {ban_appeal_link}",
+                                    priority=outbound.Priority.DM)
             except (discord.Forbidden, discord.HTTPException, AttributeError):
                 logger.debug("pass")
 
@@ -272,33 +427,20 @@ class ModerationCog(commands.Cog, name="Moderation"):
     async def on_member_update(self, before: discord.Member, after: discord.Member):
         # delete unmute events if someone manually untimed out
         if is_timedout(before) is not None and is_timedout(after) is None:  # if muted role manually removed
-            actuallycancelledanytasks = False
-            async with database.db.execute("SELECT id FROM schedule WHERE json_extract(eventdata, \"$.guild\")=? "
-                                           "AND json_extract(eventdata, \"$.member\")=? AND (eventtype=? OR "
-                                           "eventtype=?)",
-                                           (after.guild.id, after.id, "unmute", "refresh_mute")) as cur:
-                async for row in cur:
-                    await scheduler.canceltask(row[0])
-                    actuallycancelledanytasks = True
-            if actuallycancelledanytasks:
-                await after.send(f"You were manually unmuted in **{after.guild.name}**.")
+            if await scheduler.cancel_matching(["unmute", "refresh_mute"], after.guild.id, after.id):
+                await outbound.send(after, f"You were manually unmuted in **{after.guild.name}**.",
+                                    priority=outbound.Priority.DM)
         # remove thin ice from records if manually removed
         thin_ice_role = await get_server_config(after.guild.id, "mod_role")
         if thin_ice_role is not None:
             if thin_ice_role in [role.id for role in before.roles] \
                     and thin_ice_role not in [role.id for role in after.roles]:  # if muted role manually removed
-                actuallycancelledanytasks = False
-                async with database.db.execute("SELECT id FROM schedule WHERE json_extract(eventdata, \"$.guild\")=? "
-                                               "AND json_extract(eventdata, \"$.member\")=? AND eventtype=?",
-                                               (after.guild.id, after.id, "un_thin_ice")) as cur:
-                    async for row in cur:
-                        await scheduler.canceltask(row[0])
-                        await database.db.execute("DELETE FROM thin_ice WHERE guild=? and user=?",
-                                                  (after.guild.id, after.id))
-                        actuallycancelledanytasks = True
+                if await scheduler.cancel_matching("un_thin_ice", after.guild.id, after.id):
+                    await database.db.execute("DELETE FROM thin_ice WHERE guild=? and user=?",
+                                              (after.guild.id, after.id))
                     await database.db.commit()
-                if actuallycancelledanytasks:
-                    await after.send(f"Your thin ice was manually removed in **{after.guild.name}**.")
+                    await outbound.send(after, f"Your thin ice was manually removed in **{after.guild.name}**.",
+                                        priority=outbound.Priority.DM)
                     await modlog.modlog(f"{after.mention} (`{after}`)'s thin ice was manually removed.",
                                         guildid=after.guild.id, userid=after.id)
 
@@ -317,9 +459,10 @@ class ModerationCog(commands.Cog, name="Moderation"):
                 await scheduler.schedule(scheduletime, "un_thin_ice",
                                          {"guild": member.guild.id, "member": member.id,
                                           "thin_ice_role": thin_ice_role[0]})
-                await member.send(f"Welcome back to **{member.guild.name}**. since you were just unbanned, you will"
-                                  f" have the **thin ice** role for **1 week.** If you receive {thin_ice_role[1]} "
-                                  f"point(s) in this timespan, you will be permanently banned.")
+                await outbound.send(member, f"Welcome back to **{member.guild.name}**. since you were just unbanned, "
+                                    f"you will have the **thin ice** role for **1 week.** If you receive "
+                                    f"{thin_ice_role[1]} point(s) in this timespan, you will be permanently banned.",
+                                    priority=outbound.Priority.DM)
 
     @commands.command(aliases=["setmodrole", "addmodrole", "moderatorrole"])
     @commands.has_guild_permissions(manage_guild=True)
@@ -396,9 +539,11 @@ class ModerationCog(commands.Cog, name="Moderation"):
         """
         if channel is None:
             await update_server_config(ctx.guild.id, "log_channel", None)
+            modlog.invalidate_channels(ctx.guild.id)
             await ctx.reply("✔️ Removed server modlog channel.")
         else:
             await update_server_config(ctx.guild.id, "log_channel", channel.id)
+            modlog.invalidate_channels(ctx.guild.id)
             await ctx.reply(f"✔️ Set server modlog channel to **{channel.mention}**")
             await channel.send(f"This is the new modlog channel for {ctx.guild.name}!")
 
@@ -415,15 +560,80 @@ class ModerationCog(commands.Cog, name="Moderation"):
         """
         if channel is None:
             await update_server_config(ctx.guild.id, "bulk_log_channel", None)
+            bulklog.invalidate_config(ctx.guild.id)
+            modlog.invalidate_channels(ctx.guild.id)
             await modlog.modlog(f"{ctx.author.mention} ({ctx.author}) removed the server bulklog channel.",
                                 ctx.guild.id, ctx.author.id)
             await ctx.reply("✔️ Removed server bulklog channel.")
         else:
             await update_server_config(ctx.guild.id, "bulk_log_channel", channel.id)
+            bulklog.invalidate_config(ctx.guild.id)
+            modlog.invalidate_channels(ctx.guild.id)
             await modlog.modlog(f"{ctx.author.mention} ({ctx.author}) set the server bulklog channel to "
                                 f"{channel.mention} ({channel}).", ctx.guild.id, ctx.author.id)
             await ctx.reply(f"✔️ Set server bulklog channel to **{channel.mention}**")
 
+    @commands.command(aliases=["bulklogevent", "logevents"])
+    @commands.has_guild_permissions(manage_guild=True)
+    @commands.guild_only()
+    async def bulklogevents(self, ctx, *events: str):
+        """
+        Choose which events appear in the server "bulk log" channel.
+
+        :param ctx: discord context
+        :param events: - event types to log, `all` to log everything, or leave blank to see the current events and \
+        every event type.
+        """
+        if not events:
+            current = (await bulklog.get_config(ctx.guild.id)).events
+            await ctx.reply(f"Logging: {'all events' if current is None else ', '.join(sorted(current)) or 'nothing'}"
+                            f"\nEvent types: {', '.join(sorted(bulklog.EVENTS))}")
+            return
+        events = {e.lower() for e in events}
+        if "all" in events:
+            await update_server_config(ctx.guild.id, "bulk_log_events", None)
+            bulklog.invalidate_config(ctx.guild.id)
+            await modlog.modlog(f"{ctx.author.mention} ({ctx.author}) set the server bulklog to log all events.",
+                                ctx.guild.id, modid=ctx.author.id)
+            await ctx.reply("✔️ Bulk log will log all events.")
+            return
+        if invalid := events - bulklog.EVENTS:
+            raise commands.BadArgument(f"Unknown event type(s): {', '.join(sorted(invalid))}. "
+                                       f"Valid event types are: {', '.join(sorted(bulklog.EVENTS))}")
+        await update_server_config(ctx.guild.id, "bulk_log_events", json.dumps(sorted(events)))
+        bulklog.invalidate_config(ctx.guild.id)
+        await modlog.modlog(f"{ctx.author.mention} ({ctx.author}) set the server bulklog events to "
+                            f"{', '.join(sorted(events))}.", ctx.guild.id, modid=ctx.author.id)
+        await ctx.reply(f"✔️ Bulk log will log: {', '.join(sorted(events))}")
+
+    @commands.command(aliases=["antispam", "spamconfig"])
+    @commands.has_guild_permissions(manage_guild=True)
+    @commands.guild_only()
+    async def spamfilter(self, ctx, setting: typing.Optional[str] = None, *, value: typing.Optional[str] = None):
+        """
+        Set up automatic deletion of spam.
+        Messages are spam when someone sends the same message over and over, sends messages too quickly, sends too
+        many emojis in one message or sends too many links. Spammers can also be warned or muted. Members with
+        Manage Messages permissions are never filtered.
+
+        :param ctx: discord context
+        :param setting: `on`, `off`, or the name of a setting to change. leave blank to see the current settings.
+        :param value: the new value of the setting. counts are numbers (0 to not check), times are like `10s` or `5m`,
+        and action is `none`, `warn` or `mute`.
+        """
+        spamconfig = await spamfilter.get_config(ctx.guild.id)
+        if setting is None:
+            await ctx.reply(embed=spamconfig.embed(f"Spam filter for {ctx.guild.name}"))
+            return
+        setting = setting.lower()
+        settings = spamconfig.change(setting, value)
+        await update_server_config(ctx.guild.id, "spam_filter", None if settings is None else json.dumps(settings))
+        spamfilter.invalidate_config(ctx.guild.id)
+        text = "turned the spam filter off" if settings is None else "turned the spam filter on" if setting == "on" \
+            else f"set spam filter `{setting}` to `{settings[setting]}`"
+        await ctx.reply(f"✔️ {text[0].upper()}{text[1:]}.")
+        await modlog.modlog(f"{ctx.author.mention} (`{ctx.author}`) {text}.", ctx.guild.id, modid=ctx.author.id)
+
     @commands.command(aliases=["banappeal"])
     @commands.has_guild_permissions(manage_guild=True)
     @commands.guild_only()
@@ -464,30 +674,26 @@ class ModerationCog(commands.Cog, name="Moderation"):
             await ctx.reply("❌ members is a required argument that is missing.")
             return
         htime = humanize.precisedelta(ban_length)
-        for member in members:
-            result = await ban_action(member, ctx.guild, ban_length, reason)
-            if not result:
-                await ctx.reply(f"❌ Failed to ban {member.mention}. Are they already banned or a mod?")
-                await modlog.modlog(f"{ctx.author.mention} (`{ctx.author}`) tried to ban "
-                                    f"{member.mention} (`{member}`) for "
-                                    f"{f'for **{htime}**' if htime else 'permanently'} with reason "
-                                    f"`{reason}`, but it failed. ", ctx.guild.id,
-                                    member.id, ctx.author.id)
-                continue
-            if ban_length is None:
-                await ctx.reply(
-                    f"✔ Permanently banned **{member.mention}** with reason `{reason}️`")
-                await modlog.modlog(f"{ctx.author.mention} (`{ctx.author}`) banned"
-                                    f" {member.mention} (`{member}`) with reason "
-                                    f"`{reason}️`", ctx.guild.id, member.id,
-                                    ctx.author.id)
-            else:
-                await ctx.reply(f"✔️ Banned **{member.mention}** for **{htime}** with reason "
-                                f"`{reason}`.")
-                await modlog.modlog(f"{ctx.author.mention} (`{ctx.author}`) banned"
-                                    f" {member.mention} (`{member}`) for {htime} with reason "
-                                    f"`{reason}`.", ctx.guild.id, member.id,
-                                    ctx.author.id)
+        length = f"for **{htime}**" if ban_length else "permanently"
+        pending = []
+
+        async def pipeline(member: discord.User) -> massaction.Outcome:
+            if not await ban_action(member, ctx.guild, ban_length, reason, pending):
+                return False, f"❌ Failed to ban {member.mention}. Are they already banned or a mod?", \
+                       f"{ctx.author.mention} (`{ctx.author}`) tried to ban {member.mention} (`{member}`) " \
+                       f"{length} with reason `{reason}`, but it failed. "
+            return True, f"✔️ Banned **{member.mention}** {length} with reason `{reason}`.", \
+                   f"{ctx.author.mention} (`{ctx.author}`) banned {member.mention} (`{member}`) {length} " \
+                   f"with reason `{reason}`."
+
+        try:
+            results = await massaction.run(ctx, "ban", members, pipeline)
+        finally:
+            await scheduler.schedule_many(pending)
+        await modlog.modlog_many([(member.id, logtext) for member, _, _, logtext in results], ctx.guild.id,
+                                 ctx.author.id, f"{ctx.author.mention} (`{ctx.author}`) banned "
+                                                f"{sum(r[1] for r in results)}/{len(results)} members {length} "
+                                                f"with reason `{reason}`.")
 
     @commands.command(aliases=["k", "boot", "eject"])
     @commands.bot_has_permissions(ban_members=True)
@@ -503,22 +709,22 @@ class ModerationCog(commands.Cog, name="Moderation"):
         if not members:
             await ctx.reply("❌ members is a required argument that is missing.")
             return
-        for member in members:
+
+        async def pipeline(member: discord.User) -> massaction.Outcome:
             try:
                 await ctx.guild.kick(member, reason=reason)
             except discord.Forbidden:
-                await ctx.reply(f"❌ Failed to kick {member.mention}. Are they banned or a mod?")
-                await modlog.modlog(f"{ctx.author.mention} (`{ctx.author}`) tried to kick "
-                                    f"{member.mention} (`{member}`) with reason "
-                                    f"`{reason}`, but it failed. ", ctx.guild.id,
-                                    member.id, ctx.author.id)
-            else:
-                await ctx.reply(
-                    f"✔ Kicked **{member.mention}** with reason `{reason}️`")
-                await modlog.modlog(f"{ctx.author.mention} (`{ctx.author}`) kicked"
-                                    f" {member.mention} (`{member}`) with reason "
-                                    f"`{reason}`", ctx.guild.id, member.id,
-                                    ctx.author.id)
+                return False, f"❌ Failed to kick {member.mention}. Are they banned or a mod?", \
+                       f"{ctx.author.mention} (`{ctx.author}`) tried to kick {member.mention} (`{member}`) " \
+                       f"with reason `{reason}`, but it failed. "
+            return True, f"✔ Kicked **{member.mention}** with reason `{reason}️`", \
+                   f"{ctx.author.mention} (`{ctx.author}`) kicked {member.mention} (`{member}`) with reason `{reason}`"
+
+        results = await massaction.run(ctx, "kick", members, pipeline)
+        await modlog.modlog_many([(member.id, logtext) for member, _, _, logtext in results], ctx.guild.id,
+                                 ctx.author.id, f"{ctx.author.mention} (`{ctx.author}`) kicked "
+                                                f"{sum(r[1] for r in results)}/{len(results)} members "
+                                                f"with reason `{reason}`.")
 
     @commands.command(aliases=["mu"])
     @commands.bot_has_permissions(manage_roles=True)
@@ -538,32 +744,26 @@ class ModerationCog(commands.Cog, name="Moderation"):
             await ctx.reply("❌ members is a required argument that is missing.")
             return
         htime = humanize.precisedelta(mute_length)
-        for member in members:
-            result = await mute_action(member, mute_length, reason)
-            if not result:
-                await ctx.reply(f"❌ Failed to mute {member.mention}. Are they already banned or a mod?")
-                await modlog.modlog(f"{ctx.author.mention} (`{ctx.author}`) tried to mute "
-                                    f"{member.mention} (`{member}`) for "
-                                    f"{f'for **{htime}**' if htime else 'permanently'} with reason "
-                                    f"`{reason}`, but it failed. ", ctx.guild.id,
-                                    member.id, ctx.author.id)
-                continue
-            if mute_length is None:
-                await ctx.reply(
-                    f"✔ Permanently muted **{member.mention}** with reason `{reason}️`")
-                await modlog.modlog(f"{ctx.author.mention} (`{ctx.author}`) "
-                                    f"permanently muted {member.mention} (`{member}`) "
-                                    f"with reason "
-                                    f"`{reason}️`", ctx.guild.id, member.id,
-                                    ctx.author.id)
-            else:
-                await ctx.reply(f"✔️ Muted **{member.mention}** for **{htime}** with reason "
-                                f"`{reason}`.")
-                await modlog.modlog(f"{ctx.author.mention} (`{ctx.author}`) muted "
-                                    f"{member.mention} (`{member}`) for **{htime}**"
-                                    f" with reason "
-                                    f"`{reason}`.", ctx.guild.id, member.id,
-                                    ctx.author.id)
+        length = f"for **{htime}**" if mute_length else "permanently"
+        pending = []
+
+        async def pipeline(member: discord.Member) -> massaction.Outcome:
+            if not await mute_action(member, mute_length, reason, pending):
+                return False, f"❌ Failed to mute {member.mention}. Are they already banned or a mod?", \
+                       f"{ctx.author.mention} (`{ctx.author}`) tried to mute {member.mention} (`{member}`) " \
+                       f"{length} with reason `{reason}`, but it failed. "
+            return True, f"✔️ Muted **{member.mention}** {length} with reason `{reason}`.", \
+                   f"{ctx.author.mention} (`{ctx.author}`) muted {member.mention} (`{member}`) {length} " \
+                   f"with reason `{reason}`."
+
+        try:
+            results = await massaction.run(ctx, "mute", members, pipeline)
+        finally:
+            await scheduler.schedule_many(pending)
+        await modlog.modlog_many([(member.id, logtext) for member, _, _, logtext in results], ctx.guild.id,
+                                 ctx.author.id, f"{ctx.author.mention} (`{ctx.author}`) muted "
+                                                f"{sum(r[1] for r in results)}/{len(results)} members {length} "
+                                                f"with reason `{reason}`.")
 
     @commands.command(aliases=["um"])
     @commands.bot_has_permissions(manage_roles=True)
@@ -580,18 +780,15 @@ class ModerationCog(commands.Cog, name="Moderation"):
             return
         for member in members:
             # cancel all unmute events
-            async with database.db.execute("SELECT id FROM schedule WHERE json_extract(eventdata, \"$.guild\")=? "
-                                           "AND json_extract(eventdata, \"$.member\")=? AND (eventtype=? OR eventtype=?)",
-                                           (ctx.guild.id, member.id, "unmute", "refresh_mute")) as cur:
-                async for row in cur:
-                    await scheduler.canceltask(row[0])
+            await scheduler.cancel_matching(["unmute", "refresh_mute"], ctx.guild.id, member.id)
 
             await member.timeout(None)
             await ctx.reply(f"✔️ Unmuted {member.mention}")
             await modlog.modlog(f"{ctx.author.mention} (`{ctx.author}`) unmuted"
                                 f" {member.mention} (`{member}`)", ctx.guild.id, member.id, ctx.author.id)
             try:
-                await member.send(f"You were manually unmuted in **{ctx.guild.name}**.")
+                await outbound.send(member, f"You were manually unmuted in **{ctx.guild.name}**.",
+                                    priority=outbound.Priority.DM)
             except (discord.Forbidden, discord.HTTPException, AttributeError):
                 logger.debug("pass")
 
@@ -608,25 +805,22 @@ class ModerationCog(commands.Cog, name="Moderation"):
         if not members:
             await ctx.reply("❌ members is a required argument that is missing.")
             return
-        bans = [ban.user for ban in await ctx.guild.bans()]
         for member in members:
-            if member not in bans:
+            if not await is_banned(ctx.guild, member):
                 await ctx.reply(f"❌ {member.mention} isn't banned!")
                 continue
             await ctx.guild.unban(member)
+            set_banned(ctx.guild.id, member.id, False)
             await ctx.reply(f"✔️ Unbanned {member.mention}")
             await modlog.modlog(f"{ctx.author.mention} (`{ctx.author}`) "
                                 f"unbanned {member.mention} (`{member}`)",
                                 ctx.guild.id, member.id, ctx.author.id)
             try:
-                await member.send(f"You were manually unbanned in **{ctx.guild.name}**.")
+                await outbound.send(member, f"You were manually unbanned in **{ctx.guild.name}**.",
+                                    priority=outbound.Priority.DM)
             except (discord.Forbidden, discord.HTTPException, AttributeError):
                 logger.debug("pass")
-            async with database.db.execute("SELECT id FROM schedule WHERE json_extract(eventdata, \"$.guild\")=? "
-                                           "AND json_extract(eventdata, \"$.member\")=? AND eventtype=?",
-                                           (ctx.guild.id, member.id, "unban")) as cur:
-                async for row in cur:
-                    await scheduler.canceltask(row[0])
+            await scheduler.cancel_matching("unban", ctx.guild.id, member.id)
 
     @commands.command(aliases=["deletewarn", "removewarn", "dwarn", "cancelwarn", "dw"])
     @mod_only()
@@ -649,6 +843,7 @@ class ModerationCog(commands.Cog, name="Moderation"):
                     f"❌ Failed to remove warning. Does warn #{warn_id} exist and is it from this server?")
             else:
                 await database.db.execute("UPDATE warnings SET deactivated=1 WHERE id=?", (warn_id,))
+                pointsledger.invalidate_ledger(ctx.guild.id, warn[0])
                 # update warns on thin ice
                 member = await ctx.guild.fetch_member(warn[0])
                 points = warn[1]
@@ -662,22 +857,22 @@ class ModerationCog(commands.Cog, name="Moderation"):
                         "UPDATE thin_ice SET warns_on_thin_ice = warns_on_thin_ice-? WHERE guild=? AND user=?",
                         (points, member.guild.id, member.id))
                 await database.db.commit()
-                user = await self.bot.fetch_user(warn[0])
+                user = await userresolver.get_user(self.bot, warn[0])
                 if user:
                     await ctx.reply(f"✔️ Removed warning #{warn_id} from {user.mention} (`{warn[2]}`)")
                     await modlog.modlog(f"{ctx.author.mention} (`{ctx.author}`) removed warning #{warn_id} from "
                                         f"{user.mention} ({user}). Warn text was `{warn[2]}`", ctx.guild.id,
                                         modid=ctx.author.id, userid=user.id)
                     try:
-                        await user.send(f"A warn you received in {ctx.guild.name} for was deleted. "
-                                        f"(`{warn[2]}`)")
+                        await outbound.send(user, f"A warn you received in {ctx.guild.name} for was deleted. "
+                                            f"(`{warn[2]}`)", priority=outbound.Priority.DM)
                     except (discord.Forbidden, discord.HTTPException, AttributeError) as e:
                         logger.debug("pass;" + str(e))
                 else:
                     await ctx.reply(f"✔️ Removed warning #{warn_id} from <@{warn[0]}> (`{warn[2]}`)")
                     await modlog.modlog(f"{ctx.author.mention} (`{ctx.author}`) removed warning #{warn_id} from "
-                                        f"{user.mention}. Warn text was `{warn[2]}`", ctx.guild.id,
-                                        modid=ctx.author.id, userid=user.id)
+                                        f"<@{warn[0]}>. Warn text was `{warn[2]}`", ctx.guild.id,
+                                        modid=ctx.author.id, userid=warn[0])
 
     @commands.command(aliases=["restorewarn", "undeletewarn", "udw"])
     @mod_only()
@@ -698,22 +893,23 @@ class ModerationCog(commands.Cog, name="Moderation"):
         else:
             await database.db.execute("UPDATE warnings SET deactivated=1 WHERE id=?", (warn_id,))
             await database.db.commit()
-            user = await self.bot.fetch_user(warn[0])
+            pointsledger.invalidate_ledger(ctx.guild.id, warn[0])
+            user = await userresolver.get_user(self.bot, warn[0])
             if user:
                 await ctx.reply(f"✔️ Restored warning #{warn_id} from {user.mention} (`{warn[2]}`)")
                 await modlog.modlog(f"{ctx.author.mention} (`{ctx.author}`) restored warning #{warn_id} from "
                                     f"{user.mention} ({user}). Warn text was `{warn[2]}`", ctx.guild.id,
                                     modid=ctx.author.id, userid=user.id)
                 try:
-                    await user.send(f"A previously deleted warn you received in {ctx.guild.name} was restored. "
-                                    f"(`{warn[2]}`)")
+                    await outbound.send(user, f"A previously deleted warn you received in {ctx.guild.name} was "
+                                        f"restored. (`{warn[2]}`)", priority=outbound.Priority.DM)
                 except (discord.Forbidden, discord.HTTPException, AttributeError) as e:
                     logger.debug("pass;" + str(e))
             else:
                 await ctx.reply(f"✔️ Removed warning #{warn_id} from <@{warn[0]}> (`{warn[2]}`)")
                 await modlog.modlog(f"{ctx.author.mention} (`{ctx.author}`) removed warning #{warn_id} from "
-                                    f"{user.mention}. Warn text was `{warn[2]}`", ctx.guild.id,
-                                    modid=ctx.author.id, userid=user.id)
+                                    f"<@{warn[0]}>. Warn text was `{warn[2]}`", ctx.guild.id,
+                                    modid=ctx.author.id, userid=warn[0])
 
     @commands.command(aliases=["w", "bite"])
     @mod_only()
@@ -731,28 +927,25 @@ class ModerationCog(commands.Cog, name="Moderation"):
         if points > 1:
             points = round(points, 1)
         now = datetime.now(tz=timezone.utc)
-        for member in members:
-            async with database.db.cursor() as cur:
-                cur: aiosqlite.Cursor
-                await cur.execute("INSERT INTO warnings(server, user, issuedby, issuedat, reason, points)"
-                                  "VALUES (?, ?, ?, ?, ?, ?)",
-                                  (ctx.guild.id, member.id, ctx.author.id,
-                                   int(now.timestamp()), reason, points))
-                insertedrow = cur.lastrowid
-            await database.db.commit()
+        pointstext = f"{points} infraction point{'' if points == 1 else 's'}"
+        pending = []
 
-            await ctx.reply(
-                f"Warned {member.mention} (warn ID `#{insertedrow}`) with {points} infraction point{'' if points == 1 else 's'} for: "
-                f"`{reason}`")
-            await modlog.modlog(f"{ctx.author.mention} (`{ctx.author}`) "
-                                f"warned {member.mention} (`{member}`) (warn ID `#{insertedrow}`) with {points}"
-                                f" infraction point{'' if points == 1 else 's'} for: "
-                                f"`{reason}`", ctx.guild.id, member.id, ctx.author.id)
-            try:
-                await member.send(f"You were warned in {ctx.guild.name} for `{reason}`.")
-            except (discord.Forbidden, discord.HTTPException, AttributeError) as e:
-                logger.debug("pass;" + str(e))
-            await on_warn(member, points)  # this handles autopunishments
+        async def pipeline(member: discord.Member) -> massaction.Outcome:
+            insertedrow = await warn_action(member, points, reason, ctx.author.id, now, pending)
+            return True, f"Warned {member.mention} (warn ID `#{insertedrow}`) with {pointstext} for: `{reason}`", \
+                   f"{ctx.author.mention} (`{ctx.author}`) warned {member.mention} (`{member}`) " \
+                   f"(warn ID `#{insertedrow}`) with {pointstext} for: `{reason}`"
+
+        try:
+            results = await massaction.run(ctx, "warn", members, pipeline)
+        finally:
+            # warnings that didn't set off a punishment (which commits on its own) are committed together
+            await database.db.commit()
+            await scheduler.schedule_many(pending)
+        await modlog.modlog_many([(member.id, logtext) for member, _, _, logtext in results], ctx.guild.id,
+                                 ctx.author.id, f"{ctx.author.mention} (`{ctx.author}`) warned "
+                                                f"{sum(r[1] for r in results)}/{len(results)} members with "
+                                                f"{pointstext} for: `{reason}`")
 
     @commands.command(aliases=["n", "modnote"])
     @mod_only()
@@ -794,6 +987,7 @@ class ModerationCog(commands.Cog, name="Moderation"):
                                   (ctx.guild.id, member.id, ctx.author.id,
                                    int(now.timestamp()), reason, points))
         await database.db.commit()
+        pointsledger.add_warning(ctx.guild.id, member.id, int(now.timestamp()), points)
         await ctx.reply(
             f"Created warn on <t:{int(now.timestamp())}:D> for {member.mention} with {points} infraction "
             f"point{'' if points == 1 else 's'} for: `{reason}`")
@@ -817,53 +1011,43 @@ class ModerationCog(commands.Cog, name="Moderation"):
 
         :param ctx: discord context
         :param member: the member to see the warns of.
-        :param page: if the user has more than 25 warns, this will let you see pages of warns.
+        :param page: if the user has more than 25 warns, this will let you see pages of warns. you can also use the
+        buttons to change pages.
         :param show_deleted: show deleted warns.
         :returns: list of warns
         """
         assert page > 0
         async with ctx.channel.typing():
-            embed = discord.Embed(title=f"Warns for {member.display_name}: Page {page}", color=discord.Color(0xB565D9),
-                                  description=member.mention)
-            deactivated_text = "" if show_deleted else "AND deactivated=0"
-            async with database.db.execute(f"SELECT id, issuedby, issuedat, reason, deactivated, points FROM warnings "
-                                           f"WHERE user=? AND server=? {deactivated_text} ORDER BY issuedat DESC "
-                                           f"LIMIT 25 OFFSET ?",
-                                           (member.id, ctx.guild.id, (page - 1) * 25)) as cursor:
-                # now = datetime.now(tz=timezone.utc)
-                async for warn in cursor:
-                    issuedby = await self.bot.fetch_user(warn[1])
-                    issuedat = warn[2]
-                    reason = warn[3]
-                    points = warn[5]
-                    add_long_field(embed,
-                                   name=f"Warn ID `#{warn[0]}`: {'%g' % points} point{'' if points == 1 else 's'}"
-                                        f"{' (Deleted)' if warn[4] else ''}",
-                                   value=
-                                   f"Reason: {reason}\n"
-                                   f"Issued by: {issuedby.mention}\n"
-                                   f"Issued <t:{int(issuedat)}:f> "
-                                   f"(<t:{int(issuedat)}:R>)", inline=False)
-            async with database.db.execute("SELECT count(*) FROM warnings WHERE user=? AND server=? AND deactivated=0",
-                                           (member.id, ctx.guild.id)) as cur:
-                warncount = (await cur.fetchone())[0]
-            async with database.db.execute("SELECT count(*) FROM warnings WHERE user=? AND server=? AND deactivated=1",
-                                           (member.id, ctx.guild.id)) as cur:
-                delwarncount = (await cur.fetchone())[0]
-            async with database.db.execute(
-                    "SELECT sum(points) FROM warnings WHERE user=? AND server=? AND deactivated=0",
-                    (member.id, ctx.guild.id)) as cur:
-                points = (await cur.fetchone())[0]
-                if points is None:
-                    points = 0
-            embed.description += f" has {'%g' % points} point{'' if points == 1 else 's'}, " \
-                                 f"{warncount} warn{'' if warncount == 1 else 's'} and " \
-                                 f"{delwarncount} deleted warn{'' if delwarncount == 1 else 's'}"
-            if not embed.fields:
-                embed.add_field(name="No Results", value="Try a different page # or show deleted warns.",
-                                inline=False)
-            for e in split_embed(embed):
-                await ctx.reply(embed=e)
+            async with database.db.execute("SELECT coalesce(sum(deactivated=0), 0), coalesce(sum(deactivated=1), 0), "
+                                           "total(CASE WHEN deactivated=0 THEN points END) FROM warnings "
+                                           "WHERE user=? AND server=?", (member.id, ctx.guild.id)) as cur:
+                warncount, delwarncount, points = await cur.fetchone()
+            description = f"{member.mention} has {'%g' % points} point{'' if points == 1 else 's'}, " \
+                          f"{warncount} warn{'' if warncount == 1 else 's'} and " \
+                          f"{delwarncount} deleted warn{'' if delwarncount == 1 else 's'}"
+
+            users = {}
+
+            async def prefetch(warns):
+                # every moderator on the page is resolved at once instead of one by one
+                users.update(await userresolver.resolve(self.bot, [warn[1] for warn in warns]))
+
+            def render(warns, number):
+                embed = discord.Embed(title=f"Warns for {member.display_name}: Page {number}",
+                                      color=discord.Color(0xB565D9), description=description)
+                for warn in warns:
+                    add_warn_field(embed, warn, users=users)
+                if not embed.fields:
+                    embed.add_field(name="No Results", value="Try a different page # or show deleted warns.",
+                                    inline=False)
+                return split_embed(embed)
+
+            view = paginator.KeysetView(ctx.author.id,
+                                        "SELECT id, issuedby, issuedat, reason, deactivated, points, issuedat, id "
+                                        "FROM warnings",
+                                        f"user=? AND server=? {'' if show_deleted else 'AND deactivated=0'}",
+                                        (member.id, ctx.guild.id), ["issuedat", "id"], render, 25, prefetch)
+            await view.start(ctx, page)
 
     @commands.command(aliases=["moderatorlogs", "modlog", "logs"])
     @mod_only()
@@ -873,41 +1057,128 @@ class ModerationCog(commands.Cog, name="Moderation"):
 
         :param ctx: discord context
         :param member: the member to see the modlogs of.
-        :param page: if the user has more than 10 modlogs, this will let you see pages of modlogs.
+        :param page: if the user has more than 10 modlogs, this will let you see pages of modlogs. you can also use the
+        buttons to change pages.
         :param viewmodactions: set to yes to view the actions the user took as moderator instead of actions taken
         against them.
         :returns: list of actions taken against them
         """
         assert page > 0
         async with ctx.channel.typing():
-            embed = discord.Embed(title=f"Modlogs for {member.display_name}: Page {page}",
-                                  color=discord.Color(0xB565D9), description=member.mention)
-            async with database.db.execute(f"SELECT text,datetime,user,moderator FROM modlog "
-                                           f"WHERE {'moderator' if viewmodactions else 'user'}=? AND guild=? "
-                                           f"ORDER BY datetime DESC LIMIT 10 OFFSET ?",
-                                           (member.id, ctx.guild.id, (page - 1) * 10)) as cursor:
-                now = datetime.now(tz=timezone.utc)
-                async for log in cursor:
-                    if log[2]:
-                        user: typing.Optional[discord.User] = await self.bot.fetch_user(log[2])
-                    else:
-                        user = None
-                    if log[3]:
-                        moderator: typing.Optional[discord.User] = await self.bot.fetch_user(log[3])
-                    else:
-                        moderator = None
-                    issuedat = log[1]
-                    text = log[0]
-                    add_long_field(embed,
-                                   name=f"<t:{int(issuedat)}:f> (<t:{int(issuedat)}:R>)",
-                                   value=
-                                   text + ("\n\n" if user or moderator else "") +
-                                   (f"**User**: {user.mention}\n" if user else "") +
-                                   (f"**Moderator**: {moderator.mention}\n" if moderator else ""), inline=False)
+            users = {}
+
+            async def prefetch(logs):
+                users.update(await userresolver.resolve(self.bot, [i for log in logs for i in log[2:4]]))
+
+            def render(logs, number):
+                embed = discord.Embed(title=f"Modlogs for {member.display_name}: Page {number}",
+                                      color=discord.Color(0xB565D9), description=member.mention)
+                for log in logs:
+                    add_modlog_field(embed, log, users)
                 if not embed.fields:
                     embed.add_field(name="No Results", value="Try a different page #.", inline=False)
-                for e in split_embed(embed):
-                    await ctx.reply(embed=e)
+                return split_embed(embed)
+
+            view = paginator.KeysetView(ctx.author.id,
+                                        "SELECT text, datetime, user, moderator, datetime, id FROM modlog",
+                                        f"{'moderator' if viewmodactions else 'user'}=? AND guild=?",
+                                        (member.id, ctx.guild.id), ["datetime", "id"], render, 10, prefetch)
+            await view.start(ctx, page)
+
+    @commands.command(aliases=["exportlogs", "exportwarns", "exportmodlogs"])
+    @mod_only()
+    async def exporthistory(self, ctx, file_format: typing.Optional[typing.Literal["csv", "jsonl"]] = "csv",
+                            member: typing.Optional[discord.User] = None,
+                            since: typing.Optional[date_converter] = None,
+                            until: typing.Optional[date_converter] = None):
+        """
+        Export the server's warns, modlogs and auto-punishments as compressed files.
+
+        :param ctx: discord context
+        :param file_format: `csv` for one .csv.gz per table or `jsonl` for one .jsonl.gz with every table.
+        :param member: only export the warns and modlogs of this member, including actions they took as moderator.
+        :param since: only export warns and modlogs from this date onwards, in YYYY-MM-DD format.
+        :param until: only export warns and modlogs up to and including this date, in YYYY-MM-DD format.
+        """
+        async with ctx.channel.typing():
+            files = await historyexport.export(ctx.guild.id, file_format, member.id if member else None, since,
+                                               until + timedelta(days=1) if until else None)
+            try:
+                sizes = [file.seek(0, 2) for file, _ in files]
+                for file, _ in files:
+                    file.seek(0)
+                if sum(sizes) > ctx.guild.filesize_limit:
+                    await ctx.reply(f"❌ Export is {humanize.naturalsize(sum(sizes))}, which is over this server's "
+                                    f"upload limit of {humanize.naturalsize(ctx.guild.filesize_limit)}. "
+                                    f"Try exporting one member or a shorter date range.")
+                    return
+                await ctx.reply(f"✔️ Exported moderation history of {ctx.guild.name}"
+                                f"{f' for {member.mention}' if member else ''}.",
+                                files=[discord.File(file, filename=filename) for file, filename in files])
+            finally:
+                for file, _ in files:
+                    file.close()
+
+    @commands.command(aliases=["searchlog", "searchmodlogs", "searchwarns", "findlogs"])
+    @mod_only()
+    async def searchlogs(self, ctx, source: typing.Optional[typing.Literal["modlogs", "warns"]] = "modlogs", *,
+                         query: str):
+        """
+        Search the server's modlogs or warn reasons, best matches first.
+
+        :param ctx: discord context
+        :param source: `modlogs` to search modlog text or `warns` to search warn reasons.
+        :param query: what to search for. words are matched separately, use `"quotes"` for a phrase, `word*` for
+        anything starting with word, and `OR`/`NOT` to combine searches. user IDs work to find mentions of them.
+        """
+        async with ctx.channel.typing():
+            users = {}
+            if source == "warns":
+                async def prefetch(warns):
+                    users.update(await userresolver.resolve(self.bot, [i for warn in warns for i in warn[:3:2]]))
+
+                def render(warns, number):
+                    embed = discord.Embed(title=f"Warns matching \"{query}\": Page {number}"[:256],
+                                          color=discord.Color(0xB565D9))
+                    for warn in warns:
+                        add_warn_field(embed, warn[1:], warn[0], users)
+                    if not embed.fields:
+                        embed.add_field(name="No Results", value="Try a different search.", inline=False)
+                    return split_embed(embed)
+
+                view = paginator.KeysetView(ctx.author.id,
+                                            "SELECT w.user, w.id, w.issuedby, w.issuedat, w.reason, w.deactivated, "
+                                            "w.points, -warnings_fts.rank, w.id "
+                                            "FROM warnings_fts JOIN warnings w ON w.id = warnings_fts.rowid",
+                                            "warnings_fts MATCH ? AND w.server=?",
+                                            (f'server : "{ctx.guild.id}" AND reason : ({query})', ctx.guild.id),
+                                            ["-warnings_fts.rank", "w.id"], render, 25, prefetch)
+            else:
+                async def prefetch(logs):
+                    users.update(await userresolver.resolve(self.bot, [i for log in logs for i in log[2:4]]))
+
+                def render(logs, number):
+                    embed = discord.Embed(title=f"Modlogs matching \"{query}\": Page {number}"[:256],
+                                          color=discord.Color(0xB565D9))
+                    for log in logs:
+                        add_modlog_field(embed, log, users)
+                    if not embed.fields:
+                        embed.add_field(name="No Results", value="Try a different search.", inline=False)
+                    return split_embed(embed)
+
+                view = paginator.KeysetView(ctx.author.id,
+                                            "SELECT m.text, m.datetime, m.user, m.moderator, -modlog_fts.rank, m.id "
+                                            "FROM modlog_fts JOIN modlog m ON m.id = modlog_fts.rowid",
+                                            "modlog_fts MATCH ? AND m.guild=?",
+                                            (f'guild : "{ctx.guild.id}" AND text : ({query})', ctx.guild.id),
+                                            ["-modlog_fts.rank", "m.id"], render, 10, prefetch)
+            try:
+                await view.start(ctx)
+            except sqlite3.OperationalError as e:
+                if not str(e).startswith("fts5:"):
+                    raise
+                view.stop()
+                raise commands.BadArgument(f"Invalid search `{query}`: {e}. Try putting it in \"quotes\".")
 
     def autopunishment_to_text(self, point_count, point_timespan, punishment_type, punishment_duration):
         punishment_type_future_tense = {
@@ -950,6 +1221,7 @@ class ModerationCog(commands.Cog, name="Moderation"):
             (ctx.guild.id, point_count, punishment_type, punishment_duration.total_seconds(),
              point_timespan.total_seconds()))
         await database.db.commit()
+        pointsledger.invalidate_rules(ctx.guild.id)
 
     @commands.command(aliases=["removeap", "delap", "deleteautopunishment", "rap", "dap"])
     @commands.guild_only()
@@ -965,6 +1237,7 @@ class ModerationCog(commands.Cog, name="Moderation"):
         cur = await database.db.execute("DELETE FROM auto_punishment WHERE warn_count=? AND guild=?",
                                         (point_count, ctx.guild.id))
         await database.db.commit()
+        pointsledger.invalidate_rules(ctx.guild.id)
         if cur.rowcount > 0:
             await ctx.reply(f"✔️ Removed rule for {point_count} point{'' if point_count == 1 else 's'}.")
             await modlog.modlog(f"{ctx.author.mention} (`{ctx.author}`) removed "
@@ -1,11 +1,22 @@
+import asyncio
+import time
 import typing
 from datetime import datetime, timezone
 
+import discord
 from discord.ext import commands
 
 import database
+import outbound
+from clogs import logger
 
 botcopy = commands.Bot
+COALESCE_WINDOW = 2  # seconds to collect modlog entries for before sending them as one message
+CHANNEL_CACHE_TTL = 600  # seconds to keep channels fetched over REST
+fetchedchannels: typing.Dict[int, typing.Tuple[discord.abc.Messageable, float]] = {}
+pending: typing.Dict[int, typing.List[str]] = {}  # channel ID -> modlog lines waiting to be sent
+delivering: typing.Set[asyncio.Task] = set()  # so deliveries aren't garbage collected while they wait
+channelcache: typing.Dict[int, typing.Set[int]] = {}  # guild ID -> its modlog channels
 
 
 class ModLogInitCog(commands.Cog):
@@ -15,15 +26,121 @@ class ModLogInitCog(commands.Cog):
         self.bot = bot
 
 
+async def get_channel(channelid: int) -> discord.abc.Messageable:
+    """
+    get a channel from the gateway cache, only falling back to the API if it's not there
+    :param channelid: ID of the channel
+    :return: the channel
+    """
+    channel = botcopy.get_channel(channelid)
+    if channel is not None:
+        return channel
+    cached = fetchedchannels.get(channelid)
+    if cached is not None and cached[1] > time.monotonic():
+        return cached[0]
+    channel = await botcopy.fetch_channel(channelid)
+    fetchedchannels[channelid] = (channel, time.monotonic() + CHANNEL_CACHE_TTL)
+    return channel
+
+
+def pack_lines(lines: typing.List[str], limit: int = 2000) -> typing.List[str]:
+    """
+    join lines into as few messages as possible
+    :param lines: lines of text
+    :param limit: max length of a message
+    :return: list of messages, none longer than limit
+    """
+    messages = []
+    current = ""
+    for line in lines:
+        while len(line) > limit:  # way too long to ever fit, give it its own message(s)
+            if current:
+                messages.append(current)
+                current = ""
+            messages.append(line[:limit])
+            line = line[limit:]
+        if current and len(current) + 1 + len(line) > limit:
+            messages.append(current)
+            current = line
+        else:
+            current = f"{current}\n{line}" if current else line
+    if current:
+        messages.append(current)
+    return messages
+
+
+async def deliver(channelid: int):
+    await asyncio.sleep(COALESCE_WINDOW)
+    lines = pending.pop(channelid)
+    try:
+        channel = await get_channel(channelid)
+        for message in pack_lines(lines):
+            await outbound.send(channel, message, priority=outbound.Priority.MODERATION)
+    except (discord.NotFound, discord.Forbidden) as e:
+        fetchedchannels.pop(channelid, None)
+        logger.warning(f"Couldn't deliver {len(lines)} modlog entries to {channelid}: {e}")
+    except Exception as e:
+        logger.error(e, exc_info=(type(e), e, e.__traceback__))
+
+
+def queue(channelid: int, line: str):
+    # entries that arrive within COALESCE_WINDOW of each other get sent together
+    if channelid not in pending:
+        pending[channelid] = []
+        task = asyncio.create_task(deliver(channelid))
+        delivering.add(task)
+        task.add_done_callback(delivering.discard)
+    pending[channelid].append(line)
+
+
+async def logchannels(guildid: int) -> typing.Set[int]:
+    """
+    get the channels modlog entries of a guild go to, only hitting the database the first time
+    :param guildid: ID of the guild
+    :return: IDs of the channels, empty if the guild has no modlog channel
+    """
+    channels = channelcache.get(guildid)
+    if channels is None:
+        async with database.db.execute("SELECT log_channel,bulk_log_channel FROM server_config WHERE guild=?",
+                                       (guildid,)) as cur:
+            modlogchannel = await cur.fetchone()
+        if modlogchannel is None or modlogchannel[0] is None:
+            channels = set()
+        else:
+            channels = {ch for ch in modlogchannel if ch is not None}  # send to normal and bulk
+        channelcache[guildid] = channels
+    return channels
+
+
+def invalidate_channels(guildid: int):
+    """call after changing log_channel or bulk_log_channel of a guild"""
+    channelcache.pop(guildid, None)
+
+
 async def modlog(msg: str, guildid: int, userid: typing.Optional[int] = None, modid: typing.Optional[int] = None):
     await database.db.execute("INSERT INTO modlog(guild,user,moderator,text,datetime) VALUES (?,?,?,?,?)",
                               (guildid, userid, modid, msg, datetime.now(tz=timezone.utc).timestamp()))
     await database.db.commit()
-    async with database.db.execute("SELECT log_channel,bulk_log_channel FROM server_config WHERE guild=?",
-                                   (guildid,)) as cur:
-        modlogchannel = await cur.fetchone()
-    if modlogchannel is None or modlogchannel[0] is None:
+    for ch in await logchannels(guildid):
+        queue(ch, "**[ModLog]** " + msg)
+
+
+async def modlog_many(entries: typing.List[typing.Tuple[typing.Optional[int], str]], guildid: int,
+                      modid: typing.Optional[int] = None, summary: typing.Optional[str] = None):
+    """
+    log many actions at once, such as a mass ban
+    :param entries: (user ID, text) of every action, each is stored so it shows up in that user's modlogs
+    :param guildid: ID of the guild
+    :param modid: ID of the moderator
+    :param summary: sent to the modlog channel instead of every entry, if there's more than one
+    """
+    if not entries:
         return
-    for ch in modlogchannel:  # send to normal and bulk
-        channel = await botcopy.fetch_channel(ch)
-        await channel.send("**[ModLog]** " + msg, )
+    now = datetime.now(tz=timezone.utc).timestamp()
+    await database.db.executemany("INSERT INTO modlog(guild,user,moderator,text,datetime) VALUES (?,?,?,?,?)",
+                                  [(guildid, userid, modid, msg, now) for userid, msg in entries])
+    await database.db.commit()
+    lines = [summary] if summary is not None and len(entries) > 1 else [msg for _, msg in entries]
+    for ch in await logchannels(guildid):
+        for line in lines:
+            queue(ch, "**[ModLog]** " + line)
@@ -0,0 +1,169 @@
+import asyncio
+import collections
+import enum
+import heapq
+import itertools
+import time
+import typing
+
+import discord
+
+from clogs import logger
+
+T = typing.TypeVar("T")
+
+
+class Priority(enum.IntEnum):
+    INTERACTIVE = 0  # replies to commands
+    MODERATION = 1  # moderator facing messages, like the modlog and verification
+    LOG = 2  # bulk log, scheduled messages
+    DM = 3  # notifying users
+
+
+GLOBAL_RATE = 40  # requests per second across every bucket, a bit under discord's global limit of 50
+# tokens each priority has to leave in the global limiter for higher priorities
+RESERVE = {Priority.INTERACTIVE: 0, Priority.MODERATION: 0, Priority.LOG: 10, Priority.DM: 20}
+# once this many messages are queued in total, new messages of these priorities are dropped
+SHED_DEPTH = {Priority.LOG: 500, Priority.DM: 1000}
+LATENCY_SAMPLES = 500  # recent sends per priority kept for latency stats
+
+
+class Job:
+    __slots__ = ("factory", "priority", "future", "submitted")
+
+    def __init__(self, factory: typing.Callable[[], typing.Awaitable], priority: Priority):
+        self.factory = factory
+        self.priority = priority
+        self.future = asyncio.get_running_loop().create_future()
+        self.submitted = time.monotonic()
+
+
+class GlobalLimiter:
+    """token bucket shared by every bucket, lower priorities can't use the last few tokens"""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+    async def acquire(self, priority: Priority):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            needed = 1 + RESERVE[priority]
+            if self.tokens >= needed:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((needed - self.tokens) / self.rate)
+
+
+class Gateway:
+    """
+    every outgoing message goes through here. each bucket (a channel or a DM) is sent to in order of priority by its
+    own worker so one busy channel can't hold up the others, and a priority aware global limiter stops bursts
+    from hitting discord's global rate limit.
+    """
+
+    def __init__(self):
+        self.buckets: typing.Dict[typing.Hashable, typing.List[typing.Tuple[int, int, Job]]] = {}
+        self.workers: typing.Dict[typing.Hashable, asyncio.Task] = {}
+        self.limiter = GlobalLimiter(GLOBAL_RATE)
+        self.order = itertools.count()
+        self.depth = 0
+        self.sent = collections.Counter()
+        self.shed = collections.Counter()
+        self.failed = collections.Counter()
+        self.latency: typing.Dict[Priority, typing.Deque[float]] = {p: collections.deque(maxlen=LATENCY_SAMPLES)
+                                                                    for p in Priority}
+
+    async def submit(self, factory: typing.Callable[[], typing.Awaitable[T]], bucket: typing.Hashable,
+                     priority: Priority) -> typing.Optional[T]:
+        """
+        queue an API call
+        :param factory: makes the coroutine to run, only called once it's this job's turn
+        :param bucket: jobs with the same bucket are ran one at a time, usually the channel ID
+        :param priority: priority of the job
+        :return: whatever the coroutine returns, or None if the job was dropped because too much is queued
+        """
+        if priority in SHED_DEPTH and self.depth >= SHED_DEPTH[priority]:
+            self.shed[priority] += 1
+            logger.warning(f"{self.depth} messages queued, dropped a {priority.name} message to {bucket}")
+            return None
+        job = Job(factory, priority)
+        heapq.heappush(self.buckets.setdefault(bucket, []), (priority, next(self.order), job))
+        self.depth += 1
+        if bucket not in self.workers:
+            self.workers[bucket] = asyncio.create_task(self.worker(bucket))
+        return await job.future
+
+    async def worker(self, bucket: typing.Hashable):
+        queue = self.buckets[bucket]
+        try:
+            while queue:
+                _, _, job = heapq.heappop(queue)
+                self.depth -= 1
+                await self.limiter.acquire(job.priority)
+                self.latency[job.priority].append(time.monotonic() - job.submitted)
+                try:
+                    result = await job.factory()
+                except Exception as e:
+                    self.failed[job.priority] += 1
+                    if not job.future.done():
+                        job.future.set_exception(e)
+                else:
+                    self.sent[job.priority] += 1
+                    if not job.future.done():
+                        job.future.set_result(result)
+        except Exception as e:
+            logger.error(e, exc_info=(type(e), e, e.__traceback__))
+        finally:
+            del self.buckets[bucket]
+            del self.workers[bucket]
+
+    def stats(self) -> typing.Dict[Priority, dict]:
+        """queue depth, counters and latency in seconds from submitting to sending, per priority"""
+        queued = collections.Counter(job.priority for queue in self.buckets.values() for _, _, job in queue)
+        out = {}
+        for priority in Priority:
+            samples = sorted(self.latency[priority])
+            out[priority] = {
+                "queued": queued[priority],
+                "sent": self.sent[priority],
+                "failed": self.failed[priority],
+                "shed": self.shed[priority],
+                "latency_avg": sum(samples) / len(samples) if samples else 0,
+                "latency_p95": samples[int(len(samples) * 0.95)] if samples else 0
+            }
+        return out
+
+
+gateway = Gateway()
+replystats = collections.Counter()  # replies and how many fell back to a normal message, counted by main.safe_reply
+
+
+def bucket_of(destination: discord.abc.Messageable) -> typing.Hashable:
+    if isinstance(destination, discord.abc.User):
+        return "dm", destination.id
+    return destination.id
+
+
+async def submit(factory: typing.Callable[[], typing.Awaitable[T]], bucket: typing.Hashable,
+                 priority: Priority) -> typing.Optional[T]:
+    return await gateway.submit(factory, bucket, priority)
+
+
+async def send(destination: discord.abc.Messageable, *args, priority: Priority = Priority.LOG,
+               **kwargs) -> typing.Optional[discord.Message]:
+    """
+    send a message through the gateway, takes the same arguments as discord.abc.Messageable.send()
+    :param destination: channel, user or member to send to
+    :param priority: priority of the message
+    :return: the sent message, or None if it was dropped
+    """
+    message = await gateway.submit(lambda: destination.send(*args, **kwargs), bucket_of(destination), priority)
+    if message is None:  # dropped, sending would have closed the files
+        for f in kwargs.get("files") or [kwargs.get("file")]:
+            if f is not None:
+                f.close()
+    return message
@@ -0,0 +1,127 @@
+import typing
+
+import discord
+
+import database
+from embedutils import pack_embeds
+
+Row = typing.Tuple
+
+
+async def fetch_rows(select: str, where: str, params: tuple, key: typing.List[str], cursor: typing.Optional[Row],
+                     backwards: bool, limit: int, offset: int = 0) -> typing.Tuple[typing.List[Row], bool]:
+    """
+    get a page of rows ordered newest first by key, continuing from a cursor instead of using OFFSET so deep pages
+    don't rescan every row before them
+    :param select: SELECT ... FROM ..., the last len(key) columns selected must be the key columns
+    :param where: WHERE clause without the WHERE
+    :param params: params of the WHERE clause
+    :param key: columns that uniquely order the rows, like ["issuedat", "id"]
+    :param cursor: key of the row to continue from, or None to start from the newest row
+    :param backwards: get the rows before the cursor instead of after
+    :param limit: rows per page
+    :param offset: rows to skip, only used to jump to a page number when there's no cursor yet
+    :return: the rows newest first, and whether there are more rows in that direction
+    """
+    if cursor is not None:
+        where += f" AND ({', '.join(key)}) {'>' if backwards else '<'} ({', '.join('?' * len(cursor))})"
+        params += tuple(cursor)
+    order = ", ".join(f"{col} {'ASC' if backwards else 'DESC'}" for col in key)
+    async with database.db.execute(f"{select} WHERE {where} ORDER BY {order} LIMIT ? OFFSET ?",
+                                   params + (limit + 1, offset)) as cur:
+        rows = await cur.fetchall()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if backwards:
+        rows.reverse()
+    return rows, more
+
+
+class KeysetView(discord.ui.View):
+    """previous/next buttons for results paged with fetch_rows(), the view keeps the cursors of the current page"""
+
+    def __init__(self, author: int, select: str, where: str, params: tuple, key: typing.List[str],
+                 render: typing.Callable[[typing.List[Row], int], typing.List[discord.Embed]], limit: int,
+                 prefetch: typing.Optional[typing.Callable[[typing.List[Row]], typing.Awaitable]] = None):
+        """
+        :param author: ID of the user allowed to use the buttons
+        :param render: turns a page of rows and its page number into embeds
+        :param prefetch: awaited with every page of rows before it's rendered, to look up what render needs in one go
+        see fetch_rows() for the rest
+        """
+        super().__init__(timeout=300)
+        self.author = author
+        self.select = select
+        self.where = where
+        self.params = params
+        self.key = key
+        self.render = render
+        self.limit = limit
+        self.prefetch = prefetch
+        self.number = 1
+        self.first: typing.Optional[Row] = None
+        self.last: typing.Optional[Row] = None
+        self.message: typing.Optional[discord.Message] = None
+
+    async def load(self, cursor: typing.Optional[Row], backwards: bool, offset: int = 0) -> typing.List[discord.Embed]:
+        rows, more = await fetch_rows(self.select, self.where, self.params, self.key, cursor, backwards, self.limit,
+                                      offset)
+        if self.prefetch is not None:
+            await self.prefetch(rows)
+        messages = pack_embeds(self.render(rows, self.number))
+        # a message can only have 6000 chars of embeds, end the page early if it doesn't fit.
+        # the next page continues from the last row shown so nothing is skipped.
+        while len(messages) > 1 and len(rows) > 1:
+            more = True
+            rows = rows[1:] if backwards else rows[:-1]
+            messages = pack_embeds(self.render(rows, self.number))
+        if rows:
+            self.first = rows[0][-len(self.key):]
+            self.last = rows[-1][-len(self.key):]
+        elif cursor is None:  # jumped past the last page, nothing to continue from
+            self.previous.disabled = self.next.disabled = True
+            return messages[0]
+        if backwards:
+            self.previous.disabled = not more
+            self.next.disabled = False
+        else:
+            self.previous.disabled = cursor is None and offset == 0
+            self.next.disabled = not more
+        return messages[0]
+
+    async def start(self, ctx, page: int = 1):
+        self.number = page
+        embeds = await self.load(None, False, (page - 1) * self.limit)
+        if self.previous.disabled and self.next.disabled:  # only one page, no need for buttons
+            self.stop()
+            await ctx.reply(embeds=embeds)
+        else:
+            self.message = await ctx.reply(embeds=embeds, view=self)
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        if interaction.user.id != self.author:
+            await interaction.response.send_message("❌ Only the person who ran the command can change pages.",
+                                                    ephemeral=True)
+            return False
+        return True
+
+    async def on_timeout(self):
+        self.previous.disabled = True
+        self.next.disabled = True
+        if self.message is not None:
+            try:
+                await self.message.edit(view=self)
+            except discord.HTTPException:
+                pass
+
+    @discord.ui.button(label="Previous", emoji="⬅️", style=discord.ButtonStyle.secondary)
+    async def previous(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.number -= 1
+        embeds = await self.load(self.first, True)
+        await interaction.response.edit_message(embeds=embeds, view=self)
+
+    @discord.ui.button(label="Next", emoji="➡️", style=discord.ButtonStyle.secondary)
+    async def next(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.number += 1
+        embeds = await self.load(self.last, False)
+        await interaction.response.edit_message(embeds=embeds, view=self)
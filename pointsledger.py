@@ -0,0 +1,112 @@
+import bisect
+import collections
+import itertools
+import typing
+
+import database
+
+LEDGER_SIZE = 10000  # (guild, user) ledgers kept in memory
+
+
+class Ledger:
+    """active warnings of one member sorted by time, with prefix sums so points since any time is a binary search"""
+    __slots__ = ("times", "prefix")
+
+    def __init__(self, warnings: typing.List[typing.Tuple[float, float]]):
+        """
+        :param warnings: (issuedat, points) of every active warning, sorted by issuedat
+        """
+        self.times = [issuedat for issuedat, _ in warnings]
+        self.prefix = [0.0] + list(itertools.accumulate(points for _, points in warnings))
+
+    def points_since(self, cutoff: typing.Optional[float]) -> typing.Optional[float]:
+        """
+        :param cutoff: only count warnings issued after this time, None for all of them
+        :return: sum of points, or None if there are no warnings to count
+        """
+        start = 0 if cutoff is None else bisect.bisect_right(self.times, cutoff)
+        if start == len(self.times):
+            return None
+        return self.prefix[-1] - self.prefix[start]
+
+
+class Rule:
+    __slots__ = ("warn_count", "punishment_type", "punishment_duration", "warn_timespan")
+
+    def __init__(self, warn_count: int, punishment_type: str, punishment_duration: typing.Optional[float],
+                 warn_timespan: typing.Optional[float]):
+        self.warn_count = warn_count
+        self.punishment_type = punishment_type
+        self.punishment_duration = punishment_duration
+        self.warn_timespan = warn_timespan
+
+
+ledgers: typing.OrderedDict[typing.Tuple[int, int], Ledger] = collections.OrderedDict()
+rules: typing.Dict[int, typing.List[Rule]] = {}
+
+
+async def get_ledger(guildid: int, userid: int) -> Ledger:
+    key = (guildid, userid)
+    ledger = ledgers.get(key)
+    if ledger is None:
+        async with database.db.execute("SELECT issuedat, points FROM warnings WHERE server=? AND user=? "
+                                       "AND deactivated=0 ORDER BY issuedat", key) as cur:
+            ledger = Ledger(await cur.fetchall())
+        ledgers[key] = ledger
+        if len(ledgers) > LEDGER_SIZE:
+            ledgers.popitem(last=False)
+    else:
+        ledgers.move_to_end(key)
+    return ledger
+
+
+def add_warning(guildid: int, userid: int, issuedat: float, points: float):
+    """call after inserting a warning"""
+    ledger = ledgers.get((guildid, userid))
+    if ledger is None:
+        return
+    if ledger.times and issuedat < ledger.times[-1]:  # backdated with oldwarn, easier to just reload
+        invalidate_ledger(guildid, userid)
+    else:
+        ledger.times.append(issuedat)
+        ledger.prefix.append(ledger.prefix[-1] + points)
+
+
+def invalidate_ledger(guildid: int, userid: int):
+    """call after deleting or restoring a warning"""
+    ledgers.pop((guildid, userid), None)
+
+
+async def get_rules(guildid: int) -> typing.List[Rule]:
+    guildrules = rules.get(guildid)
+    if guildrules is None:
+        # same order as the old query, ORDER BY punishment_duration, punishment_type DESC
+        async with database.db.execute("SELECT warn_count, punishment_type, punishment_duration, warn_timespan "
+                                       "FROM auto_punishment WHERE guild=? "
+                                       "ORDER BY punishment_duration, punishment_type DESC", (guildid,)) as cur:
+            guildrules = rules[guildid] = [Rule(*row) for row in await cur.fetchall()]
+    return guildrules
+
+
+def invalidate_rules(guildid: int):
+    """call after adding or removing an auto-punishment"""
+    rules.pop(guildid, None)
+
+
+async def triggered_rule(guildid: int, userid: int, now: float, issued_points: float) -> typing.Optional[Rule]:
+    """
+    find the auto-punishment a warn just triggered
+    :param guildid: ID of the guild
+    :param userid: ID of the warned user
+    :param now: current timestamp
+    :param issued_points: points of the warn that was just given
+    :return: the first rule (by shortest punishment) whose point count was just crossed, or None
+    """
+    ledger = await get_ledger(guildid, userid)
+    for rule in await get_rules(guildid):
+        if rule.warn_timespan is None:
+            continue
+        total = ledger.points_since(None if rule.warn_timespan == 0 else now - rule.warn_timespan)
+        if total is not None and total >= rule.warn_count > total - issued_points:
+            return rule
+    return None
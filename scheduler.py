@@ -1,5 +1,8 @@
 import asyncio
+import itertools
 import json
+import typing
+from collections import defaultdict
 from datetime import datetime, timedelta, timezone
 
 import discord
@@ -9,11 +12,27 @@ from discord.ext import commands
 
 import database
 import modlog
+import outbound
+import userresolver
 from clogs import logger
+from timingwheel import TimingWheel
 
 scheduler = TimedScheduler(prefer_utc=True)
+# non-durable events sooner than this skip the database and aioscheduler and go on the timing wheel instead
+EPHEMERAL_THRESHOLD = timedelta(hours=1)
+# events due sooner than this are ran right away instead of being given to aioscheduler, which only takes times
+# that are still in the future by the time it gets them
+DUE_MARGIN = timedelta(seconds=1)
+# events running outside of aioscheduler, kept referenced until they finish
+duetasks: typing.Set[asyncio.Task] = set()
+wheel = TimingWheel(tasks=duetasks)
+ephemeral_ids = itertools.count(-1, -1)  # wheel events get negative IDs so they never collide with row IDs
+BIRTHDAY_CHANNEL_CONCURRENCY = 2  # birthday channels created at once during a sweep
 botcopy: commands.Bot
 loadedtasks = dict()  # keep track of task objects to cancel if needed.
+# (eventtype, guild, member/user) -> IDs of pending events, so callers can cancel by what an event is about
+eventindex: typing.DefaultDict[tuple, typing.Set[int]] = defaultdict(set)
+eventkeys: typing.Dict[int, tuple] = dict()
 
 
 class ScheduleInitCog(commands.Cog):
@@ -23,30 +42,121 @@ class ScheduleInitCog(commands.Cog):
         self.bot = bot
 
 
+def every(interval: timedelta, until: typing.Optional[datetime] = None) -> dict:
+    """
+    recurrence rule for an event that repeats every interval
+    :param interval: time between occurrences
+    :param until: if specified, no occurrences will be scheduled at or after this time
+    :return: recurrence rule to pass to schedule()
+    """
+    return {"every": interval.total_seconds(), "until": until.timestamp() if until else None}
+
+
+def next_occurrence(recurrence: dict, last: datetime) -> typing.Optional[datetime]:
+    """
+    calculate when a recurring event should next run
+    :param recurrence: recurrence rule made by every()
+    :param last: the time the event was scheduled for this time
+    :return: the next time after now the event should run, or None if it shouldn't run again
+    """
+    now = datetime.now(tz=timezone.utc)
+    if "every" in recurrence:
+        interval = timedelta(seconds=recurrence["every"])
+        nextrun = last + interval
+        if nextrun <= now:  # skip occurrences missed while offline instead of running them all at once
+            nextrun += interval * ((now - nextrun) // interval + 1)
+        if recurrence["until"] is not None and nextrun.timestamp() >= recurrence["until"]:
+            return None
+        return nextrun
+    else:
+        logger.error(f"Unknown recurrence rule {recurrence}")
+        return None
+
+
+def index_key(eventtype: str, eventdata: dict) -> tuple:
+    return eventtype, eventdata.get("guild"), eventdata.get("member", eventdata.get("user"))
+
+
+def track(eventid: int, eventtype: str, eventdata: dict, task):
+    loadedtasks[eventid] = task
+    key = index_key(eventtype, eventdata)
+    eventkeys[eventid] = key
+    eventindex[key].add(eventid)
+
+
+def untrack(eventid: int) -> bool:
+    """
+    forget about a pending event
+    :return: False if the event wasn't pending (i.e. it was cancelled)
+    """
+    if eventid not in loadedtasks:
+        return False
+    del loadedtasks[eventid]
+    key = eventkeys.pop(eventid)
+    eventindex[key].discard(eventid)
+    if not eventindex[key]:
+        del eventindex[key]
+    return True
+
+
+def register(dbrowid: int, time: datetime, eventtype: str, eventdata: dict,
+             recurrence: typing.Optional[dict] = None):
+    if time - datetime.now(tz=timezone.utc) < DUE_MARGIN:
+        # aioscheduler refuses times in the past, run events that are already due straight away
+        task = asyncio.create_task(run_event(dbrowid, eventtype, eventdata, recurrence, time))
+        # run_event untracks the event before it's done
+        duetasks.add(task)
+        task.add_done_callback(duetasks.discard)
+        track(dbrowid, eventtype, eventdata, task)
+        return
+    timef = time.astimezone(tz=timezone.utc).replace(tzinfo=None)
+    track(dbrowid, eventtype, eventdata,
+          scheduler.schedule(run_event(dbrowid, eventtype, eventdata, recurrence, time), timef))
+
+
 async def start():
     logger.debug("starting scheduler")
     scheduler.start()
-    async with database.db.execute("SELECT id, eventtime, eventtype, eventdata FROM schedule") as cursor:
-        async for event in cursor:
-            data = json.loads(event[3])
-            dt = datetime.fromtimestamp(event[1], tz=timezone.utc)
-            if dt <= datetime.now(tz=timezone.utc):
-                logger.debug(f"running missed event #{event[0]}")
-                loadedtasks[event[0]] = task  # not needed but easier to put this here than to ignore the exception
-                await run_event(event[0], event[2], data)
-            else:
-                logger.debug(f"scheduling stored event #{event[0]}")
-                task = scheduler.schedule(run_event(event[0], event[2], data), dt.replace(tzinfo=None))
-                loadedtasks[event[0]] = task
+    wheel.start()
+    async with database.db.execute("SELECT id, eventtime, eventtype, eventdata, recurrence FROM schedule") as cursor:
+        events = await cursor.fetchall()
+    for event in events:
+        data = json.loads(event[3])
+        recurrence = json.loads(event[4]) if event[4] is not None else None
+        dt = datetime.fromtimestamp(event[1], tz=timezone.utc)
+        if dt <= datetime.now(tz=timezone.utc):
+            logger.debug(f"running missed event #{event[0]}")
+            track(event[0], event[2], data, None)
+            await run_event(event[0], event[2], data, recurrence, dt)
+        else:
+            logger.debug(f"scheduling stored event #{event[0]}")
+            register(event[0], dt, event[2], data, recurrence)
+    if ("birthday_sweep", None, None) not in eventindex:
+        nexthour = datetime.now(tz=timezone.utc).replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+        await schedule(nexthour, "birthday_sweep", {}, every(timedelta(hours=1)))
 
 
-async def run_event(dbrowid, eventtype: str, eventdata: dict):
+async def run_event(dbrowid, eventtype: str, eventdata: dict, recurrence: typing.Optional[dict] = None,
+                    eventtime: typing.Optional[datetime] = None):
     try:
+        if dbrowid is not None and not untrack(dbrowid):
+            # cancelled events are left in aioscheduler's queue rather than searched for, they just do nothing
+            logger.debug(f"Skipping cancelled event #{dbrowid}")
+            return
         logger.debug(f"Running Event #{dbrowid} type {eventtype} data {eventdata}")
-        if dbrowid is not None:
-            await database.db.execute("DELETE FROM schedule WHERE id=?", (dbrowid,))
+        if dbrowid is not None and dbrowid > 0:
+            nextrun = next_occurrence(recurrence, eventtime) if recurrence else None
+            if nextrun is None:
+                await database.db.execute("DELETE FROM schedule WHERE id=?", (dbrowid,))
+            else:
+                # recurring events keep their row, moving it to the next occurrence in the same statement
+                # means a crash can never lose the chain
+                await database.db.execute("UPDATE schedule SET eventtime=? WHERE id=?",
+                                          (nextrun.timestamp(), dbrowid))
             await database.db.commit()
-        del loadedtasks[dbrowid]
+            if nextrun is not None:
+                register(dbrowid, nextrun, eventtype, eventdata, recurrence)
+                logger.debug(f"event #{dbrowid} will recur at {nextrun}")
         if eventtype == "debug":
             logger.debug("Hello world! (debug event)")
         elif eventtype == "message":
@@ -54,85 +164,69 @@ async def run_event(dbrowid, eventtype: str, eventdata: dict):
             try:
                 ch = await botcopy.fetch_channel(ch)
             except discord.errors.NotFound:
-                ch = await botcopy.fetch_user(ch)
-            await ch.send(eventdata["message"])
+                ch = await userresolver.get_user(botcopy, ch)
+                if ch is None:
+                    logger.warning(f"Couldn't send event #{dbrowid}'s message, {eventdata['channel']} doesn't exist.")
+                    return
+            await outbound.send(ch, eventdata["message"], priority=outbound.Priority.LOG)
         elif eventtype == "unban":
             guild, member = await asyncio.gather(botcopy.fetch_guild(eventdata["guild"]),
-                                                 botcopy.fetch_user(eventdata["member"]))
+                                                 userresolver.get_user(botcopy, eventdata["member"]))
+            if member is None:
+                # the account is gone, the ban still has to be lifted but there's nobody to DM
+                logger.info(f"user {eventdata['member']} of event #{dbrowid} doesn't exist, not DMing them.")
+                await asyncio.gather(guild.unban(discord.Object(eventdata["member"]), reason="End of temp-ban."),
+                                     modlog.modlog(f"<@{eventdata['member']}> was automatically unbanned.", guild.id,
+                                                   eventdata["member"]))
+                return
             await asyncio.gather(guild.unban(member, reason="End of temp-ban."),
-                                 member.send(f"You were unbanned in **{guild.name}**."),
+                                 outbound.send(member, f"You were unbanned in **{guild.name}**.",
+                                               priority=outbound.Priority.DM),
                                  modlog.modlog(f"{member.mention} (`{member}`) "
                                                f"was automatically unbanned.", guild.id, member.id))
         elif eventtype == "unmute":
             # purely cosmetic
             guild = await botcopy.fetch_guild(eventdata["guild"])
             member = await guild.fetch_member(eventdata["member"])
-            await asyncio.gather(member.send(f"You were unmuted in **{guild.name}**."),
+            await asyncio.gather(outbound.send(member, f"You were unmuted in **{guild.name}**.",
+                                               priority=outbound.Priority.DM),
                                  modlog.modlog(f"{member.mention} (`{member}`) "
                                                f"was automatically unmuted.", guild.id, member.id))
         elif eventtype == "refresh_mute":
-            guild = await botcopy.fetch_guild(eventdata["guild"])
-            member = await guild.fetch_member(eventdata["member"])
-            if eventdata["muteend"] is None:
-                await member.edit(timed_out_until=datetime.now(tz=timezone.utc) + timedelta(days=28))
-                await schedule(datetime.now(tz=timezone.utc) + timedelta(days=28), "refresh_mute",
-                               {"guild": member.guild.id, "member": member.id, "muteend": None})
-                logger.debug(f"Refreshed {member}'s permanent mute in {guild}")
-            else:
-                muteend = datetime.fromtimestamp(eventdata["muteend"], tz=timezone.utc)
-                if muteend - datetime.now(tz=timezone.utc) > timedelta(days=28):
-                    await member.edit(timed_out_until=datetime.now(tz=timezone.utc) + timedelta(days=28))
-                    await schedule(datetime.now(tz=timezone.utc) + timedelta(days=28),
-                                   "refresh_mute",
-                                   {"guild": member.guild.id, "member": member.id, "muteend": eventdata["muteend"]})
-                    logger.debug(f"Refreshed {member}'s mute in {guild}. ends {muteend}")
-                else:
-                    await member.edit(timed_out_until=muteend)
-                    await schedule(muteend, "unmute", {"guild": member.guild.id, "member": member.id})
-                    logger.debug(f"Refreshed {member}'s mute for the last time in {guild}. ends {muteend}")
+            # recurs every 28 days until the mute ends, the end of the mute has its own "unmute" event
+            try:
+                guild = await botcopy.fetch_guild(eventdata["guild"])
+                member = await guild.fetch_member(eventdata["member"])
+            except discord.NotFound:
+                # the row already moved on to the next refresh, without this it would recur forever for a permanent
+                # mute of someone who left
+                await cancel_matching(["unmute", "refresh_mute"], eventdata["guild"], eventdata["member"])
+                logger.debug(f"Stopped refreshing {eventdata['member']}'s mute in {eventdata['guild']}, "
+                             f"they or the guild are gone.")
+                return
+            timeoutend = datetime.now(tz=timezone.utc) + timedelta(days=28)
+            if eventdata["muteend"] is not None:
+                timeoutend = min(timeoutend, datetime.fromtimestamp(eventdata["muteend"], tz=timezone.utc))
+            await member.edit(timed_out_until=timeoutend)
+            logger.debug(f"Refreshed {member}'s mute in {guild}. timed out until {timeoutend}")
 
         elif eventtype == "un_thin_ice":
             guild = await botcopy.fetch_guild(eventdata["guild"])
             member = await guild.fetch_member(eventdata["member"])
             await asyncio.gather(member.remove_roles(discord.Object(eventdata["thin_ice_role"])),
-                                 member.send(f"Your thin ice has expired in **{guild.name}**."),
+                                 outbound.send(member, f"Your thin ice has expired in **{guild.name}**.",
+                                               priority=outbound.Priority.DM),
                                  modlog.modlog(f"{member.mention}'s (`{member}`) "
                                                f"thin ice has expired.", guild.id, member.id))
             await database.db.execute("DELETE FROM thin_ice WHERE guild=? and user=?", (guild.id, member.id))
             await database.db.commit()
-        elif eventtype == "birthday":
-            now = datetime.now(tz=timezone.utc)
-            birthday = datetime.fromtimestamp(eventdata["birthday"], tz=timezone.utc)
-            age = round((now - birthday).days / 365.25)
-            createdchannels = []
-            for guild in botcopy.guilds:
-                async with database.db.execute("SELECT birthday_category FROM server_config WHERE guild=?",
-                                               (guild.id,)) as cur:
-                    bcategory = await cur.fetchone()
-                if bcategory is not None:
-                    member = guild.get_member(eventdata["user"])
-                    bcategoryreal: discord.CategoryChannel = guild.get_channel(bcategory[0])
-                    if bcategoryreal is not None and member is not None:
-                        dname = ''.join(c for c in member.display_name.lower() if c.isalnum() or c == "-")
-                        bchannel = await bcategoryreal.create_text_channel(f"🎂{dname}-birthday"[:32],
-                                                                           reason=f"{member.display_name}"
-                                                                                  f"'s birthday.")
-                        createdchannels.append(bchannel.id)
-                        await bchannel.send(f"Happy {humanize.ordinal(age)} Birthday {member.mention}!!",
-                                            allowed_mentions=discord.AllowedMentions(everyone=False, roles=False,
-                                                                                     users=True, replied_user=True))
-            # schedule next birthday event
-            thisyear = now.year
-            nextbirthday = birthday
-            while nextbirthday < now:
-                try:
-                    nextbirthday = nextbirthday.replace(year=thisyear)
-                except ValueError as e:  # leap years are weird
-                    logger.debug(str(e))
-                thisyear += 1
-            await schedule(nextbirthday, "birthday", {"user": eventdata["user"], "birthday": birthday.timestamp()})
-            # delete birthday channels in 24 hours
-            await schedule(now + timedelta(days=1), "delbirthdaychannel", {"channels": createdchannels})
+        elif eventtype == "end_lockdown":
+            guild = await botcopy.fetch_guild(eventdata["guild"])
+            await guild.edit(verification_level=discord.VerificationLevel(eventdata["verification_level"]),
+                             reason="End of raid lockdown.")
+            await modlog.modlog("Raid lockdown ended, the verification level is back to normal.", guild.id)
+        elif eventtype == "birthday_sweep":
+            await birthday_sweep()
         elif eventtype == "delbirthdaychannel":
             for ch in eventdata["channels"]:
                 channel = botcopy.get_channel(ch)
@@ -144,29 +238,142 @@ async def run_event(dbrowid, eventtype: str, eventdata: dict):
         logger.error(e, exc_info=(type(e), e, e.__traceback__))
 
 
-async def schedule(time: datetime, eventtype: str, eventdata: dict):
-    assert time.tzinfo is not None  # offset aware datetimes my beloved
-    if time <= datetime.now(tz=timezone.utc):
-        logger.debug(f"running event now")
-        await run_event(None, eventtype, eventdata)
+async def birthday_sweep():
+    # runs every hour. each timezone hits midnight during exactly one sweep a day, so only birthdays whose local
+    # time is currently 00:xx are celebrated
+    now = datetime.now(tz=timezone.utc)
+    # local dates anywhere from UTC-12 to UTC+14
+    dates = {((now + timedelta(hours=h)).month, (now + timedelta(hours=h)).day) for h in (-12, 0, 14)}
+    async with database.db.execute(f"SELECT user, birthday, tz, month, day FROM birthdays WHERE "
+                                   f"{' OR '.join(['(month=? AND day=?)'] * len(dates))}",
+                                   [x for date in dates for x in date]) as cur:
+        birthdays = []
+        async for user, birthday, tz, month, day in cur:
+            tz = timezone(timedelta(hours=tz))
+            local = now.astimezone(tz)
+            if local.hour == 0 and (local.month, local.day) == (month, day):
+                birthdays.append((user, local.year - datetime.fromtimestamp(birthday, tz=tz).year))
+    if not birthdays:
+        return
+    # load every guild with birthdays enabled once instead of querying per guild per birthday
+    async with database.db.execute("SELECT guild, birthday_category FROM server_config "
+                                   "WHERE birthday_category IS NOT NULL") as cur:
+        categories = []
+        async for guildid, categoryid in cur:
+            guild = botcopy.get_guild(guildid)
+            if guild is not None and (category := guild.get_channel(categoryid)) is not None:
+                categories.append(category)
+    ratelimit = asyncio.Semaphore(BIRTHDAY_CHANNEL_CONCURRENCY)
+
+    async def celebrate(category: discord.CategoryChannel, member: discord.Member, age: int):
+        async with ratelimit:
+            dname = ''.join(c for c in member.display_name.lower() if c.isalnum() or c == "-")
+            bchannel = await category.create_text_channel(f"🎂{dname}-birthday"[:32],
+                                                          reason=f"{member.display_name}'s birthday.")
+            await outbound.send(bchannel, f"Happy {humanize.ordinal(age)} Birthday {member.mention}!!",
+                                allowed_mentions=discord.AllowedMentions(everyone=False, roles=False,
+                                                                         users=True, replied_user=True),
+                                priority=outbound.Priority.LOG)
+            return bchannel.id
+
+    celebrations = [celebrate(category, member, age) for user, age in birthdays for category in categories
+                    if (member := category.guild.get_member(user)) is not None]
+    createdchannels = []
+    for result in await asyncio.gather(*celebrations, return_exceptions=True):
+        if isinstance(result, Exception):
+            logger.error(result, exc_info=(type(result), result, result.__traceback__))
+        else:
+            createdchannels.append(result)
+    logger.debug(f"celebrated {len(birthdays)} birthday(s) in {len(createdchannels)} channel(s)")
+    if createdchannels:
+        # delete birthday channels in 24 hours
+        await schedule(now + timedelta(days=1), "delbirthdaychannel", {"channels": createdchannels},
+                       durable=False)
+
 
-    async with database.db.execute("INSERT INTO schedule (eventtime, eventtype, eventdata) VALUES (?,?,?)",
-                                   (time.timestamp(), eventtype, json.dumps(eventdata))) as cursor:
-        lri = cursor.lastrowid
-        timef = time.astimezone(tz=timezone.utc).replace(tzinfo=None)
-        task = scheduler.schedule(run_event(lri, eventtype, eventdata), timef)
-        loadedtasks[lri] = task
+async def schedule(time: datetime, eventtype: str, eventdata: dict, recurrence: typing.Optional[dict] = None,
+                   durable: bool = True):
+    return (await schedule_many([(time, eventtype, eventdata, recurrence)], durable))[0]
+
+
+async def schedule_many(events: typing.Iterable[tuple], durable: bool = True) -> typing.List[int]:
+    """
+    schedule several events at once. all rows are inserted in one transaction and registered with the scheduler
+    in one pass, which is much cheaper than calling schedule() per event for mass bans/mutes.
+    events in the past (or due within DUE_MARGIN) are still stored and are ran right away.
+    :param events: iterable of (time, eventtype, eventdata) or (time, eventtype, eventdata, recurrence) tuples,
+    times must be offset aware
+    :param durable: if False, events sooner than EPHEMERAL_THRESHOLD are only kept in memory on the timing wheel
+    and will be lost if the bot restarts. later events are always stored.
+    :return: list of event IDs in the same order as events. in-memory events have negative IDs.
+    """
+    events = [(*event, None) if len(event) == 3 else event for event in events]
+    if not events:
+        return []
+    now = datetime.now(tz=timezone.utc)
+    rows = []
+    for time, eventtype, eventdata, recurrence in events:
+        assert time.tzinfo is not None  # offset aware datetimes my beloved
+        if not durable and recurrence is None and time - now < EPHEMERAL_THRESHOLD:
+            rows.append(next(ephemeral_ids))
+            continue
+        async with database.db.execute("INSERT INTO schedule (eventtime, eventtype, eventdata, recurrence) "
+                                       "VALUES (?,?,?,?)",
+                                       (time.timestamp(), eventtype, json.dumps(eventdata),
+                                        json.dumps(recurrence) if recurrence else None)) as cursor:
+            rows.append(cursor.lastrowid)
+    if any(lri > 0 for lri in rows):
+        await database.db.commit()
+    # only register once the rows are safely committed
+    for lri, (time, eventtype, eventdata, recurrence) in zip(rows, events):
+        # one event failing to register mustn't stop the rest of the batch, the stored ones still run on restart
+        try:
+            if lri < 0:
+                track(lri, eventtype, eventdata,
+                      wheel.schedule(max((time - now).total_seconds(), 0),
+                                     lambda lri=lri, eventtype=eventtype, eventdata=eventdata:
+                                     run_event(lri, eventtype, eventdata)))
+            else:
+                register(lri, time, eventtype, eventdata, recurrence)
+        except Exception as e:
+            logger.error(e, exc_info=(type(e), e, e.__traceback__))
+            continue
         logger.debug(f"scheduled event #{lri} for {time}")
-        # logger.debug(loadedtasks)
-    await database.db.commit()
-    return lri
-
-
-async def canceltask(dbrowid: int):
-    scheduler.cancel(loadedtasks[dbrowid])
-    await database.db.execute("DELETE FROM schedule WHERE id=?", (dbrowid,))
-    await database.db.commit()
-    # it throws a runtime warning "coroutine was never ran" like no shit that is the entire idea
-    loadedtasks[dbrowid].callback.close()
-    del loadedtasks[dbrowid]
-    logger.debug(f"Cancelled task {dbrowid}")
+    return rows
+
+
+async def cancel_matching(eventtypes: typing.Union[str, typing.Iterable[str]], guild: typing.Optional[int] = None,
+                          member: typing.Optional[int] = None) -> int:
+    """
+    cancel all pending events of one or more types about a guild/member, without touching the database to find them
+    :param eventtypes: one or more event types
+    :param guild: the "guild" in the event data, None for events without one (i.e. birthdays)
+    :param member: the "member" (or "user") in the event data
+    :return: number of events cancelled
+    """
+    if isinstance(eventtypes, str):
+        eventtypes = [eventtypes]
+    ids = set().union(*(eventindex.get((eventtype, guild, member), ()) for eventtype in eventtypes))
+    return await cancel_many(ids)
+
+
+async def cancel_many(eventids: typing.Iterable[int]) -> int:
+    """
+    cancel several events with one database statement
+    :param eventids: IDs returned by schedule()/schedule_many()
+    :return: number of events cancelled
+    """
+    eventids = [eventid for eventid in eventids if eventid in loadedtasks]
+    stored = [eventid for eventid in eventids if eventid > 0]
+    for i in range(0, len(stored), 500):  # stay under sqlite's variable limit
+        chunk = stored[i:i + 500]
+        await database.db.execute(f"DELETE FROM schedule WHERE id IN ({','.join('?' * len(chunk))})", chunk)
+    if stored:
+        await database.db.commit()
+    for eventid in eventids:
+        task = loadedtasks[eventid]
+        untrack(eventid)
+        if eventid < 0:
+            wheel.cancel(task)
+        logger.debug(f"Cancelled task {eventid}")
+    return len(eventids)
@@ -0,0 +1,136 @@
+import collections
+import re
+import time
+import typing
+
+import discord
+from discord.ext import commands
+
+import jsonconfig
+
+STATE_SIZE = 50000  # (guild, user) states kept in memory, the least recently active are forgotten first
+DUPLICATE_RING = 10  # recent messages remembered per user to find duplicates in
+PUNISH_COOLDOWN = 30  # seconds after being punished before a user can be punished again, their spam is still deleted
+ACTIONS = ("none", "warn", "mute")
+# settings of a guild with the spam filter turned on, until they're changed with m.spamfilter. times are in seconds.
+DEFAULTS = {
+    "duplicates": 4,  # the same message this many times within duplicate_window is spam, 0 to not check
+    "duplicate_window": 60,
+    "rate": 8,  # more than this many messages within rate_window is spam, 0 to not check
+    "rate_window": 5,
+    "emojis": 20,  # more than this many emojis in one message is spam, 0 to not check
+    "links": 5,  # this many messages with links within link_window is spam, 0 to not check
+    "link_window": 30,
+    "action": "none",  # done to spammers on top of deleting the message
+    "points": 1,  # points of the warn when action is warn
+    "mute_duration": 600  # when action is mute, 0 for permanent
+}
+
+custom_emoji_regex = re.compile(r"<a?:\w+:\d+>")
+# rough but cheap, covers the blocks nearly every emoji is in
+unicode_emoji_regex = re.compile("[\U0001F000-\U0001FAFF\u2600-\u27BF\u2B00-\u2BFF]")
+link_regex = re.compile(r"https?://", re.IGNORECASE)
+
+
+class SpamConfig(jsonconfig.JSONConfig):
+    __slots__ = tuple(DEFAULTS)
+    DEFAULTS = DEFAULTS
+    DURATIONS = frozenset({"duplicate_window", "rate_window", "link_window", "mute_duration"})
+    FLOATS = frozenset({"points"})
+    ACTIONS = ACTIONS
+
+    def validate(self, setting: str, value):
+        super().validate(setting, value)
+        if setting in self.DURATIONS and setting != "mute_duration" and not value:
+            raise commands.BadArgument(f"`{setting}` has to be longer than 0.")
+        if setting == "duplicates" and value > DUPLICATE_RING:
+            # only the last DUPLICATE_RING messages are remembered, more repeats than that could never be seen
+            raise commands.BadArgument(f"`duplicates` can be at most {DUPLICATE_RING}.")
+
+
+configs = jsonconfig.ConfigCache("spam_filter", SpamConfig)
+get_config = configs.get
+invalidate_config = configs.invalidate  # call after changing spam_filter of a guild
+
+
+class SpamState:
+    """what's needed to judge a user's next message, everything is bounded so checking a message is constant time"""
+    __slots__ = ("hashes", "tokens", "updated", "links", "punished_until")
+
+    def __init__(self, now: float, rate: float):
+        self.hashes: typing.Deque[typing.Tuple[float, int]] = collections.deque(maxlen=DUPLICATE_RING)
+        self.tokens = rate  # token bucket for the message rate
+        self.updated = now
+        self.links: typing.Deque[float] = collections.deque()  # times of the last few messages with links
+        self.punished_until = 0.0
+
+
+states: typing.OrderedDict[typing.Tuple[int, int], SpamState] = collections.OrderedDict()
+
+
+def content_hash(message: discord.Message) -> int:
+    if message.content:
+        return hash(" ".join(message.content.casefold().split()))
+    return hash(tuple((a.filename, a.size) for a in message.attachments))
+
+
+def check(message: discord.Message, config: SpamConfig) -> typing.Tuple[typing.Optional[str], SpamState]:
+    """
+    update the author's state with a message and see if it's spam
+    :param message: a message in a guild
+    :param config: the guild's config
+    :return: why the message is spam or None if it isn't, and the author's state to pass to should_punish()
+    """
+    now = time.monotonic()
+    key = (message.guild.id, message.author.id)
+    state = states.get(key)
+    if state is None:
+        state = states[key] = SpamState(now, config.rate)
+        if len(states) > STATE_SIZE:
+            states.popitem(last=False)
+    else:
+        states.move_to_end(key)
+    reason = None
+
+    if config.rate:
+        state.tokens = min(config.rate, state.tokens + (now - state.updated) * config.rate / config.rate_window)
+        state.updated = now
+        if state.tokens < 1:
+            reason = "sending messages too quickly"
+        else:
+            state.tokens -= 1
+
+    if config.duplicates:
+        digest = content_hash(message)
+        cutoff = now - config.duplicate_window
+        repeats = 1 + sum(1 for sent, h in state.hashes if h == digest and sent > cutoff)
+        state.hashes.append((now, digest))
+        if reason is None and repeats >= config.duplicates:
+            reason = f"sending the same message {repeats} times"
+
+    if config.links and link_regex.search(message.content):
+        state.links.append(now)
+        while len(state.links) > config.links:
+            state.links.popleft()
+        if reason is None and len(state.links) == config.links and state.links[0] > now - config.link_window:
+            reason = f"sending {config.links} messages with links too quickly"
+
+    if config.emojis and reason is None and len(message.content) > config.emojis:  # can't have more emojis than chars
+        emojis = len(custom_emoji_regex.findall(message.content)) + \
+                 len(unicode_emoji_regex.findall(custom_emoji_regex.sub("", message.content)))
+        if emojis > config.emojis:
+            reason = f"sending {emojis} emojis in one message"
+    return reason, state
+
+
+def should_punish(state: SpamState) -> bool:
+    """
+    call when a message is spam, stops someone from getting punished for every message of one burst of spam
+    :param state: the author's state from check(), it may have been evicted from states since
+    :return: if the author should be punished, False if they were punished recently
+    """
+    now = time.monotonic()
+    if state.punished_until > now:
+        return False
+    state.punished_until = now + PUNISH_COOLDOWN
+    return True
@@ -1,5 +1,5 @@
 import re
-from datetime import timedelta
+from datetime import datetime, timedelta, timezone
 
 from discord.ext import commands
 
@@ -25,3 +25,13 @@ def time_converter(argument) -> timedelta:
         except ValueError:
             raise commands.BadArgument(f"{v} is not a number!")
     return timedelta(seconds=time)
+
+
+def date_converter(argument) -> datetime:
+    """
+    Converts a date such as "2023-06-01" into a UTC datetime
+    """
+    try:
+        return datetime.strptime(argument, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+    except ValueError:
+        raise commands.BadArgument(f"{argument} is not a valid date, use YYYY-MM-DD.")
@@ -0,0 +1,120 @@
+import asyncio
+import inspect
+import typing
+
+from clogs import logger
+
+
+class TimerHandle:
+    __slots__ = ("expiry", "callback", "level", "slot")
+
+    def __init__(self, expiry: int, callback: typing.Callable):
+        self.expiry = expiry
+        self.callback = callback
+        self.level = None
+        self.slot = None
+
+
+class TimingWheel:
+    """
+    hierarchical hashed timing wheel, used for short lived timers that don't need the database.
+    inserting and cancelling a timer are both O(1), and each tick only touches the timers that are due.
+    """
+
+    def __init__(self, tick: float = 1, bits: int = 6, levels: int = 3,
+                 tasks: typing.Optional[typing.Set[asyncio.Task]] = None):
+        """
+        :param tick: seconds per tick, the resolution of the wheel
+        :param bits: each level has 2**bits slots
+        :param levels: number of levels, the wheel can hold timers up to tick * 2**(bits*levels) seconds out
+        :param tasks: set that tasks of callbacks are kept in until they finish, so they aren't garbage collected
+        """
+        self.tick = tick
+        self.bits = bits
+        self.mask = (1 << bits) - 1
+        self.levels = levels
+        self.wheels: typing.List[typing.List[set]] = [[set() for _ in range(1 << bits)] for _ in range(levels)]
+        self.current = 0  # current tick
+        self.span = tick * (1 << (bits * levels))  # max delay in seconds
+        self.pending = 0
+        self.task: typing.Optional[asyncio.Task] = None
+        self.tasks = tasks if tasks is not None else set()
+
+    def _place(self, handle: TimerHandle):
+        # the level is decided by the highest block of bits where the expiry differs from the current tick,
+        # the timer then cascades down a level each time the lower levels wrap around to it.
+        # anything past the top level is less than one revolution out so it goes in the top level too.
+        level = min(max((handle.expiry ^ self.current).bit_length() - 1, 0) // self.bits, self.levels - 1)
+        slot = (handle.expiry >> (self.bits * level)) & self.mask
+        handle.level = level
+        handle.slot = slot
+        self.wheels[level][slot].add(handle)
+
+    def schedule(self, delay: float, callback: typing.Callable) -> TimerHandle:
+        """
+        run a callback after a delay
+        :param delay: seconds from now, must be less than span
+        :param callback: called with no arguments, if it returns an awaitable it is ran as a task
+        :return: handle which can be passed to cancel()
+        """
+        if delay >= self.span:
+            raise ValueError(f"Delay {delay} exceeds timing wheel span of {self.span}")
+        handle = TimerHandle(self.current + max(int(-(-delay // self.tick)), 1), callback)
+        self._place(handle)
+        self.pending += 1
+        return handle
+
+    def cancel(self, handle: TimerHandle) -> bool:
+        """
+        cancel a timer
+        :param handle: handle returned by schedule()
+        :return: True if the timer was cancelled, False if it already ran or was cancelled
+        """
+        if handle.level is None:
+            return False
+        self.wheels[handle.level][handle.slot].discard(handle)
+        handle.level = None
+        self.pending -= 1
+        return True
+
+    def advance(self):
+        """move the wheel forward one tick, running any timers that are due"""
+        self.current += 1
+        # cascade higher levels whose slot we just reached, highest first so timers can fall through several levels
+        wrapped = 1
+        while wrapped < self.levels and not self.current & ((1 << (self.bits * wrapped)) - 1):
+            wrapped += 1
+        for level in reversed(range(1, wrapped)):
+            slot = self.wheels[level][(self.current >> (self.bits * level)) & self.mask]
+            cascading = list(slot)
+            slot.clear()
+            for handle in cascading:
+                self._place(handle)
+        slot = self.wheels[0][self.current & self.mask]
+        due = list(slot)
+        slot.clear()
+        for handle in due:
+            handle.level = None
+            self.pending -= 1
+            try:
+                result = handle.callback()
+                if inspect.isawaitable(result):
+                    task = asyncio.ensure_future(result)
+                    self.tasks.add(task)
+                    task.add_done_callback(self.tasks.discard)
+            except Exception as e:
+                logger.error(e, exc_info=(type(e), e, e.__traceback__))
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        start = loop.time() - self.current * self.tick
+        while True:
+            # catch up on any ticks missed while the loop was busy instead of drifting
+            target = int((loop.time() - start) / self.tick)
+            while self.current < target:
+                self.advance()
+            await asyncio.sleep(start + (self.current + 1) * self.tick - loop.time())
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
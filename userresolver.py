@@ -0,0 +1,72 @@
+import asyncio
+import collections
+import time
+import typing
+
+import discord
+from discord.ext import commands
+
+from clogs import logger
+
+USER_CACHE_TTL = 3600  # seconds to keep users fetched over REST
+USER_CACHE_SIZE = 10000  # fetched users kept, the least recently fetched are forgotten first
+FETCH_CONCURRENCY = 5  # max users fetched at once
+
+# users discord.py doesn't have cached, ID -> (user or None if they don't exist, expiry)
+fetched: typing.OrderedDict[int, typing.Tuple[typing.Optional[discord.User], float]] = collections.OrderedDict()
+
+
+async def resolve(bot: commands.Bot, ids: typing.Iterable[typing.Optional[int]]) \
+        -> typing.Dict[int, typing.Optional[discord.User]]:
+    """
+    get many users at once, preferring the gateway cache and only fetching the ones that aren't anywhere
+    :param bot: the bot
+    :param ids: user IDs, can have duplicates and Nones
+    :return: dict of ID -> user, or None if the user doesn't exist or couldn't be fetched
+    """
+    out = {}
+    misses = []
+    now = time.monotonic()
+    for userid in dict.fromkeys(ids):
+        if userid is None:
+            continue
+        user = bot.get_user(userid)
+        if user is not None:
+            out[userid] = user
+        elif userid in fetched and fetched[userid][1] > now:
+            out[userid] = fetched[userid][0]
+        else:
+            misses.append(userid)
+    if misses:
+        ratelimit = asyncio.Semaphore(FETCH_CONCURRENCY)
+
+        async def fetch(userid: int):
+            async with ratelimit:
+                try:
+                    user = await bot.fetch_user(userid)
+                except discord.NotFound:
+                    user = None
+                except discord.HTTPException as e:
+                    # one user failing shouldn't fail everything that needed the others, show them by ID instead
+                    logger.debug(f"couldn't fetch user {userid}: {e}")
+                    out[userid] = None
+                    return
+            # every entry gets the same TTL, so the least recently fetched is also the first to expire
+            fetched[userid] = (user, time.monotonic() + USER_CACHE_TTL)
+            fetched.move_to_end(userid)
+            if len(fetched) > USER_CACHE_SIZE:
+                fetched.popitem(last=False)
+            out[userid] = user
+
+        await asyncio.gather(*[fetch(userid) for userid in misses])
+    return out
+
+
+async def get_user(bot: commands.Bot, userid: int) -> typing.Optional[discord.User]:
+    """
+    get one user, see resolve()
+    :param bot: the bot
+    :param userid: the user's ID
+    :return: the user or None if they don't exist
+    """
+    return (await resolve(bot, [userid]))[userid]
@@ -1,14 +1,261 @@
+import asyncio
+import collections
+import io
+import re
+import typing
+import unicodedata
+
+import discord
 from discord.ext import commands
 
+import database
+import modlog
+from clogs import logger
+from moderation import mod_only
+
+# characters people swap in for letters to get around filters
+# (not ! or |, they end sentences far more often than they replace an i)
+LEET = {"0": "o", "1": "i", "3": "e", "4": "a", "5": "s", "7": "t", "8": "b", "9": "g", "@": "a", "$": "s"}
+# removed before matching: zero width characters, soft hyphens and the accents NFKD splits off of letters
+INVISIBLE = [0x00AD, 0x034F, 0x180E, 0x2060, 0xFEFF] + list(range(0x200B, 0x2010)) + list(range(0x0300, 0x0370))
+translation = str.maketrans({**LEET, **{chr(c): None for c in INVISIBLE}})
+separators = re.compile(r"[\W_]+")
+
+
+def normalize(text: str) -> str:
+    """
+    reduce text to lowercase words separated by single spaces, with leetspeak, accents and invisible characters undone
+    so "H3LL0!" and "ĥéll\u200bo" both become " hello "
+    :param text: a message or a filtered word
+    :return: the normalized text with a space on both ends
+    """
+    text = unicodedata.normalize("NFKD", text).casefold().translate(translation)
+    return " " + separators.sub(" ", text).strip() + " "
+
+
+def pattern_of(word: str) -> str:
+    """
+    :param word: a filtered word, * at the start or end lets it match inside longer words
+    :return: what to look for in normalized text
+    """
+    pattern = normalize(word.strip("*"))
+    if word.startswith("*"):
+        pattern = pattern.lstrip(" ")
+    if word.endswith("*"):
+        pattern = pattern.rstrip(" ")
+    return pattern
+
+
+class Automaton:
+    """Aho-Corasick automaton, finds any of a guild's filtered words in one pass over a message"""
+    __slots__ = ("goto", "fail", "out")
+
+    def __init__(self, words: typing.Iterable[str]):
+        self.goto: typing.List[typing.Dict[str, int]] = [{}]
+        self.fail: typing.List[int] = [0]
+        self.out: typing.List[typing.Optional[str]] = [None]  # a filtered word that ends at each node
+        for word in words:
+            pattern = pattern_of(word)
+            if not pattern.strip():
+                continue
+            node = 0
+            for char in pattern:
+                if char not in self.goto[node]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(None)
+                    self.goto[node][char] = len(self.goto) - 1
+                node = self.goto[node][char]
+            self.out[node] = word
+        queue = collections.deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self.goto[node].items():
+                queue.append(child)
+                fail = self.fail[node]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(char, 0)
+                if self.out[child] is None:
+                    self.out[child] = self.out[self.fail[child]]
+
+    def search(self, text: str) -> typing.Optional[str]:
+        """
+        :param text: normalized text
+        :return: the first filtered word found, or None
+        """
+        goto, fail, out = self.goto, self.fail, self.out
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if out[node] is not None:
+                return out[node]
+        return None
+
+
+# guild ID -> version of its word list, bumped whenever the list changes
+versions: typing.Dict[int, int] = {}
+# guild ID -> (version the automaton was built from, automaton or None if the guild has no words)
+automata: typing.Dict[int, typing.Tuple[int, typing.Optional[Automaton]]] = {}
+building: typing.Dict[int, asyncio.Task] = {}
+
+
+async def build(guildid: int) -> typing.Optional[Automaton]:
+    try:
+        version = versions.get(guildid, 0)
+        async with database.db.execute("SELECT word FROM filtered_words WHERE guild=?", (guildid,)) as cur:
+            words = [row[0] for row in await cur.fetchall()]
+        # big lists take a while to build, don't hold up everything else
+        automaton = await asyncio.to_thread(Automaton, words) if words else None
+        automata[guildid] = (version, automaton)
+        return automaton
+    finally:
+        del building[guildid]
+
+
+def start_build(guildid: int):
+    if guildid not in building:
+        building[guildid] = asyncio.create_task(build(guildid))
+
+
+async def get_automaton(guildid: int) -> typing.Optional[Automaton]:
+    """
+    get the automaton of a guild's current word list. if the list changed, the old automaton is used until the new
+    one is built.
+    :param guildid: ID of the guild
+    :return: the automaton or None if the guild has no filtered words
+    """
+    cached = automata.get(guildid)
+    if cached is not None and cached[0] == versions.get(guildid, 0):
+        return cached[1]
+    start_build(guildid)
+    if cached is not None:
+        return cached[1]
+    return await asyncio.shield(building[guildid])
+
+
+def invalidate(guildid: int):
+    """call after changing the filtered words of a guild"""
+    versions[guildid] = versions.get(guildid, 0) + 1
+    start_build(guildid)
+
 
 class WordFilterCog(commands.Cog, name="Word Filter"):
     """
     Moderation commands for auto-deleting certain words.
     """
+
     def __init__(self, bot):
         self.bot = bot
 
-    # command here
+    async def filter(self, guild: discord.Guild, channel: discord.abc.Messageable, messageid: int,
+                     author: typing.Optional[discord.Member], content: str):
+        if author is None or author.bot or author.guild_permissions.manage_messages:
+            return
+        automaton = await get_automaton(guild.id)
+        if automaton is None:
+            return
+        word = automaton.search(normalize(content))
+        if word is None:
+            return
+        try:
+            await channel.get_partial_message(messageid).delete()
+        except discord.HTTPException as e:
+            logger.debug(e)
+            return
+        await modlog.modlog(f"Deleted a message from {author.mention} (`{author}`) in {channel.mention} "
+                            f"containing the filtered word ||{discord.utils.escape_markdown(word)}||.", guild.id,
+                            author.id)
+
+    @commands.Cog.listener()
+    async def on_message(self, message: discord.Message):
+        if message.guild is None or not isinstance(message.author, discord.Member):
+            return
+        await self.filter(message.guild, message.channel, message.id, message.author, message.content)
+
+    @commands.Cog.listener()
+    async def on_raw_message_edit(self, payload: discord.RawMessageUpdateEvent):
+        # raw so edits of messages that aren't cached are filtered too
+        if payload.guild_id is None or "content" not in payload.data or "author" not in payload.data:
+            return
+        guild = self.bot.get_guild(payload.guild_id)
+        channel = guild.get_channel_or_thread(payload.channel_id) if guild else None
+        if channel is None:
+            return
+        await self.filter(guild, channel, payload.message_id, guild.get_member(int(payload.data["author"]["id"])),
+                          payload.data["content"])
+
+    @commands.command(aliases=["addfilter", "filteradd", "banword"])
+    @mod_only()
+    async def filterword(self, ctx, *words: str):
+        """
+        Automatically delete messages containing words.
+        Case, accents, leetspeak, punctuation and invisible characters are ignored. Words only match whole words
+        unless they start or end with `*`, like `word*` to also match `words`.
+        Members with Manage Messages permissions are never filtered.
+
+        :param ctx: discord context
+        :param words: one or more words or phrases to filter, put phrases in "quotes".
+        """
+        words = [w.strip() for w in words if pattern_of(w.strip()).strip()]
+        if not words:
+            raise commands.BadArgument("Give at least one word to filter.")
+        cur = await database.db.executemany("INSERT OR IGNORE INTO filtered_words (guild, word) VALUES (?, ?)",
+                                            [(ctx.guild.id, word) for word in words])
+        await database.db.commit()
+        invalidate(ctx.guild.id)
+        try:
+            await ctx.message.delete()  # don't leave the words in chat
+        except discord.HTTPException as e:
+            logger.debug(e)
+        await ctx.send(f"✔️ {ctx.author.mention} added {cur.rowcount} word{'' if cur.rowcount == 1 else 's'} "
+                       f"to the word filter.")
+        await modlog.modlog(f"{ctx.author.mention} (`{ctx.author}`) added {cur.rowcount} "
+                            f"word{'' if cur.rowcount == 1 else 's'} to the word filter.", ctx.guild.id,
+                            modid=ctx.author.id)
+
+    @commands.command(aliases=["removefilter", "filterremove", "unbanword"])
+    @mod_only()
+    async def unfilterword(self, ctx, *words: str):
+        """
+        Stop deleting messages containing words.
+
+        :param ctx: discord context
+        :param words: one or more words or phrases to stop filtering, exactly as they were added.
+        """
+        if not words:
+            raise commands.BadArgument("Give at least one word to stop filtering.")
+        cur = await database.db.executemany("DELETE FROM filtered_words WHERE guild=? AND word=?",
+                                            [(ctx.guild.id, word.strip()) for word in words])
+        await database.db.commit()
+        invalidate(ctx.guild.id)
+        try:
+            await ctx.message.delete()
+        except discord.HTTPException as e:
+            logger.debug(e)
+        await ctx.send(f"✔️ {ctx.author.mention} removed {cur.rowcount} word{'' if cur.rowcount == 1 else 's'} "
+                       f"from the word filter.")
+        await modlog.modlog(f"{ctx.author.mention} (`{ctx.author}`) removed {cur.rowcount} "
+                            f"word{'' if cur.rowcount == 1 else 's'} from the word filter.", ctx.guild.id,
+                            modid=ctx.author.id)
+
+    @commands.command(aliases=["listfilter", "filterlist", "bannedwords"])
+    @mod_only()
+    async def filteredwords(self, ctx):
+        """
+        List the words in the word filter, as a file so they aren't shown in chat.
+        """
+        async with database.db.execute("SELECT word FROM filtered_words WHERE guild=? ORDER BY word",
+                                       (ctx.guild.id,)) as cur:
+            words = [row[0] for row in await cur.fetchall()]
+        if not words:
+            await ctx.reply("This server has no filtered words. Add some with m.filterword.")
+            return
+        buf = io.BytesIO("\n".join(words).encode("utf8"))
+        await ctx.reply(f"This server has {len(words)} filtered word{'' if len(words) == 1 else 's'}.",
+                        file=discord.File(buf, filename="filtered_words.txt"))
 
 
 '''